@@ -25,7 +25,14 @@ class StructureChildSerializer(serializers.ModelSerializer):
 
 
 class StructureSerializer(serializers.ModelSerializer):
-    children = StructureChildSerializer(many=True)
+    children = serializers.SerializerMethodField()
+
+    def get_children(self, structure):
+        # use the children loaded for a whole page of structures, if any
+        children = getattr(structure, "loaded_children", None)
+        if children is None:
+            children = structure.children
+        return StructureChildSerializer(children, many=True).data
 
     class Meta:
         model = Structure
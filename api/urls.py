@@ -44,6 +44,11 @@ urlpatterns = [
         views.country_population,
         name="api_country_population",
     ),
+    path(
+        "country/<str:country_code>/area_data",
+        views.country_area_data,
+        name="api_country_area_data",
+    ),
     path(
         "country/<str:country_code>/declarations",
         views.country_declarations,
@@ -69,6 +74,16 @@ urlpatterns = [
         views.country_trigger_recount,
         name="api_country_trigger_recount",
     ),
+    path(
+        "country/<str:country_code>/tree_integrity",
+        views.country_tree_integrity,
+        name="api_country_tree_integrity",
+    ),
+    path(
+        "world/tree_integrity",
+        views.tree_integrity,
+        name="api_tree_integrity",
+    ),
     path(
         "popcount/regenerate",
         views.trigger_all_recounts,
@@ -76,6 +91,7 @@ urlpatterns = [
     ),
     path("area/del/<int:area_id>", views.area_del, name="api_area_del"),
     path("area/<int:area_id>/row", views.area_data, name="api_area_data"),
+    path("area/<int:area_id>/tree", views.area_tree, name="api_area_tree"),
     path(
         "structure/del/<int:structure_id>",
         views.structure_del,
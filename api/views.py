@@ -1,8 +1,17 @@
 from django.shortcuts import get_object_or_404, render, redirect, Http404, HttpResponse
-from django.http import JsonResponse
+from django.contrib import messages
+from django.http import JsonResponse, HttpResponseBadRequest
+from django.template.loader import render_to_string
 from django.views.decorators.csrf import csrf_protect
 from api.serializers import AreaSerializer, StructureSerializer
-from rest_framework import generics, mixins, viewsets, permissions
+from rest_framework import (
+    exceptions,
+    generics,
+    mixins,
+    pagination,
+    permissions,
+    viewsets,
+)
 
 from govtrack.models import (
     Declaration,
@@ -13,7 +22,12 @@ from govtrack.models import (
     PopCount,
     ImportDeclaration,
 )
-from govtrack.forms import AreaForm
+from govtrack.areaimport import AreaImport
+from govtrack.batchimport import read_csv, read_paste
+from govtrack.inboximport import InboxImport
+from govtrack.integrity import check_countries
+from govtrack.popcount import CountrySnapshot
+from govtrack.treebuilder import AreaBranch, load_structure_children
 
 import csv
 import datetime
@@ -24,12 +38,13 @@ from datetime import timedelta
 
 logger = logging.getLogger("cegov")
 DATE_FORMAT = "%Y-%m-%d"
+# the most import errors shown on the page after a bulk add
+MAX_IMPORT_MESSAGES = 20
 
 ## PUBLIC METHODS ##
 
 
-def area_data(request, area_id):
-    area = get_object_or_404(Area, pk=area_id)
+def area_data_row(area, contribution):
     decl = area.latest_declaration
     dec_date = ""
     bestlink = ""
@@ -41,7 +56,7 @@ def area_data(request, area_id):
         # links = decl.links.all()
         # if links:
         #    bestlink = links[0].url
-    areadata = [
+    return [
         area.name,
         1,
         area.location,
@@ -50,14 +65,63 @@ def area_data(request, area_id):
         "",  # empty col
         contact,
         bestlink,  # key document/reference
-        area.contribution(),
+        contribution,
     ]
+
+
+def area_data(request, area_id):
+    area = get_object_or_404(Area, pk=area_id)
+    response = HttpResponse(content_type="text/csv")
+    writer = csv.writer(response)
+    writer.writerow(area_data_row(area, area.contribution()))
+    return response
+
+
+def country_area_data(request, country_code):
+    """The same rows as area_data, for every area in a country."""
+    country = Country.find_by_code(country_code)
+    if not country:
+        raise Http404("No country for specified code")
+    contributions = CountrySnapshot.load(country).contributions()
+    areas = Area.objects.filter(country=country.id).order_by("structure", "sort_name")
     response = HttpResponse(content_type="text/csv")
     writer = csv.writer(response)
-    writer.writerow(areadata)
+    for area in areas:
+        _, contribution = contributions.get(area.id, (0, 0))
+        writer.writerow(area_data_row(area, contribution))
     return response
 
 
+def area_tree(request, area_id):
+    """Return an area and the areas under it, down to ?depth= levels, for
+    expanding the tree of areas a branch at a time. With ?html=1 each area
+    includes its table row, and with ?bulk=1 that has a bulk edit checkbox."""
+    area = get_object_or_404(Area, pk=area_id)
+    try:
+        depth = int(request.GET.get("depth", 1))
+    except ValueError:
+        return HttpResponseBadRequest("Bad depth")
+    if depth < 1:
+        return HttpResponseBadRequest("Bad depth")
+
+    branch = AreaBranch(area.country)
+    (area,) = branch.annotate(Area.objects.filter(pk=area.id))
+    branch.expand(area, depth)
+
+    render_row = None
+    if request.GET.get("html"):
+        show_bulk_edit = bool(request.GET.get("bulk"))
+
+        def render_row(row):
+            return render_to_string(
+                "govtrack/area-table-row.html",
+                {"area": row, "show_bulk_edit": show_bulk_edit},
+                request=request,
+            )
+
+    return JsonResponse(branch.as_json(area, render_row))
+
+
 def country_population(request, country_code):
     country = Country.find_by_code(country_code)
     if not country:
@@ -103,6 +167,28 @@ def country_regenerate_timeline(request, country_code):
         return HttpResponse(status=status)
 
 
+def country_tree_integrity(request, country_code):
+    status = 403
+    if request.user.is_authenticated:
+        country = Country.find_by_code(country_code)
+        if not country:
+            raise Http404("No country for specified code")
+        (report,) = check_countries([country])
+        return JsonResponse(report, content_type="application/json")
+    else:
+        return HttpResponse(status=status)
+
+
+def tree_integrity(request):
+    status = 403
+    if request.user.is_authenticated:
+        reports = check_countries(Country.objects.order_by("country_code"))
+        response = {"ok": all(r["ok"] for r in reports), "countries": reports}
+        return JsonResponse(response, content_type="application/json")
+    else:
+        return HttpResponse(status=status)
+
+
 def country_population_timeline(request, country_code):
     country = Country.find_by_code(country_code)
     if not country:
@@ -203,15 +289,17 @@ def country_declarations(request, country_code):
             return HttpResponseBadRequest("Bad date format")
         query_args["after"] = after_date
 
-    declist = country.declarations(**query_args)
+    declist = country.declarations(**query_args).select_related("area")
+    contributions = CountrySnapshot.load(country).contributions()
     for dec in declist:
+        num_declared_ancestors, _ = contributions.get(dec.area_id, (0, 0))
         writer.writerow(
             [
                 dec.area.name,
                 dec.area.location,
                 dec.area.population,
                 dec.display_event_date(),
-                dec.area.num_declared_ancestors(),
+                num_declared_ancestors,
             ]
         )
 
@@ -271,107 +359,64 @@ def import_declaration_del(request, import_declaration_id):
     return HttpResponse(status=status)
 
 
-# Create multiple areas at once from CSV-like text
+# Create multiple areas at once from CSV-like text, or an uploaded CSV file
+def report_import(request, report, summary):
+    """Show the outcome of a bulk import as messages on the next page."""
+    messages.info(request, summary)
+    for error in report["errors"][:MAX_IMPORT_MESSAGES]:
+        details = "; ".join(
+            "%s: %s" % (field, " ".join(errors))
+            for field, errors in error["errors"].items()
+        )
+        if error["line"]:
+            details = "line %s (%s) %s" % (error["line"], error["text"], details)
+        messages.error(request, details)
+    if len(report["errors"]) > MAX_IMPORT_MESSAGES:
+        messages.error(
+            request,
+            "and %s more lines with errors"
+            % (len(report["errors"]) - MAX_IMPORT_MESSAGES),
+        )
+
+
 def add_multi_areas(request, parent_id, structure_id):
     if request.method == "POST" and request.user.is_authenticated:
-        parent = Area.objects.get(id=parent_id)
-        lines = request.POST.get("area_csv_data").split("\n")
-        for line in lines:
-            row = line.split("|")
-            newarea_name = row.pop(0)
-            try:
-                newarea_pop = int(row.pop(0).replace(",", ""))
-            except:
-                newarea_pop = 0
-            logger.info(f"Adding {newarea_name} with pop {newarea_pop}")
-            form = AreaForm(
-                {
-                    "country": parent.country_id,
-                    "location": parent.location,
-                    "parent": parent_id,
-                    "structure": structure_id,
-                    "name": newarea_name,
-                    "sort_name": newarea_name,
-                    "population": newarea_pop,
-                }
-            )
-            if form.is_valid():
-                newarea = form.save()
-                logger.info(
-                    f"Created new area {newarea} population {newarea.population}"
-                )
-                for newurl in row:
-                    logger.info(f"newurl {newurl}")
-                    if not newurl:
-                        continue
-                    link_data = {
-                        "content_type_id": Area.content_type_id(),
-                        "object_id": newarea.id,
-                        "url": newurl,
-                    }
-                    newlink = Link(**link_data)
-                    try:
-                        newlink.full_clean()
-                        newlink.save()
-                        logger.info("Created new link %s" % newlink)
-                    except ValidationError as ex:
-                        logger.error("couldn't save new link: %s" % ex)
-            else:
-                logger.error(f"Errors in add_multi_areas: {form.errors}")
+        parent = get_object_or_404(Area, pk=parent_id)
+        structure = get_object_or_404(Structure, pk=structure_id)
+        upload = request.FILES.get("area_csv_file")
+        if upload:
+            rows = read_csv(upload.file)
+        else:
+            rows = read_paste(request.POST.get("area_csv_data", ""))
+        report = AreaImport(parent, structure).run(rows)
+        if "application/json" in request.headers.get("Accept", ""):
+            return JsonResponse(report)
+
+        report_import(
+            request,
+            report,
+            "Created %s areas with %s links" % (report["created"], report["links"]),
+        )
     return redirect("area", area_id=parent_id)
 
 
 # Inbox methods
 def add_multi_import_declarations(request, country_id):
     if request.user.is_authenticated and request.method == "POST":
-        try:
-            lines = request.POST.get("paste_data").split("\n")
-            data = []
-
-            for line in lines:
-                values = line.split("|")
-                date = False
-                for fmt in (
-                    "%d %b, %Y",
-                    "%d %b %Y",
-                    "%d %B %Y",
-                    "%Y-%m-%d",
-                    "%d %B, %Y",
-                    "%d-%m-%Y",
-                ):
-                    try:
-                        date = datetime.datetime.strptime(values[4], fmt).date()
-                        break
-                    except ValueError:
-                        pass
-                if not date:
-                    raise ValueError("no valid date format found")
-                data.append(
-                    {
-                        "name": values[0],
-                        "num_govs": int("".join(values[1].split(","))),
-                        "area": values[2],
-                        "population": int("".join(values[3].split(","))),
-                        "date": date,
-                        "due": values[5],
-                        "contact": values[6],
-                        "link": values[7],
-                        "country": Country.objects.filter(id=country_id).first(),
-                    }
-                )
-        except (AttributeError, ValueError, IndexError) as error:
-            return HttpResponse(
-                f"Error: 400\nInvalid Input Data\n{error}",
-                status=400,
-                content_type="text/plain",
-            )
-
-        for datum in data:
-            ImportDeclaration(**datum).save()
-
-        return redirect(
-            "inbox", country_id=Country.objects.filter(id=country_id).first().id
+        country = get_object_or_404(Country, pk=country_id)
+        upload = request.FILES.get("paste_file")
+        if upload:
+            rows = read_paste(upload.file)
+        else:
+            rows = read_paste(request.POST.get("paste_data", ""))
+        report = InboxImport(country).run(rows)
+        if "application/json" in request.headers.get("Accept", ""):
+            return JsonResponse(report)
+
+        report_import(
+            request, report, "Added %s declarations to the inbox" % report["created"]
         )
+        return redirect("inbox", country_id=country.id)
     return HttpResponse(status=403)
 
 
@@ -490,21 +535,54 @@ def structure_add_subtree(request, structure_id):
     return HttpResponse(status=403)
 
 
-class AreaList(generics.ListCreateAPIView):
-    queryset = Area.objects.all()
-    serializer_class = AreaSerializer
+class IdPagination(pagination.CursorPagination):
+    """Pages of items in id order, which stay fast however far through the
+    list they are, and don't skip or repeat items added while paging."""
 
+    ordering = "id"
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
 
-class AreaDetail(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Area.objects.all()
-    serializer_class = AreaSerializer
 
+class AreaQuerysetMixin:
+    """Areas with what AreaSerializer needs loaded up front: the number of
+    children as an annotation, and the supplement ids in one more query,
+    filtered by any of ?country=, ?structure= and ?parent=."""
 
-class AreaChildren(mixins.ListModelMixin, generics.GenericAPIView):
     serializer_class = AreaSerializer
+    filter_fields = ("country", "structure", "parent")
 
     def get_queryset(self):
-        return Area.objects.get(pk=self.kwargs["pk"]).children
+        queryset = Area.with_child_counts(Area.objects.all()).prefetch_related(
+            "supplements"
+        )
+        filters = {}
+        for field in self.filter_fields:
+            value = self.request.query_params.get(field)
+            if value is None:
+                continue
+            if not value.isdigit():
+                raise exceptions.ValidationError({field: "Must be an id"})
+            filters[field] = int(value)
+        return queryset.filter(**filters)
+
+
+class AreaList(AreaQuerysetMixin, generics.ListCreateAPIView):
+    pagination_class = IdPagination
+
+
+class AreaDetail(AreaQuerysetMixin, generics.RetrieveUpdateDestroyAPIView):
+    filter_fields = ()
+
+
+class AreaChildren(AreaQuerysetMixin, mixins.ListModelMixin, generics.GenericAPIView):
+    pagination_class = IdPagination
+    filter_fields = ("structure",)
+
+    def get_queryset(self):
+        area = get_object_or_404(Area, pk=self.kwargs["pk"])
+        return super().get_queryset().filter(parent=area.id).exclude(pk=area.id)
 
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
@@ -518,3 +596,20 @@ class StructureViewSet(viewsets.ModelViewSet):
 
     queryset = Structure.objects.all()
     serializer_class = StructureSerializer
+    pagination_class = IdPagination
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        country = self.request.query_params.get("country")
+        if country is not None:
+            if not country.isdigit():
+                raise exceptions.ValidationError({"country": "Must be an id"})
+            queryset = queryset.filter(country=int(country))
+        return queryset
+
+    def paginate_queryset(self, queryset):
+        # children, and the number of children of each, for the whole page
+        page = super().paginate_queryset(queryset)
+        if page is not None:
+            page = load_structure_children(page)
+        return page
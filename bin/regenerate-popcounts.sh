@@ -1,12 +1,6 @@
 #!/bin/bash
 
-URL=http://icef.localhost:8000
+# Regenerate population timelines for every country, using all available cores.
+# Any arguments are passed on, e.g. --workers 4 or --full
 
-COUNTRIES='data/countries.csv'
-
-CODES=$(tail -n 217 $COUNTRIES | cut -d',' -f 1)
-
-for C in $CODES
-do
-    echo curl $URL/api/country/$C/regenerate_timeline
-done
+python manage.py generate_timeline --all "$@"
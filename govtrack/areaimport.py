@@ -0,0 +1,159 @@
+"""Creating many areas under one parent at once, from pasted text or an
+uploaded CSV file."""
+
+from django.core.exceptions import ValidationError
+
+from .batchimport import BatchImport
+from .closure import build_closure
+
+import logging
+
+logger = logging.getLogger("cegov")
+
+
+class AreaImport(BatchImport):
+    """Areas being created under one parent, with one structure."""
+
+    def __init__(self, parent, structure):
+        super().__init__()
+        self.parent = parent
+        self.structure = structure
+        self.content_type_id = None
+        # {ancestor id: (depth, direct)} for the parent
+        self.parent_ancestors = {}
+        self.links = 0
+
+    def report(self):
+        return {**super().report(), "links": self.links}
+
+    def check_structure(self):
+        """Return a list of reasons the structure can't be used under the
+        parent, if there are any."""
+        problems = []
+        if self.structure.country_id != self.parent.country_id:
+            problems.append("structure %s is not in this country" % self.structure)
+        elif self.structure.parent_id != self.parent.structure_id:
+            problems.append(
+                "structure %s is not below the parent's structure" % self.structure
+            )
+        return problems
+
+    def build(self, line, row):
+        """Return an unsaved area and its unsaved links for a row, or None
+        if the row is blank or not valid."""
+        from .models import Area, Link
+
+        fields = [field.strip() for field in row]
+        if not any(fields):
+            return None
+        name = fields[0]
+        try:
+            population = int(fields[1].replace(",", ""))
+        except (IndexError, ValueError):
+            population = 0
+        area = Area(
+            name=name,
+            sort_name=name,
+            country_id=self.parent.country_id,
+            location=self.parent.location,
+            parent_id=self.parent.id,
+            structure_id=self.structure.id,
+            population=population,
+            depth=self.parent.depth + 1,
+        )
+        errors = {}
+        try:
+            # the related objects were checked once for the whole import
+            area.clean_fields(exclude=["country", "parent", "structure"])
+        except ValidationError as ex:
+            errors.update(ex.message_dict)
+
+        links = []
+        for url in fields[2:]:
+            if not url:
+                continue
+            link = Link(url=url, content_type_id=self.content_type_id)
+            try:
+                link.clean_fields(exclude=["content_type", "object_id"])
+                links.append(link)
+            except ValidationError as ex:
+                # the area is still created, without the link
+                errors.setdefault("links", []).extend(ex.messages)
+
+        if errors:
+            self.error(line, row, errors)
+        if set(errors) - {"links"}:
+            return None
+        return area, links
+
+    def insert(self, batch):
+        """Insert a batch of areas, then their links and closure links."""
+        from .models import Area, AreaClosure, Link
+
+        areas = Area.objects.bulk_create([area for area, _ in batch])
+        links = []
+        for area, area_links in batch:
+            for link in area_links:
+                link.object_id = area.id
+                links.append(link)
+        Link.objects.bulk_create(links)
+
+        closure = build_closure(
+            [area.id for area in areas],
+            {area.id: area.parent_id for area in areas},
+            {},
+            {self.parent.id: self.parent_ancestors},
+        )
+        AreaClosure.objects.bulk_create(
+            AreaClosure(
+                ancestor_id=ancestor_id, descendant_id=area_id, depth=d, direct=direct
+            )
+            for area_id, ancestors in closure.items()
+            for ancestor_id, (d, direct) in ancestors.items()
+        )
+        self.links += len(links)
+
+    def finish(self):
+        """Update the parent's tree fields, the country summary and the
+        recount mark once for all the new areas."""
+        from .models import Area, CountrySummary
+        from .identitymap import IdentityMap
+
+        if not self.created:
+            return
+        ancestor_ids = [
+            ancestor_id
+            for ancestor_id, (_, direct) in self.parent_ancestors.items()
+            if direct
+        ]
+        Area.update_heights(ancestor_ids)
+        CountrySummary.adjust(self.parent.country_id, "num_areas", self.created)
+        IdentityMap.forget_model(Area)
+        IdentityMap.related(self.parent, "country").popcount_update_needed()
+
+    def run(self, rows):
+        """Validate and create areas from (line number, row) pairs, and
+        return a report of how many were created and what was wrong."""
+        from .models import Area, AreaClosure
+
+        problems = self.check_structure()
+        if problems:
+            self.errors.append(
+                {"line": None, "text": "", "errors": {"__all__": problems}}
+            )
+            return self.report()
+
+        self.content_type_id = Area.content_type_id()
+        self.parent_ancestors = {
+            link.ancestor_id: (link.depth, link.direct)
+            for link in AreaClosure.objects.filter(descendant=self.parent.id)
+        }
+        super().run(rows)
+        logger.info(
+            "imported %s areas with %s links under %s, %s rows had errors",
+            self.created,
+            self.links,
+            self.parent.id,
+            len(self.errors),
+        )
+        return self.report()
@@ -0,0 +1,184 @@
+"""Moving many areas of a country at once, to new parents or structures."""
+
+from django.db import transaction
+
+from . import traversal
+
+import logging
+
+logger = logging.getLogger("cegov")
+
+
+class AreaMove:
+    """New parents and structures for a set of areas in one country."""
+
+    def __init__(self, country):
+        self.country = country
+        # {area id: new parent id}
+        self.new_parents = {}
+        # {area id: new structure id}
+        self.new_structures = {}
+        # {id: (parent_id, structure_id)}
+        self.areas = {}
+        # {id: parent_id}
+        self.structures = {}
+        self.moved = 0
+        self.restructured = 0
+        # [{"id", "detail"}]
+        self.errors = []
+
+    def error(self, item_id, detail):
+        self.errors.append({"id": item_id, "detail": detail})
+
+    def report(self):
+        return {
+            "moved": self.moved,
+            "restructured": self.restructured,
+            "errors": self.errors,
+        }
+
+    @staticmethod
+    def as_id(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    def move(self, area_ids, parent_id):
+        """Give each of the areas a new parent. Blank ids are ignored."""
+        parent_id = self.as_id(parent_id)
+        for area_id in area_ids:
+            if str(area_id).strip():
+                self.new_parents[self.as_id(area_id)] = parent_id
+
+    def restructure(self, area_id, structure_id):
+        """Give an area a new structure."""
+        self.new_structures[self.as_id(area_id)] = self.as_id(structure_id)
+
+    def load(self):
+        """Load the parent and structure of every area in the country, and the
+        parent of every structure, in two queries."""
+        from .models import Area, Structure
+
+        self.areas = {
+            item_id: (parent_id, structure_id)
+            for item_id, parent_id, structure_id in Area.objects.filter(
+                country=self.country.id
+            ).values_list("id", "parent_id", "structure_id")
+        }
+        self.structures = dict(
+            Structure.objects.filter(country=self.country.id).values_list(
+                "id", "parent_id"
+            )
+        )
+
+    def check(self):
+        """Check the changes against the country's tree as it will be after
+        they are made, recording any problems in errors."""
+        for area_id, parent_id in self.new_parents.items():
+            if area_id not in self.areas:
+                self.error(area_id, "area %s is not in this country" % area_id)
+            elif self.areas[area_id][0] == area_id:
+                self.error(area_id, "area %s is the root, and can't be moved" % area_id)
+            elif parent_id not in self.areas:
+                self.error(area_id, "new parent %s is not in this country" % parent_id)
+            elif parent_id == area_id:
+                self.error(area_id, "area %s can't be its own parent" % area_id)
+        for area_id, structure_id in self.new_structures.items():
+            if area_id not in self.areas:
+                self.error(area_id, "area %s is not in this country" % area_id)
+            elif structure_id not in self.structures:
+                self.error(
+                    area_id, "structure %s is not in this country" % structure_id
+                )
+        if self.errors:
+            return
+
+        parents = {item_id: values[0] for item_id, values in self.areas.items()}
+        parents.update(self.new_parents)
+        structures = {item_id: values[1] for item_id, values in self.areas.items()}
+        structures.update(self.new_structures)
+
+        for area_id in self.new_parents:
+            try:
+                traversal.ancestor_path(parents, area_id)
+            except traversal.CycleError:
+                self.error(
+                    area_id,
+                    "area %s would be under its own descendant %s"
+                    % (area_id, self.new_parents[area_id]),
+                )
+
+        # areas whose own structure or whose parent's structure changes
+        affected = set(self.new_parents) | set(self.new_structures)
+        if self.new_structures:
+            children = traversal.children_map(parents.items())
+            for area_id in self.new_structures:
+                affected.update(children.get(area_id, []))
+        for area_id in sorted(affected):
+            parent_id = parents[area_id]
+            if parent_id == area_id:
+                continue
+            expected = structures[parent_id]
+            if self.structures.get(structures[area_id]) != expected:
+                self.error(
+                    area_id,
+                    "structure %s of area %s would not be below structure %s "
+                    "of its parent %s"
+                    % (structures[area_id], area_id, expected, parent_id),
+                )
+
+    def apply(self):
+        """Make the changes, with one update for each new parent and each new
+        structure, then bring the tree data up to date."""
+        from .models import Area, AreaClosure
+        from .identitymap import IdentityMap
+
+        by_parent = {}
+        for area_id, parent_id in self.new_parents.items():
+            if self.areas[area_id][0] != parent_id:
+                by_parent.setdefault(parent_id, []).append(area_id)
+        by_structure = {}
+        for area_id, structure_id in self.new_structures.items():
+            if self.areas[area_id][1] != structure_id:
+                by_structure.setdefault(structure_id, []).append(area_id)
+
+        for parent_id, area_ids in by_parent.items():
+            self.moved += Area.objects.filter(id__in=area_ids).update(
+                parent_id=parent_id
+            )
+        for structure_id, area_ids in by_structure.items():
+            self.restructured += Area.objects.filter(id__in=area_ids).update(
+                structure_id=structure_id
+            )
+        if not (self.moved or self.restructured):
+            return
+
+        if self.moved:
+            AreaClosure.refresh(
+                [area_id for area_ids in by_parent.values() for area_id in area_ids]
+            )
+        Area.refresh_tree_fields(self.country)
+        IdentityMap.forget_model(Area)
+        if self.moved:
+            # what is counted under the old and new parents has changed
+            self.country.popcount_update_needed()
+
+    def run(self):
+        """Check and make the changes, and return a report of how many areas
+        were changed and what was wrong. Nothing is changed if anything is
+        wrong."""
+        with transaction.atomic():
+            self.load()
+            self.check()
+            if not self.errors:
+                self.apply()
+
+        logger.info(
+            "moved %s areas and changed the structure of %s in %s, with %s errors",
+            self.moved,
+            self.restructured,
+            self.country.country_code,
+            len(self.errors),
+        )
+        return self.report()
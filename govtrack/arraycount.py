@@ -0,0 +1,183 @@
+"""Population counting with the country tree held in flat NumPy arrays.
+
+ArrayCounter gives the same results as CountrySnapshot.declared_population,
+but works out which areas are counted for many dates at once. Each date is
+a row of a boolean matrix, and every step of the traversal is applied to a
+whole level of the tree for all dates in one array operation.
+"""
+
+from .popcount import as_date
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger("cegov")
+
+
+class ArrayCounter:
+    """Counts declared population for many dates at once.
+
+    Areas under the root are numbered in the order a breadth-first
+    traversal from the root visits them, so that every level of the tree,
+    and the children of every area, are contiguous ranges of indexes.
+    Any other areas in the snapshot are numbered after them; they are
+    never counted, but can still make areas they supplement declared
+    by proxy."""
+
+    # number of dates counted in one batch, which bounds the memory used
+    CHUNK_SIZE = 512
+
+    def __init__(self, snapshot, root_id=None):
+        self.snapshot = snapshot
+        self.root_id = root_id if root_id is not None else snapshot.root_id
+
+        # breadth-first order, and where each level starts
+        order = [self.root_id]
+        level_offsets = [0]
+        start = 0
+        while start < len(order):
+            level_offsets.append(len(order))
+            end = len(order)
+            for area_id in order[start:end]:
+                order.extend(snapshot.children.get(area_id, []))
+            start = end
+        self.size = len(order)
+        self.level_offsets = np.array(level_offsets, dtype=np.int64)
+        in_tree = set(order)
+        order.extend(a for a in snapshot.parent if a not in in_tree)
+        self.area_ids = np.array(order, dtype=np.int64)
+        self.index = {area_id: i for i, area_id in enumerate(order)}
+
+        n = self.size
+        self.parent = np.zeros(n, dtype=np.int64)
+        for i, area_id in enumerate(order[1:n], 1):
+            self.parent[i] = self.index[snapshot.parent[area_id]]
+        # CSR offsets: the children of area i are child_offsets[i]:child_offsets[i+1]
+        counts = np.bincount(self.parent[1:], minlength=n)
+        self.child_offsets = np.concatenate(([1], 1 + np.cumsum(counts)))
+        self.population = np.array(
+            [snapshot.population[a] or 0 for a in order[:n]], dtype=np.int64
+        )
+        self.is_agglom = np.array(
+            [snapshot.is_agglomeration(a) for a in order[:n]], dtype=bool
+        )
+
+        # supplement edges, from areas under the root to their supplementary parents
+        edges = sorted(
+            (i, self.index[supplement_id])
+            for i, area_id in enumerate(order[:n])
+            for supplement_id in snapshot.supplements.get(area_id, [])
+        )
+        edges = np.array(edges, dtype=np.int64).reshape(-1, 2)
+        self.supp_child = edges[:, 0]
+        self.supp_parent = edges[:, 1]
+
+        self._timeline = [
+            (as_date(event_date), self.index[area_id], status == "D")
+            for event_date, area_id, status in snapshot.timeline()
+            if area_id in self.index
+        ]
+
+    def declared_matrix(self, dates):
+        """Return a boolean matrix of which areas are declared at each date,
+        with a row per date and a column per area."""
+        dates = [as_date(d) for d in dates]
+        # the latest event for each area on or before each date,
+        # found by carrying each row's events forward to the next row
+        latest = np.zeros((len(dates) + 1, len(self.area_ids)), dtype=np.int64)
+        values = [False]
+        row = 0
+        for event_date, area, is_declared in self._timeline:
+            while row < len(dates) and dates[row] < event_date:
+                row += 1
+            if row == len(dates):
+                break
+            values.append(is_declared)
+            latest[row + 1, area] = len(values) - 1
+        np.maximum.accumulate(latest, axis=0, out=latest)
+        return np.array(values, dtype=bool)[latest[1:]]
+
+    def _reduce_edges(self, matrix, mask):
+        """For the supplement edges selected by mask, return the children
+        and whether any of each child's supplementary parents is set in matrix."""
+        children = self.supp_child[mask]
+        if not len(children):
+            return children, None
+        starts = np.flatnonzero(np.r_[True, children[1:] != children[:-1]])
+        values = np.logical_or.reduceat(
+            matrix[:, self.supp_parent[mask]], starts, axis=1
+        )
+        return children[starts], values
+
+    def counted_matrix(self, declared):
+        """Return a boolean matrix of which areas are counted, given a
+        matrix of which areas are declared."""
+        rows = declared.shape[0]
+        n = self.size
+        visited = np.zeros((rows, n), dtype=bool)
+        would_count = np.zeros((rows, n), dtype=bool)
+        aggloms = np.zeros((rows, n), dtype=bool)
+
+        # declared directly, or through a declared parent or supplementary parent
+        base = declared[:, :n].copy()
+        base[:, 1:] |= declared[:, self.parent[1:]]
+        children, supp_declared = self._reduce_edges(declared, slice(None))
+        if supp_declared is not None:
+            base[:, children] |= supp_declared
+
+        visited[:, 0] = True
+        would_count[:, 0] = declared[:, 0]
+        aggloms[:, 0] = would_count[:, 0] & self.is_agglom[0]
+        for start, end in zip(self.level_offsets[1:-1], self.level_offsets[2:]):
+            level = slice(start, end)
+            parents = self.parent[level]
+            visited[:, level] = visited[:, parents] & (
+                ~would_count[:, parents] | self.is_agglom[parents]
+            )
+            # declared agglomerations which the traversal has already reached
+            proxy = base[:, level] | aggloms[:, parents]
+            in_level = (self.supp_child >= start) & (self.supp_child < end)
+            earlier = in_level & (self.supp_parent < start)
+            same_level = in_level & (self.supp_parent >= start)
+            same_level &= self.supp_parent < self.supp_child
+            children, supp_aggloms = self._reduce_edges(aggloms, earlier)
+            if supp_aggloms is not None:
+                proxy[:, children - start] |= supp_aggloms
+
+            level_count = visited[:, level] & proxy
+            # agglomerations on the same level only affect areas after them,
+            # so repeat until no more areas are affected
+            while same_level.any():
+                would_count[:, level] = level_count
+                aggloms[:, level] = level_count & self.is_agglom[level]
+                children, supp_aggloms = self._reduce_edges(aggloms, same_level)
+                updated = level_count.copy()
+                updated[:, children - start] |= supp_aggloms & visited[:, children]
+                if np.array_equal(updated, level_count):
+                    break
+                level_count = updated
+            would_count[:, level] = level_count
+            aggloms[:, level] = level_count & self.is_agglom[level]
+
+        return would_count & ~self.is_agglom
+
+    def totals(self, dates):
+        """Return an array of the declared population at each of the given dates."""
+        dates = list(dates)
+        totals = np.zeros(len(dates), dtype=np.int64)
+        for start in range(0, len(dates), self.CHUNK_SIZE):
+            chunk = dates[start : start + self.CHUNK_SIZE]
+            counted = self.counted_matrix(self.declared_matrix(chunk))
+            totals[start : start + len(chunk)] = counted @ self.population
+        return totals
+
+    def count(self, dates):
+        """Yield (date, declared population) for each of the given dates,
+        which must be in ascending order."""
+        dates = list(dates)
+        for date, total in zip(dates, self.totals(dates)):
+            yield (date, int(total))
+
+    def declared_population(self, date):
+        return int(self.totals([date])[0])
@@ -0,0 +1,81 @@
+"""Readers for pasted and uploaded rows, and a base class for importers
+which check them one at a time and insert them in batches."""
+
+from django.db import transaction
+
+import csv
+import io
+
+
+def text_stream(source):
+    """A text stream for pasted text, or for an uploaded or opened binary
+    file, which is read as it goes rather than all at once."""
+    if isinstance(source, str):
+        return io.StringIO(source)
+    return io.TextIOWrapper(source, encoding="utf-8-sig", newline="")
+
+
+def read_paste(source):
+    """Yield (line number, row) for text pasted into a quick add form, with
+    fields separated by |."""
+    reader = csv.reader(text_stream(source), delimiter="|", quoting=csv.QUOTE_NONE)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def read_csv(source):
+    """Yield (line number, row) for a CSV file."""
+    reader = csv.reader(text_stream(source))
+    for row in reader:
+        yield reader.line_num, row
+
+
+class BatchImport:
+    """Rows turned into objects one at a time, and inserted in batches in
+    one transaction. Subclasses provide build and insert."""
+
+    # rows are inserted this many at a time
+    BATCH_SIZE = 500
+
+    def __init__(self):
+        self.created = 0
+        # [{"line", "text", "errors": {field: [messages]}}]
+        self.errors = []
+
+    def error(self, line, row, errors):
+        self.errors.append({"line": line, "text": "|".join(row), "errors": errors})
+
+    def report(self):
+        return {"created": self.created, "errors": self.errors}
+
+    def build(self, line, row):
+        """Return the unsaved object for a row, or None if the row is blank
+        or not valid, recording why with error."""
+        raise NotImplementedError
+
+    def insert(self, batch):
+        """Insert a batch of objects returned by build."""
+        raise NotImplementedError
+
+    def finish(self):
+        """Bring anything which depends on the new rows up to date, once they
+        have all been inserted."""
+
+    def run(self, rows):
+        """Import (line number, row) pairs, and return a report of how many
+        were created and what was wrong."""
+        with transaction.atomic():
+            batch = []
+            for line, row in rows:
+                built = self.build(line, row)
+                if built is not None:
+                    batch.append(built)
+                if len(batch) >= self.BATCH_SIZE:
+                    self.insert(batch)
+                    self.created += len(batch)
+                    batch = []
+            if batch:
+                self.insert(batch)
+                self.created += len(batch)
+            self.finish()
+        return self.report()
@@ -0,0 +1,121 @@
+"""Working out the ancestors of areas, for the AreaClosure table, and the
+depth and subtree height of areas and structures.
+
+An area's ancestors are reached through its parent, and through its
+supplementary parents. For each ancestor we keep the number of steps to
+it, and whether it can be reached through parent links alone.
+
+This only deals in ids, so that it can be used by migrations as well as
+by the models.
+"""
+
+from collections import deque
+import logging
+
+logger = logging.getLogger("cegov")
+
+
+def merge(ancestors, ancestor_id, depth, direct):
+    """Add a route to an ancestor, keeping the route through parent links
+    if there is one, or the shortest route otherwise."""
+    current = ancestors.get(ancestor_id)
+    if (
+        current is None
+        or (direct and not current[1])
+        or (direct == current[1] and depth < current[0])
+    ):
+        ancestors[ancestor_id] = (depth, direct)
+
+
+def build_closure(area_ids, parents, supplements, known=None):
+    """Work out the ancestors of every area in area_ids.
+
+    parents maps each area to its parent, and supplements maps areas to
+    lists of their supplementary parents. Ancestors of any parents which
+    aren't in area_ids must be given in known.
+
+    Returns a dict mapping each area to a dict of {ancestor: (depth, direct)},
+    with each area included as its own ancestor at depth 0."""
+    area_ids = set(area_ids)
+    known = known or {}
+
+    def parents_of(area_id):
+        parent_id = parents.get(area_id)
+        if parent_id is not None and parent_id != area_id:
+            yield parent_id, True
+        for supplement_id in supplements.get(area_id, []):
+            if supplement_id != area_id:
+                yield supplement_id, False
+
+    # visit areas after all of their parents
+    waiting = {area_id: 0 for area_id in area_ids}
+    children = {}
+    for area_id in area_ids:
+        for parent_id, direct in parents_of(area_id):
+            if parent_id in area_ids:
+                waiting[area_id] += 1
+                children.setdefault(parent_id, []).append(area_id)
+    queue = deque(a for a in area_ids if not waiting[a])
+    order = []
+    while queue:
+        area_id = queue.popleft()
+        order.append(area_id)
+        for child_id in children.get(area_id, []):
+            waiting[child_id] -= 1
+            if not waiting[child_id]:
+                queue.append(child_id)
+    if len(order) < len(area_ids):
+        # only possible if areas are their own ancestors
+        looped = sorted(area_ids - set(order))
+        logger.warning("areas %s are in a loop of parent links" % looped)
+        order.extend(looped)
+
+    closure = {}
+    for area_id in order:
+        ancestors = {area_id: (0, True)}
+        for parent_id, direct in parents_of(area_id):
+            parent_ancestors = closure.get(parent_id, known.get(parent_id, {}))
+            for ancestor_id, (depth, parent_direct) in parent_ancestors.items():
+                merge(ancestors, ancestor_id, depth + 1, direct and parent_direct)
+        closure[area_id] = ancestors
+    return closure
+
+
+def tree_fields(parents, levels):
+    """Work out the depth and subtree height of every item in a tree.
+
+    parents maps each item to its parent, with root items being their own
+    parent, and levels maps each item to its level.
+
+    Returns a dict mapping each item to (depth, subtree_height), where depth
+    is the number of parent links up to the root, and subtree_height is the
+    number of levels between the item and its deepest descendant."""
+    children = {}
+    order = []
+    for item_id, parent_id in parents.items():
+        if parent_id == item_id or parent_id not in parents:
+            order.append(item_id)
+        else:
+            children.setdefault(parent_id, []).append(item_id)
+
+    # parents come before their children in order
+    depth = dict.fromkeys(order, 0)
+    for item_id in order:
+        for child_id in children.get(item_id, []):
+            depth[child_id] = depth[item_id] + 1
+            order.append(child_id)
+    if len(order) < len(parents):
+        looped = sorted(set(parents) - set(depth))
+        logger.warning("items %s are in a loop of parent links" % looped)
+
+    deepest = dict(levels)
+    for item_id in reversed(order):
+        for child_id in children.get(item_id, []):
+            deepest[item_id] = max(deepest[item_id], deepest[child_id])
+    return {
+        item_id: (
+            depth.get(item_id, 0),
+            max(0, deepest[item_id] - levels[item_id]) if item_id in depth else 0,
+        )
+        for item_id in parents
+    }
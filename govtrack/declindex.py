@@ -0,0 +1,88 @@
+"""In-memory index of declaration status over time, per country, kept for
+the length of a request."""
+
+from .popcount import as_date
+
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger("cegov")
+
+_registry = threading.local()
+
+
+class DeclarationIndex:
+    """Declarations for one country, grouped by area and sorted by date."""
+
+    def __init__(self, country_id):
+        self.country_id = country_id
+        # declarations for each area, oldest first
+        self.transitions = {}
+        self._dates = {}
+
+    @classmethod
+    def load(cls, country_id):
+        """Build an index for a country in one query."""
+        from .models import Declaration
+
+        index = cls(country_id)
+        declarations = (
+            Declaration.objects.filter(area__country=country_id)
+            .select_related("area")
+            .order_by("event_date", "id")
+        )
+        for dec in declarations:
+            index.transitions.setdefault(dec.area_id, []).append(dec)
+            index._dates.setdefault(dec.area_id, []).append(dec.event_date)
+        return index
+
+    @classmethod
+    def for_country(cls, country_id):
+        """Return the index for a country, loading it if necessary."""
+        indexes = getattr(_registry, "indexes", None)
+        if indexes is None:
+            indexes = _registry.indexes = {}
+        if country_id not in indexes:
+            indexes[country_id] = cls.load(country_id)
+        return indexes[country_id]
+
+    @classmethod
+    def clear(cls):
+        """Discard all loaded indexes."""
+        _registry.indexes = {}
+
+    def latest(self, area_id, date=None):
+        """Return the latest declaration for an area on or before the given
+        date, or the latest of all if no date is given."""
+        decs = self.transitions.get(area_id)
+        if not decs:
+            return None
+        if date is None:
+            return decs[-1]
+        idx = bisect.bisect_right(self._dates[area_id], as_date(date))
+        if idx == 0:
+            return None
+        return decs[idx - 1]
+
+    def status_at(self, area_id, date=None):
+        dec = self.latest(area_id, date)
+        if dec:
+            return dec.status
+        return None
+
+    def is_declared_at(self, area_id, date=None):
+        return self.status_at(area_id, date) == "D"
+
+    def is_active_at(self, declaration, date):
+        """Return true if no declaration for the same area after this one,
+        and before the given date, has a status other than declared."""
+        decs = self.transitions.get(declaration.area_id, [])
+        dates = self._dates.get(declaration.area_id, [])
+        date = as_date(date)
+        start = bisect.bisect_right(dates, as_date(declaration.event_date))
+        end = bisect.bisect_left(dates, date)
+        for sib in decs[start:end]:
+            if sib.status != "D" and sib.pk != declaration.pk:
+                return False
+        return True
@@ -0,0 +1,108 @@
+"""Request-scoped identity map of model instances, so that related objects
+are fetched at most once per request."""
+
+from .declindex import DeclarationIndex
+
+import contextlib
+import threading
+
+_registry = threading.local()
+
+
+class IdentityMap:
+    """One instance per row, for the models which are looked up most often."""
+
+    @staticmethod
+    def _instances():
+        instances = getattr(_registry, "instances", None)
+        if instances is None:
+            instances = _registry.instances = {}
+        return instances
+
+    @staticmethod
+    def _key(model, pk):
+        return (model._meta.concrete_model, pk)
+
+    @classmethod
+    def get(cls, model, pk):
+        """Return the instance of model with the given primary key,
+        fetching it if it hasn't been seen yet."""
+        instances = cls._instances()
+        key = cls._key(model, pk)
+        if key not in instances:
+            instances[key] = model.objects.get(pk=pk)
+        return instances[key]
+
+    @classmethod
+    def get_many(cls, model, pks):
+        """Return a dict of the instances of model with the given primary
+        keys, fetching any which haven't been seen yet in one query."""
+        instances = cls._instances()
+        missing = [pk for pk in set(pks) if cls._key(model, pk) not in instances]
+        if missing:
+            for obj in model.objects.filter(pk__in=missing):
+                instances[cls._key(model, obj.pk)] = obj
+        return {
+            pk: instances[cls._key(model, pk)]
+            for pk in pks
+            if cls._key(model, pk) in instances
+        }
+
+    @classmethod
+    def add(cls, instance):
+        """Add an instance which has already been fetched, unless there is
+        one for the same row already, and return the one in the map."""
+        return cls._instances().setdefault(cls._key(instance, instance.pk), instance)
+
+    @classmethod
+    def related(cls, instance, name):
+        """Return the object that the foreign key called name on instance
+        refers to, from the map. It is cached on the instance too, so that
+        later access through the field itself costs nothing."""
+        field = instance._meta.get_field(name)
+        if field.is_cached(instance):
+            return getattr(instance, name)
+        pk = getattr(instance, field.attname)
+        if pk is None:
+            return None
+        obj = cls.get(field.related_model, pk)
+        field.set_cached_value(instance, obj)
+        return obj
+
+    @classmethod
+    def forget(cls, instance):
+        """Drop an instance from the map."""
+        cls._instances().pop(cls._key(instance, instance.pk), None)
+
+    @classmethod
+    def forget_model(cls, model):
+        """Drop every instance of a model, after rows have been updated in bulk."""
+        model = model._meta.concrete_model
+        instances = cls._instances()
+        for key in [key for key in instances if key[0] is model]:
+            del instances[key]
+
+    @classmethod
+    def clear(cls):
+        """Drop everything."""
+        _registry.instances = {}
+
+
+def clear_request_caches():
+    """Discard the identity map and declaration indexes for this thread."""
+    IdentityMap.clear()
+    DeclarationIndex.clear()
+
+
+@contextlib.contextmanager
+def task_scope():
+    """Run a background task with empty request caches, and discard
+    whatever it cached when it finishes."""
+    from .invalidation import PendingRecounts
+
+    clear_request_caches()
+    PendingRecounts.clear()
+    try:
+        yield
+    finally:
+        clear_request_caches()
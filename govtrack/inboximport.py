@@ -0,0 +1,144 @@
+"""Loading declarations pasted or uploaded into a country's inbox."""
+
+from django.core.exceptions import ValidationError
+
+from .batchimport import BatchImport
+
+import datetime
+import logging
+import re
+
+logger = logging.getLogger("cegov")
+
+# the fields of each row, in order
+FIELDS = ("name", "num_govs", "area", "population", "date", "due", "contact", "link")
+
+# strptime directives used in date formats, and what each matches
+DIRECTIVES = {
+    "%d": r"\d{1,2}",
+    "%m": r"\d{1,2}",
+    "%Y": r"\d{4}",
+    "%b": r"[A-Za-z]{3}",
+    "%B": r"[A-Za-z]+",
+}
+
+
+class DateDetector:
+    """Parses dates in any of a list of formats, remembering the last one
+    which worked."""
+
+    FORMATS = (
+        "%d %b, %Y",
+        "%d %b %Y",
+        "%d %B %Y",
+        "%Y-%m-%d",
+        "%d %B, %Y",
+        "%d-%m-%Y",
+    )
+
+    def __init__(self, formats=FORMATS):
+        self.formats = [(fmt, self.compile(fmt)) for fmt in formats]
+        self.last = None
+
+    @staticmethod
+    def compile(fmt):
+        """Return a pattern matching strings that could be in the given format,
+        so that strptime is only tried when it has a chance of working."""
+        parts = re.split("(%[a-zA-Z])", fmt)
+        return re.compile(
+            "".join(DIRECTIVES.get(part) or re.escape(part) for part in parts)
+        )
+
+    def parse(self, value):
+        """Return the date in value, or raise ValueError."""
+        value = value.strip()
+        candidates = self.formats
+        if self.last:
+            candidates = [self.last, *self.formats]
+        for fmt, pattern in candidates:
+            if not pattern.fullmatch(value):
+                continue
+            try:
+                date = datetime.datetime.strptime(value, fmt).date()
+            except ValueError:
+                continue
+            self.last = (fmt, pattern)
+            return date
+        raise ValueError("no valid date format found for '%s'" % value)
+
+
+def parse_number(value):
+    """Return a count written with or without thousands separators."""
+    number = int(value.replace(",", ""))
+    if number < 0:
+        raise ValueError("'%s' is negative" % value)
+    return number
+
+
+class InboxImport(BatchImport):
+    """Declarations being added to one country's inbox."""
+
+    def __init__(self, country):
+        super().__init__()
+        self.country = country
+        self.dates = DateDetector()
+
+    def build(self, line, row):
+        """Return an unsaved inbox declaration for a row, or None if the row
+        is blank or not valid."""
+        from .models import ImportDeclaration
+
+        fields = [field.strip() for field in row]
+        if not any(fields):
+            return None
+        if len(fields) < len(FIELDS):
+            self.error(
+                line,
+                row,
+                {
+                    "__all__": [
+                        "expected %s fields, found %s" % (len(FIELDS), len(fields))
+                    ]
+                },
+            )
+            return None
+
+        values = dict(zip(FIELDS, fields))
+        errors = {}
+        for name, parse in (
+            ("num_govs", parse_number),
+            ("population", parse_number),
+            ("date", self.dates.parse),
+        ):
+            try:
+                values[name] = parse(values[name])
+            except ValueError as ex:
+                errors[name] = [str(ex)]
+        if errors:
+            self.error(line, row, errors)
+            return None
+
+        declaration = ImportDeclaration(country_id=self.country.id, **values)
+        try:
+            declaration.clean_fields(exclude=["country"])
+        except ValidationError as ex:
+            self.error(line, row, ex.message_dict)
+            return None
+        return declaration
+
+    def insert(self, batch):
+        from .models import ImportDeclaration
+
+        ImportDeclaration.objects.bulk_create(batch)
+
+    def finish(self):
+        from .models import CountrySummary
+
+        if self.created:
+            CountrySummary.adjust(self.country.id, "inbox_count", self.created)
+        logger.info(
+            "added %s declarations to the inbox for %s, %s rows had errors",
+            self.created,
+            self.country.country_code,
+            len(self.errors),
+        )
@@ -0,0 +1,195 @@
+"""Checking the area and structure trees of countries for corruption, with
+a report which can be returned as JSON."""
+
+from . import traversal
+
+import logging
+
+logger = logging.getLogger("cegov")
+
+
+class TreeCheck:
+    """The structure and area trees of one country, as plain ids."""
+
+    def __init__(self, country):
+        self.country = country
+        # {id: (parent_id, level)}
+        self.structures = {}
+        # {id: (parent_id, structure_id)}
+        self.areas = {}
+        # {area_id: [supplementary parent ids]}
+        self.supplements = {}
+        self.problems = []
+
+    @classmethod
+    def load_many(cls, countries):
+        """Load the trees for the given countries in three queries, and
+        return a list of TreeChecks in the same order."""
+        from .models import Area, Structure
+
+        checks = {country.id: cls(country) for country in countries}
+        for item_id, country_id, parent_id, level in Structure.objects.filter(
+            country__in=checks
+        ).values_list("id", "country_id", "parent_id", "level"):
+            checks[country_id].structures[item_id] = (parent_id, level)
+        for item_id, country_id, parent_id, structure_id in Area.objects.filter(
+            country__in=checks
+        ).values_list("id", "country_id", "parent_id", "structure_id"):
+            checks[country_id].areas[item_id] = (parent_id, structure_id)
+        supplements = Area.supplements.through.objects.filter(
+            from_area__country__in=checks
+        ).values_list("from_area_id", "from_area__country_id", "to_area_id")
+        for area_id, country_id, supplement_id in supplements:
+            checks[country_id].supplements.setdefault(area_id, []).append(supplement_id)
+        return list(checks.values())
+
+    @classmethod
+    def load(cls, country):
+        return cls.load_many([country])[0]
+
+    def problem(self, check, model, item_id, detail):
+        """Record a problem found by one of the checks:
+        root: a country without exactly one root structure or root area
+        self_parent: an item other than the root which is its own parent
+        orphan: an item whose parent is missing, or isn't under the root
+        cycle: items in a loop of parent links, or of parent and
+            supplementary parent links
+        level: an item which isn't one level below its parent
+        structure: an area whose structure isn't in the same country
+        structure_parent: an area whose structure's parent isn't the
+            structure of its parent area
+        """
+        self.problems.append(
+            {"check": check, "model": model, "id": item_id, "detail": detail}
+        )
+
+    def run(self):
+        """Check both trees, and return the report."""
+        self.problems = []
+        self.check_tree("structure", self.structure_levels(), self.parents("structure"))
+        self.check_tree(
+            "area",
+            self.area_levels(),
+            self.parents("area"),
+            self.supplements,
+        )
+        self.check_area_structures()
+        return self.report()
+
+    def report(self):
+        return {
+            "country": self.country.country_code,
+            "ok": not self.problems,
+            "structures": len(self.structures),
+            "areas": len(self.areas),
+            "problems": self.problems,
+        }
+
+    def parents(self, model):
+        items = self.structures if model == "structure" else self.areas
+        return {item_id: values[0] for item_id, values in items.items()}
+
+    def structure_levels(self):
+        return {item_id: level for item_id, (_, level) in self.structures.items()}
+
+    def area_levels(self):
+        """The level of each area's structure, or None if it has no
+        structure in this country."""
+        return {
+            item_id: self.structures.get(structure_id, (None, None))[1]
+            for item_id, (_, structure_id) in self.areas.items()
+        }
+
+    def check_tree(self, model, levels, parents, supplements=None):
+        roots = [item_id for item_id, level in levels.items() if level == 1]
+        if parents and len(roots) != 1:
+            self.problem("root", model, None, "found %s root %ss" % (len(roots), model))
+
+        for item_id, parent_id in parents.items():
+            if parent_id == item_id and item_id not in roots:
+                self.problem(
+                    "self_parent",
+                    model,
+                    item_id,
+                    "%s %s is its own parent" % (model, item_id),
+                )
+            elif parent_id not in parents:
+                self.problem(
+                    "orphan",
+                    model,
+                    item_id,
+                    "parent %s is not in this country" % parent_id,
+                )
+            elif item_id not in roots and None not in (
+                levels[item_id],
+                levels[parent_id],
+            ):
+                if levels[item_id] != levels[parent_id] + 1:
+                    self.problem(
+                        "level",
+                        model,
+                        item_id,
+                        "level %s is not one below parent %s at level %s"
+                        % (levels[item_id], parent_id, levels[parent_id]),
+                    )
+
+        # loops of parent links, and loops through supplementary links
+        successors = {
+            item_id: [parent_id, *(supplements or {}).get(item_id, [])]
+            for item_id, parent_id in parents.items()
+        }
+        in_cycle = set()
+        for cycle in traversal.find_cycles(successors):
+            in_cycle.update(cycle)
+            self.problem(
+                "cycle",
+                model,
+                cycle[0],
+                "%ss %s are in a loop" % (model, ", ".join(str(c) for c in cycle)),
+            )
+
+        # anything else which can't be reached from a root
+        children = traversal.children_map(parents.items())
+        reached = set()
+        for root in roots:
+            reached.update(traversal.bfs(children, root))
+        for item_id, parent_id in parents.items():
+            if (
+                item_id not in reached
+                and item_id not in in_cycle
+                and parent_id in parents
+                and parent_id != item_id
+            ):
+                self.problem(
+                    "orphan",
+                    model,
+                    item_id,
+                    "%s %s is not under a root %s" % (model, item_id, model),
+                )
+
+    def check_area_structures(self):
+        for item_id, (parent_id, structure_id) in self.areas.items():
+            if structure_id not in self.structures:
+                self.problem(
+                    "structure",
+                    "area",
+                    item_id,
+                    "structure %s is not in this country" % structure_id,
+                )
+                continue
+            if parent_id == item_id or parent_id not in self.areas:
+                continue
+            parent_structure_id = self.areas[parent_id][1]
+            if self.structures[structure_id][0] != parent_structure_id:
+                self.problem(
+                    "structure_parent",
+                    "area",
+                    item_id,
+                    "structure %s is not a child of parent's structure %s"
+                    % (structure_id, parent_structure_id),
+                )
+
+
+def check_countries(countries):
+    """Check the trees of the given countries, and return a list of reports."""
+    return [check.run() for check in TreeCheck.load_many(countries)]
@@ -0,0 +1,118 @@
+"""Deferred marking of countries as needing a population recount, written
+once per country when the current transaction commits."""
+
+from django.db import models, transaction
+from django.db.models import Case, F, Value, When
+
+import functools
+import logging
+import threading
+
+logger = logging.getLogger("cegov")
+
+_registry = threading.local()
+
+# recount from the earliest declaration, when no date is known
+FROM_START = None
+
+
+class PendingRecounts:
+    """The countries waiting to be marked as needing a recount, with the date
+    each needs recounting from.
+
+    Marks are kept separately for each savepoint, and written by an on_commit
+    callback registered when the first one is made in it. Rolling back a
+    savepoint or transaction drops its callback, and so its marks."""
+
+    @staticmethod
+    def _pending():
+        # {savepoint ids: (callback, {country id: since})}
+        pending = getattr(_registry, "pending", None)
+        if pending is None:
+            pending = _registry.pending = {}
+        return pending
+
+    @staticmethod
+    def _waiting(connection, callback):
+        """Whether a callback is still registered to run when the transaction
+        commits, rather than dropped by a rollback."""
+        return any(func is callback for _, func, _ in connection.run_on_commit)
+
+    @classmethod
+    def mark(cls, country_id, since=FROM_START):
+        """Record that a country's counts from the given date onwards, or all
+        of them, need recounting, and write it when the transaction commits."""
+        from .popcount import as_date
+
+        since = as_date(since)
+        connection = transaction.get_connection()
+        if not connection.in_atomic_block:
+            cls.write({country_id: since})
+            return
+
+        pending = cls._pending()
+        key = tuple(connection.savepoint_ids)
+        callback, marks = pending.get(key, (None, None))
+        # savepoint ids are reused by later transactions, so marks left from
+        # one which was rolled back are replaced rather than added to
+        if callback is None or not cls._waiting(connection, callback):
+            marks = {}
+            callback = functools.partial(cls.flush, key, marks)
+            pending[key] = (callback, marks)
+            transaction.on_commit(callback)
+        if country_id in marks:
+            current = marks[country_id]
+            if current is FROM_START or since is FROM_START:
+                since = FROM_START
+            else:
+                since = min(current, since)
+        marks[country_id] = since
+
+    @classmethod
+    def flush(cls, key, marks):
+        """Write the marks made in one savepoint, once it has committed."""
+        pending = cls._pending()
+        if key in pending and pending[key][1] is marks:
+            del pending[key]
+        written = dict(marks)
+        marks.clear()
+        cls.write(written)
+
+    @classmethod
+    def write(cls, marks):
+        """Discard the checkpoints made stale by marks, and update each
+        country's recount status and date in one query."""
+        from .identitymap import IdentityMap
+        from .models import Country, PopCountCheckpoint
+
+        if not marks:
+            return
+        for country_id, since in marks.items():
+            checkpoints = PopCountCheckpoint.objects.filter(country=country_id)
+            if since is not FROM_START:
+                checkpoints = checkpoints.filter(date__gte=since)
+            checkpoints.delete()
+            Country.objects.filter(pk=country_id).update(
+                popcount_ready=0, popcount_since=cls.since_expression(since)
+            )
+        IdentityMap.forget_model(Country)
+        logger.debug("marked %s countries as needing a recount", len(marks))
+
+    @staticmethod
+    def since_expression(since):
+        """The new date to recount a country from, given the date it now
+        needs recounting from. A country already waiting for a full recount,
+        with no date, keeps waiting for one."""
+        if since is FROM_START:
+            return Value(None, output_field=models.DateField())
+        return Case(
+            When(popcount_ready=0, popcount_since__isnull=True, then=Value(None)),
+            When(popcount_since__lte=since, then=F("popcount_since")),
+            default=Value(since),
+            output_field=models.DateField(),
+        )
+
+    @classmethod
+    def clear(cls):
+        """Drop any pending marks."""
+        _registry.pending = {}
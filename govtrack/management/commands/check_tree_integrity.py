@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand, CommandError
+from govtrack.integrity import check_countries
+from govtrack.management.countries import countries_for_codes
+from govtrack.management.workers import run_in_workers
+from govtrack.models import Country
+
+import json
+import os
+
+
+def check_country_codes(codes):
+    """Check the trees of the countries with the given codes,
+    returning a list of reports."""
+    return check_countries(Country.objects.filter(country_code__in=codes))
+
+
+class Command(BaseCommand):
+    help = (
+        "Checks the area and structure trees of the specified countries, "
+        "or of all countries if none are given, and writes a JSON report"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("country_code", nargs="*", type=str)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Number of processes to check countries in (default: number of CPUs)",
+        )
+        parser.add_argument(
+            "--problems-only",
+            action="store_true",
+            help="Only report countries with problems",
+        )
+
+    def handle(self, *args, **options):
+        countries = countries_for_codes(options["country_code"])
+        codes = list(countries.values_list("country_code", flat=True))
+
+        workers = max(1, min(options["workers"] or 1, len(codes)))
+        reports = sorted(
+            self.check_in_workers(codes, workers), key=lambda r: r["country"]
+        )
+        failed = [r["country"] for r in reports if not r["ok"]]
+        if options["problems_only"]:
+            reports = [r for r in reports if not r["ok"]]
+        self.stdout.write(
+            json.dumps({"ok": not failed, "countries": reports}, indent=2)
+        )
+        if failed:
+            raise CommandError("Tree problems found in: %s" % ", ".join(failed))
+
+    def check_in_workers(self, codes, workers):
+        """Return the reports for all the countries, checking a share of
+        them in each worker."""
+        if workers == 1:
+            return check_country_codes(codes)
+
+        shares = [(codes[i::workers],) for i in range(workers)]
+        return [
+            report
+            for reports in run_in_workers(check_country_codes, shares, workers)
+            for report in reports
+        ]
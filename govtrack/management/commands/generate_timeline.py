@@ -1,26 +1,112 @@
 from django.core.management.base import BaseCommand, CommandError
-from govtrack.models import Country
+from govtrack.identitymap import task_scope
+from govtrack.management.workers import run_in_workers
+from govtrack.models import Country, POPCOUNT_ENGINES
+
+import os
+import time
+import traceback
+
+
+def recount_country(country_code, full=False, engine=None):
+    """Regenerate the population timeline for one country.
+    Returns (country_code, seconds taken, error message or None)."""
+    start = time.monotonic()
+    country = None
+    since = None
+    try:
+        with task_scope():
+            country = Country.find_by_code(country_code)
+            since = None if full else country.popcount_since
+            country.popcount_update_running()
+            country.generate_population_count(since, engine)
+        error = None
+    except Country.DoesNotExist:
+        error = "country does not exist"
+    except Exception:
+        error = traceback.format_exc()
+        if country is not None:
+            # mark it as needing a recount again, rather than leaving it
+            # marked as running, so that the next run picks it up
+            try:
+                country.popcount_update_needed(since)
+            except Exception:
+                error += traceback.format_exc()
+    return (country_code, time.monotonic() - start, error)
 
 
 class Command(BaseCommand):
-    help = "Generates a population timeline for specified country"
+    help = (
+        "Generates population timelines for the specified countries, "
+        "or for all countries needing a recount if none are given"
+    )
 
-    #    def add_arguments(self, parser):
-    #        parser.add_argument('country_code', nargs='+', type=str)
+    def add_arguments(self, parser):
+        parser.add_argument("country_code", nargs="*", type=str)
+        parser.add_argument("--all", action="store_true", help="Recount every country")
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Recount from the beginning rather than from the earliest change",
+        )
+        parser.add_argument(
+            "--engine",
+            choices=POPCOUNT_ENGINES,
+            help="Counting engine to use (default: POPCOUNT_ENGINE, or sweep)",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Number of countries to recount at once (default: number of CPUs)",
+        )
 
     def handle(self, *args, **options):
-        self.stdout.write(
-            self.style.SUCCESS("About to generate population count for some country")
-        )
-        try:
-            country_code = options.get("country_code", "VUT")
-            country = Country.find_by_code(country_code)
-            country.generate_population_count()
-        except Country.DoesNotExist:
-            raise CommandError('Country "%s" does not exist' % country_code)
+        codes = options["country_code"]
+        if not codes:
+            countries = Country.objects.order_by("country_code")
+            if not options["all"]:
+                countries = countries.filter(popcount_ready=0)
+            codes = list(countries.values_list("country_code", flat=True))
+        if not codes:
+            self.stdout.write("No countries need a population recount")
+            return
 
+        workers = max(1, min(options["workers"] or 1, len(codes)))
         self.stdout.write(
             self.style.SUCCESS(
-                'Generated population count for country "%s"' % country_code
+                "About to generate population count for %s countries using %s workers"
+                % (len(codes), workers)
             )
         )
+
+        start = time.monotonic()
+        failed = []
+        results = self.recount(codes, workers, options["full"], options["engine"])
+        for country_code, seconds, error in results:
+            if error:
+                failed.append(country_code)
+                self.stderr.write(
+                    "%s: failed after %.2fs\n%s" % (country_code, seconds, error)
+                )
+            else:
+                self.stdout.write("%s: done in %.2fs" % (country_code, seconds))
+
+        self.stdout.write(
+            "Recounted %s of %s countries in %.2fs"
+            % (len(codes) - len(failed), len(codes), time.monotonic() - start)
+        )
+        if failed:
+            raise CommandError(
+                "Population count failed for: %s" % ", ".join(sorted(failed))
+            )
+
+    def recount(self, codes, workers, full, engine):
+        """Yield the result of recounting each country, as it finishes."""
+        if workers == 1:
+            for country_code in codes:
+                yield recount_country(country_code, full, engine)
+            return
+
+        calls = [(country_code, full, engine) for country_code in codes]
+        yield from run_in_workers(recount_country, calls, workers)
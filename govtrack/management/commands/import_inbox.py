@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+from govtrack.batchimport import read_paste
+from govtrack.inboximport import InboxImport
+from govtrack.models import Country
+
+import json
+import sys
+
+
+class Command(BaseCommand):
+    help = (
+        "Adds declarations to a country's inbox from a file with one per line, "
+        "in the format pasted into the inbox page, and writes a JSON report "
+        "of any lines which were rejected"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("country_code", type=str)
+        parser.add_argument(
+            "file", type=str, help="File to read, or - to read standard input"
+        )
+
+    def handle(self, *args, **options):
+        country = Country.objects.filter(country_code=options["country_code"]).first()
+        if not country:
+            raise CommandError('Country "%s" does not exist' % options["country_code"])
+
+        if options["file"] == "-":
+            report = InboxImport(country).run(read_paste(sys.stdin.buffer))
+        else:
+            try:
+                with open(options["file"], "rb") as source:
+                    report = InboxImport(country).run(read_paste(source))
+            except OSError as ex:
+                raise CommandError(ex)
+
+        if report["errors"]:
+            self.stdout.write(json.dumps(report["errors"], indent=2))
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Added %s declarations to the inbox for %s, rejected %s lines"
+                % (report["created"], country.country_code, len(report["errors"]))
+            )
+        )
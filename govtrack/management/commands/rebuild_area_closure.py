@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from govtrack.management.countries import countries_for_codes
+from govtrack.models import AreaClosure
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the table of area ancestors for the specified countries, "
+        "or for all countries if none are given"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("country_code", nargs="*", type=str)
+
+    def handle(self, *args, **options):
+        countries = countries_for_codes(options["country_code"])
+        for country in countries:
+            AreaClosure.rebuild(country)
+            self.stdout.write("%s: rebuilt" % country.country_code)
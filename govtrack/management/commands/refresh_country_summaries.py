@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from govtrack.management.countries import countries_for_codes
+from govtrack.models import CountrySummary
+
+
+class Command(BaseCommand):
+    help = (
+        "Recounts the summary figures shown on the countries page. Run daily, "
+        "so that declarations dated in the future are counted once they start"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("country_code", nargs="*", type=str)
+
+    def handle(self, *args, **options):
+        countries = countries_for_codes(options["country_code"])
+        summaries = CountrySummary.refresh(countries)
+        self.stdout.write(
+            self.style.SUCCESS("Refreshed summaries for %s countries" % len(summaries))
+        )
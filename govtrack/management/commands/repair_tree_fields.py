@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from govtrack.management.countries import countries_for_codes
+from govtrack.models import Area, Structure
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes the depth and subtree height of structures and areas "
+        "for the specified countries, or for all countries if none are given"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("country_code", nargs="*", type=str)
+
+    def handle(self, *args, **options):
+        countries = countries_for_codes(options["country_code"])
+        for country in countries:
+            structures = Structure.refresh_tree_fields(country)
+            areas = Area.refresh_tree_fields(country)
+            self.stdout.write(
+                "%s: repaired %s structures and %s areas"
+                % (country.country_code, len(structures), len(areas))
+            )
@@ -0,0 +1,16 @@
+from django.core.management.base import CommandError
+from govtrack.models import Country
+
+
+def countries_for_codes(codes):
+    """Return the countries with the given codes, or every country if no
+    codes are given, in code order."""
+    countries = Country.objects.order_by("country_code")
+    if codes:
+        countries = countries.filter(country_code__in=codes)
+        missing = set(codes) - set(c.country_code for c in countries)
+        if missing:
+            raise CommandError(
+                'Country "%s" does not exist' % ", ".join(sorted(missing))
+            )
+    return countries
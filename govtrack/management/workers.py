@@ -0,0 +1,17 @@
+from django.db import connections
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+
+
+def run_in_workers(func, calls, workers):
+    """Call func with each tuple of arguments in calls, in a pool of forked
+    processes, and yield the results in the order they finish."""
+    # Workers are forked, so close our connections first to make sure
+    # each worker opens its own rather than sharing the parent's socket
+    connections.close_all()
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = [pool.submit(func, *args) for args in calls]
+        for future in as_completed(futures):
+            yield future.result()
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("govtrack", "0025_country_current_popcount"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PopCountCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                ("population", models.PositiveIntegerField()),
+                ("state", models.TextField()),
+                (
+                    "country",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="govtrack.country",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:30
+
+from django.db import migrations, models
+from django.db.models import Count, Exists, OuterRef, Q
+import django.db.models.deletion
+import datetime
+
+
+def create_summaries(apps, schema_editor):
+    Country = apps.get_model("govtrack", "Country")
+    CountrySummary = apps.get_model("govtrack", "CountrySummary")
+    Declaration = apps.get_model("govtrack", "Declaration")
+
+    def count_by_country(model_name, field="country"):
+        rows = (
+            apps.get_model("govtrack", model_name)
+            .objects.values(field)
+            .annotate(num=Count("id"))
+            .order_by()
+        )
+        return {row[field]: row["num"] for row in rows}
+
+    # same as Declaration.active_at
+    today = datetime.date.today()
+    since = Declaration.objects.filter(area=OuterRef("area"), event_date__lt=today)
+    revoked = since.filter(event_date__gt=OuterRef("event_date")).exclude(status="D")
+    redeclared = since.filter(status="D").filter(
+        Q(event_date__gt=OuterRef("event_date"))
+        | Q(event_date=OuterRef("event_date"), id__gt=OuterRef("id"))
+    )
+    active = Declaration.objects.filter(
+        ~Exists(revoked), ~Exists(redeclared), status="D", event_date__lt=today
+    )
+    rows = active.values("area__country").annotate(num=Count("id")).order_by()
+    declarations = {row["area__country"]: row["num"] for row in rows}
+
+    structures = count_by_country("Structure")
+    areas = count_by_country("Area")
+    inbox = count_by_country("ImportDeclaration")
+    CountrySummary.objects.bulk_create(
+        CountrySummary(
+            country=c,
+            num_structures=structures.get(c.id, 0),
+            num_areas=areas.get(c.id, 0),
+            num_declarations=declarations.get(c.id, 0),
+            inbox_count=inbox.get(c.id, 0),
+            current_popcount=c.current_popcount,
+        )
+        for c in Country.objects.all()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("govtrack", "0026_popcountcheckpoint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CountrySummary",
+            fields=[
+                (
+                    "country",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="summary",
+                        serialize=False,
+                        to="govtrack.country",
+                    ),
+                ),
+                ("num_structures", models.PositiveIntegerField(default=0)),
+                ("num_areas", models.PositiveIntegerField(default=0)),
+                ("num_declarations", models.PositiveIntegerField(default=0)),
+                ("inbox_count", models.PositiveIntegerField(default=0)),
+                ("current_popcount", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_summaries, migrations.RunPython.noop),
+    ]
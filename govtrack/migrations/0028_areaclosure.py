@@ -0,0 +1,77 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from govtrack.closure import build_closure
+
+
+def build_area_closure(apps, schema_editor):
+    Area = apps.get_model("govtrack", "Area")
+    AreaClosure = apps.get_model("govtrack", "AreaClosure")
+    parents = dict(Area.objects.values_list("id", "parent_id"))
+    supplements = {}
+    for area_id, supplement_id in Area.supplements.through.objects.values_list(
+        "from_area_id", "to_area_id"
+    ):
+        supplements.setdefault(area_id, []).append(supplement_id)
+    closure = build_closure(parents.keys(), parents, supplements)
+    AreaClosure.objects.bulk_create(
+        (
+            AreaClosure(
+                ancestor_id=ancestor_id,
+                descendant_id=area_id,
+                depth=depth,
+                direct=direct,
+            )
+            for area_id, ancestors in closure.items()
+            for ancestor_id, (depth, direct) in ancestors.items()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("govtrack", "0027_countrysummary"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AreaClosure",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("depth", models.PositiveSmallIntegerField()),
+                ("direct", models.BooleanField()),
+                (
+                    "ancestor",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="descendant_links",
+                        to="govtrack.area",
+                    ),
+                ),
+                (
+                    "descendant",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="ancestor_links",
+                        to="govtrack.area",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("ancestor", "descendant")},
+            },
+        ),
+        migrations.RunPython(build_area_closure, migrations.RunPython.noop),
+    ]
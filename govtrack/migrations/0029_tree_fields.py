@@ -0,0 +1,59 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:37
+
+from django.db import migrations, models
+
+from govtrack.closure import tree_fields
+
+
+def set_tree_fields(apps, schema_editor):
+    for model_name, level_field in [
+        ("Structure", "level"),
+        ("Area", "structure__level"),
+    ]:
+        model = apps.get_model("govtrack", model_name)
+        parents = {}
+        levels = {}
+        for item_id, parent_id, level in model.objects.values_list(
+            "id", "parent_id", level_field
+        ):
+            parents[item_id] = parent_id
+            levels[item_id] = level
+        model.objects.bulk_update(
+            [
+                model(id=item_id, depth=depth, subtree_height=height)
+                for item_id, (depth, height) in tree_fields(parents, levels).items()
+            ],
+            ["depth", "subtree_height"],
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("govtrack", "0028_areaclosure"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="area",
+            name="depth",
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="area",
+            name="subtree_height",
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="structure",
+            name="depth",
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="structure",
+            name="subtree_height",
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(set_tree_fields, migrations.RunPython.noop),
+    ]
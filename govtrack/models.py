@@ -1,13 +1,23 @@
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import Count, Exists, F, Max, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 import django.urls
 
+from .closure import build_closure, tree_fields
+from .declindex import DeclarationIndex
+from .identitymap import IdentityMap, clear_request_caches
+from .integrity import TreeCheck
+from .invalidation import PendingRecounts
+from .popcount import CountrySnapshot, SweepCounter, as_date, contribution
+from . import traversal
+
 import boto3
 import json
 import datetime
+import functools
 import logging
 import os
 
@@ -15,56 +25,115 @@ logger = logging.getLogger("cegov")
 poplog = logging.getLogger("popcount")
 
 DATE_FORMAT = "%Y-%m-%d"
+
+# engines which can be used for counting population timelines
+POPCOUNT_ENGINES = ("sweep", "array")
+
 # Create your models here.
 
 
 class Hierarchy:
     """Mix-in class to provide tree-related methods."""
 
+    # fields which are updated by queries as the tree changes,
+    # rather than when each item is saved
+    TREE_FIELDS = ("depth", "subtree_height")
+
+    def saved_fields(self):
+        """Return the names of the fields to save on an existing item. The
+        tree fields are left out, as they may have changed since the item
+        was loaded."""
+        return [
+            f.name
+            for f in self._meta.concrete_fields
+            if not f.primary_key and f.name not in self.TREE_FIELDS
+        ]
+
+    @classmethod
+    def refresh_tree_fields(cls, country):
+        """Recompute the tree fields of every item in a country, and return
+        a dict of {id: (depth, subtree_height)} for the items which changed."""
+        parents = {}
+        levels = {}
+        current = {}
+        for item_id, parent_id, level, depth, height in cls.objects.filter(
+            country=country
+        ).values_list("id", "parent_id", cls.LEVEL_FIELD, *cls.TREE_FIELDS):
+            parents[item_id] = parent_id
+            levels[item_id] = level
+            current[item_id] = (depth, height)
+
+        changed = {
+            item_id: fields
+            for item_id, fields in tree_fields(parents, levels).items()
+            if fields != current[item_id]
+        }
+        cls.objects.bulk_update(
+            [
+                cls(id=item_id, depth=depth, subtree_height=height)
+                for item_id, (depth, height) in changed.items()
+            ],
+            cls.TREE_FIELDS,
+            batch_size=1000,
+        )
+        if changed:
+            IdentityMap.forget_model(cls)
+        return changed
+
     def build_hierarchy(self, itemlist=None):
         if itemlist is None:
             itemlist = []
         if len(itemlist) == 0:
             itemlist = [self]
 
-        for child in self.all_children:
+        stack = [(self, iter(self.all_children))]
+        while stack:
+            parent, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                continue
             # Children that are included here via supplementary relationships
             # will have a different area as their 'actual' parent
-            if self != child.parent:
+            if child.parent_id != parent.id:
                 child.is_supplementary = True
-                child.override_indent_level = self.indent_level + 1
-            # if self.is_supplementary:
-            #    child.is_supplementary = True
+                child.override_indent_level = parent.indent_level + 1
             itemlist.append(child)
             if not child.is_supplementary:
-                child.build_hierarchy(itemlist)
+                stack.append((child, iter(child.all_children)))
         return itemlist
 
+    def load_tree(self):
+        """Load every item in this item's country in one query, and return
+        a dict of the items by id and a map of each item's children."""
+        items = {item.id: item for item in self.tree_queryset()}
+        items[self.id] = self
+        children = traversal.children_map(
+            (item.id, item.parent_id) for item in items.values()
+        )
+        return items, children
+
     @property
     def descendants(self):
         self.descendant_list = set()
-        return self.get_descendants(set())
+        return self.get_descendants(self.descendant_list)
 
     def get_descendants(self, desclist):
-        for child in self.children:
-            desclist.add(child)
-            desclist.update(child.get_descendants(desclist))
+        items, children = self.load_tree()
+        desclist.update(items[i] for i in traversal.bfs(children, self.id)[1:])
         return desclist
 
     @property
     def num_descendant_levels(self):
-        all_levels = [d.level for d in self.descendants]
-        if all_levels:
-            deepest = max(all_levels)
-            return deepest - self.level
-        else:
-            return 0
+        """The number of levels between this item and its deepest descendant,
+        which is kept up to date in subtree_height as the tree changes."""
+        return self.subtree_height
 
     @property
     def height(self):
         return self.num_descendant_levels
 
-    @property
+    @functools.cached_property
     def num_children(self):
         return self.__class__.objects.filter(parent=self.id).exclude(pk=self.id).count()
 
@@ -74,47 +143,33 @@ class Hierarchy:
         return self.children_by_level
 
     def build_adjacency_list(self):
-        self.graph = {}
-        self.children_by_level = {}
-        self.add_kids_to_adjacency_list(self.graph, self.children_by_level)
+        items, children = self.load_tree()
+        order = traversal.dfs(children, self.id)
+        self.graph = {i: children.get(i, []) for i in order}
+        self.children_by_level = traversal.group_by_level(
+            (items[i] for i in order), lambda item: str(item.level)
+        )
         return self.graph
 
-    def add_kids_to_adjacency_list(self, graph, by_level):
-        graph[self.id] = []
-        if str(self.level) in by_level:
-            by_level[str(self.level)].append(self)
-        else:
-            by_level[str(self.level)] = [self]
-        for kid in self.children:
-            graph[self.id].append(kid.id)
-            graph[kid.id] = []
-            kid.add_kids_to_adjacency_list(graph, by_level)
-
     def bfs(self):
         if not self.graph:
             self.build_adjacency_list()
-        node = self.id
-        visited = []  # List to keep track of visited nodes.
-        queue = []  # Initialize a queue
+        return [str(node) for node in traversal.bfs(self.graph, self.id)]
 
-        visited.append(node)
-        queue.append(node)
-        bfs_list = []
 
-        while queue:
-            s = queue.pop(0)
-            bfs_list.append(str(s))
-            for neighbour in self.graph[s]:
-                if neighbour not in visited:
-                    visited.append(neighbour)
-                    queue.append(neighbour)
-        return bfs_list
+class PopulationCounter:
+    """Utility class to perform population counting on tree structures.
 
+    If a CountrySnapshot is given, counting is done entirely against the
+    snapshot rather than by querying the models for each area."""
 
-class PopulationCounter:
-    """Utility class to perform population counting on tree structures."""
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot
 
     def declared_population(self, area, date=None):
+        if self.snapshot is not None:
+            return self.snapshot.declared_population(area.id, date=date)
+
         count = []
         declared_aggloms = []
         total = 0
@@ -208,21 +263,23 @@ class Country(models.Model):
         at a specified (or current) date."""
 
         as_at_date = kwargs.get("date", datetime.date.today())
-        filter_args = {
-            "status": "D",
-            "area__country": self.id,
-            "event_date__lt": as_at_date,
-        }
-        areas_declared = set()
-        dlist = Declaration.objects.filter(**filter_args).order_by("-event_date")
-        active = []
-        for dec in dlist:
-            # only show the latest active declaration for an area
-            if dec.is_active_at_date(as_at_date):
-                if not dec.area in areas_declared:
-                    active.insert(0, dec)
-                    areas_declared.add(dec.area)
-        return active
+        active = Declaration.active_at(as_at_date, area__country=self.id)
+        return list(active.select_related("area").order_by("event_date", "id"))
+
+    @classmethod
+    def active_declaration_counts(cls, date=None, ids=None):
+        """Return a dict of the number of active declarations in each country
+        (or in the countries with the given ids), by country id, in one query."""
+        filters = {}
+        if ids is not None:
+            filters["area__country__in"] = ids
+        counts = (
+            Declaration.active_at(date, **filters)
+            .values("area__country")
+            .annotate(num=models.Count("id"))
+            .order_by()
+        )
+        return {row["area__country"]: row["num"] for row in counts}
 
     def declarations(self, **kwargs):
         order_by = kwargs.get("order_by")
@@ -258,7 +315,7 @@ class Country(models.Model):
 
     @property
     def num_declarations(self):
-        return len(self.active_declarations())
+        return Declaration.active_at(area__country=self.id).count()
 
     @property
     def declared_population(self):
@@ -293,10 +350,10 @@ class Country(models.Model):
         return PopCount.objects.filter(country=self).order_by("date")
 
     def popcount_update_needed(self, since=None):
-        if self.num_declarations > 0:
-            self.popcount_ready = 0
-            self.popcount_needed_since(since)
-            self.save()
+        """Mark the population counts from the given date onwards, or all of
+        them if no date is given, as needing a recount. This only takes
+        effect when the current transaction commits."""
+        PendingRecounts.mark(self.id, since)
 
     def popcount_update_running(self):
         self.popcount_ready = 2
@@ -304,16 +361,11 @@ class Country(models.Model):
 
     def popcount_update_complete(self):
         self.popcount_ready = 1
-        self.popcount_since = self.earliest_declaration
+        # nothing is pending any more, so the next change sets the date
+        # that the following recount needs to start from
+        self.popcount_since = None
         self.save()
 
-    # Keep track of the earliest date that a popcount is needed from
-    def popcount_needed_since(self, since=None):
-        if not since:
-            since = self.earliest_declaration
-        if not self.popcount_since or self.popcount_since > since:
-            self.popcount_since = since
-
     @property
     def is_popcount_needed(self):
         return self.popcount_ready == 0
@@ -330,6 +382,8 @@ class Country(models.Model):
         aws_lambda = os.environ.get("AWS_LAMBDA_NAME", "")
         response = {"errstr": "cannot trigger recount"}
         since_date_str = ""
+        if self.popcount_since:
+            since_date_str = self.popcount_since.isoformat()
         if aws_region and aws_lambda:
             # create lambda client
             client = boto3.client(
@@ -339,8 +393,6 @@ class Country(models.Model):
                 aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
             )
             logger.info(f"client {client}")
-            if self.popcount_since:
-                since_date_str = self.popcount_since.isoformat()
 
             if client:
                 payload = {
@@ -364,20 +416,44 @@ class Country(models.Model):
             response = {"complete": 1}
         return response
 
-    def generate_population_count(self, fromdate=None):
-        """Recalculate all stored population counts from the given date onwards."""
+    def get_sweep_counter(self, snapshot, root, fromdate=None):
+        """Return a SweepCounter brought up to the day before fromdate,
+        starting from the latest checkpoint before then if there is one."""
+        counter = None
+        if fromdate:
+            checkpoint = (
+                PopCountCheckpoint.objects.filter(country=self, date__lt=fromdate)
+                .order_by("date")
+                .last()
+            )
+            if checkpoint:
+                logger.info(f"resuming count from checkpoint at {checkpoint.date}")
+                counter = checkpoint.restore(snapshot, root.id)
+        if not counter:
+            counter = SweepCounter(snapshot, root.id)
+        if fromdate:
+            # Bring the counter up to the last unaffected date in one step,
+            # rather than stepping through every earlier change date
+            counter.advance(fromdate - datetime.timedelta(days=1))
+        return counter
+
+    def generate_population_count(self, fromdate=None, engine=None):
+        """Recalculate all stored population counts from the given date onwards.
+        Counts before that date are left as they are.
+        The engine is "sweep" or "array", defaulting to the POPCOUNT_ENGINE
+        environment variable, or "sweep" if that isn't set."""
+        engine = engine or os.environ.get("POPCOUNT_ENGINE", "sweep")
+        if engine not in POPCOUNT_ENGINES:
+            raise ValueError(f"unknown popcount engine {engine}")
         logger.info("Counting population update from %s" % fromdate)
         start_time = datetime.datetime.now()
-        filter_args = {
+        fromdate = as_date(fromdate)
+        # popcounts and checkpoints to be replaced
+        old_filter_args = {
             "country": self,
         }
         if fromdate:
-            filter_args["date__gte"] = fromdate
-
-        # delete any popcounts after this point
-        existing_popcounts = PopCount.objects.filter(**filter_args)
-        logger.info("going to delete %s existing popcounts" % len(existing_popcounts))
-        existing_popcounts.delete()
+            old_filter_args["date__gte"] = fromdate
 
         # find declarations for this country, only of status D or V
         filter_args = {
@@ -398,27 +474,60 @@ class Country(models.Model):
         logger.info("got change dates: %s" % change_dates)
 
         root = self.get_root_area()
+        snapshot = CountrySnapshot.load(self)
         latest = 0
-        for cdate in change_dates:
-            # Calculate the population as at this date
-            pc = PopulationCounter()
-            date_pop = pc.declared_population(root, date=cdate)
+        if fromdate:
+            previous = (
+                PopCount.objects.filter(country=self, date__lt=fromdate)
+                .order_by("date", "id")
+                .last()
+            )
+            if previous:
+                latest = previous.population
+        if engine == "array":
+            # Every date is counted independently, so there's no need
+            # to start from a checkpoint
+            from .arraycount import ArrayCounter
+
+            counter = ArrayCounter(snapshot, root.id)
+        else:
+            counter = self.get_sweep_counter(snapshot, root, fromdate)
+        # build the new series in memory, to be swapped in all at once
+        popcounts = []
+        checkpoints = []
+        for num, (cdate, date_pop) in enumerate(counter.count(change_dates), 1):
             logger.info(f"pop at date {cdate} is {date_pop}")
+            if engine == "sweep" and (
+                num % PopCountCheckpoint.INTERVAL == 0 or num == len(change_dates)
+            ):
+                checkpoints.append(PopCountCheckpoint.build(self, counter))
             # Note we add a unique popcount for each declaration on this date,
             # but they all have the same population,
             # because we can't break down population change by declaration at this stage
             for decln in date_dict[cdate]:
-                pop = PopCount.create(self, decln, date_pop)
+                pop = PopCount.build(self, decln, date_pop)
+                popcounts.append(pop)
                 latest = pop.population
 
-        self.current_popcount = latest
+        # Replace the old series with the new one in a single transaction,
+        # so the timeline is never seen half-written
+        with transaction.atomic():
+            deleted, _ = PopCount.objects.filter(**old_filter_args).delete()
+            logger.info("deleted %s existing popcounts" % deleted)
+            PopCountCheckpoint.objects.filter(**old_filter_args).delete()
+            PopCount.objects.bulk_create(popcounts)
+            PopCountCheckpoint.objects.bulk_create(checkpoints)
+            self.current_popcount = latest
+            # mark as update complete
+            self.popcount_update_complete()
+            # declarations dated in the future may have become active since
+            # they were last counted
+            CountrySummary.count_declarations(self.id)
+
         end_time = datetime.datetime.now()
         delta = str(end_time - start_time)
         logger.info(f"Popcount for {self.country_code} took {delta}")
 
-        # mark as update complete
-        self.popcount_update_complete()
-
     def __str__(self):
         return self.name
 
@@ -430,6 +539,14 @@ class Structure(Hierarchy, models.Model):
     parent = models.ForeignKey("self", on_delete=models.CASCADE)
     admin_notes = models.TextField(blank=True)
     links = GenericRelation(Link, null=True, blank=True, related_query_name="link")
+    # number of parent links up to the root structure
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
+    # number of levels down to the deepest descendant
+    subtree_height = models.PositiveSmallIntegerField(default=0, editable=False)
+
+    LEVEL_FIELD = "level"
+    __original_parent_id = None
+    __original_level = None
     graph = None
     children_by_level = None
 
@@ -439,19 +556,50 @@ class Structure(Hierarchy, models.Model):
 
     is_supplementary = False
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__original_parent_id = self.parent_id
+        self.__original_level = self.level
+
     @classmethod
     def content_type_id(cls):
         return ContentType.objects.get_for_model(cls).pk
 
+    def save(self, *args, **kwargs):
+        new = self._state.adding or self.pk is None
+        changed_level = not new and self.level != self.__original_level
+        changed = new or (self.parent_id, self.level) != (
+            self.__original_parent_id,
+            self.__original_level,
+        )
+        if not new and "update_fields" not in kwargs:
+            kwargs["update_fields"] = self.saved_fields()
+
+        super().save(*args, **kwargs)
+        self.__original_parent_id = self.parent_id
+        self.__original_level = self.level
+
+        if changed:
+            # countries only have a handful of structures,
+            # so recompute them all rather than just the ancestors
+            changed = Structure.refresh_tree_fields(self.country_id)
+            self.depth, self.subtree_height = changed.get(
+                self.id, (self.depth, self.subtree_height)
+            )
+        if changed_level:
+            # area heights are worked out from the levels of their structures
+            Area.refresh_tree_fields(self.country_id)
+
     @property
     def fullname(self):
         name = ""
+        country = IdentityMap.related(self, "country")
         if self.level > 1:
             # will need to recurse here for multiple levels
-            myparent = self.parent
-            name = "%s | %s: %s " % (self.country.name, myparent.name, self.name)
+            myparent = IdentityMap.related(self, "parent")
+            name = "%s | %s: %s " % (country.name, myparent.name, self.name)
         else:
-            name = "%s | %s" % (self.country.name, self.name)
+            name = "%s | %s" % (country.name, self.name)
         return name
 
     @property
@@ -472,20 +620,17 @@ class Structure(Hierarchy, models.Model):
         records = Area.objects.filter(structure=self.id).order_by("sort_name")
         return records
 
+    def tree_queryset(self):
+        return Structure.objects.filter(country=self.country_id).order_by("name")
+
     @property
     def ancestors(self):
-        self.parentlist = [self]
-        if self.id != self.parent_id:
-            self.parentlist.insert(0, self.parent)
-        self.get_parent(self.parent.id)
+        """Return a list of the structures from the root down to this one."""
+        items, children = self.load_tree()
+        parents = {item.id: item.parent_id for item in items.values()}
+        self.parentlist = [items[i] for i in traversal.ancestor_path(parents, self.id)]
         return self.parentlist
 
-    def get_parent(self, parent_id):
-        parent = Structure.objects.get(id=parent_id)
-        if parent.parent_id != parent_id:
-            self.parentlist.insert(0, parent.parent)
-            return self.get_parent(parent.parent_id)
-
     @property
     def num_areas(self):
         num_areas = Area.objects.filter(structure=self.id).count()
@@ -518,8 +663,15 @@ class Area(Hierarchy, models.Model):
     )
     sort_name = models.CharField(max_length=64, null=True, blank=True)
     links = GenericRelation(Link, null=True, related_query_name="link")
+    # number of parent links up to the root area
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
+    # number of levels down to the deepest direct descendant
+    subtree_height = models.PositiveSmallIntegerField(default=0, editable=False)
 
+    LEVEL_FIELD = "structure__level"
     __original_population = None
+    __original_parent_id = None
+    __original_structure_id = None
     graph = None
     children_by_level = None
 
@@ -532,6 +684,8 @@ class Area(Hierarchy, models.Model):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.__original_population = self.population
+        self.__original_parent_id = self.parent_id
+        self.__original_structure_id = self.structure_id
 
     @classmethod
     def content_type_id(cls):
@@ -544,12 +698,160 @@ class Area(Hierarchy, models.Model):
         changed_pop = False
         if self.population != self.__original_population:
             changed_pop = True
+        # moving an area changes what is counted under its old and new parents
+        moved = False
+        if self.pk and self.parent_id != self.__original_parent_id:
+            changed_pop = True
+            moved = True
+        changed_level = bool(self.pk) and (
+            self.structure_id != self.__original_structure_id
+        )
+        new = self._state.adding or self.pk is None
+        old_ancestors = []
+        if moved:
+            old_ancestors = self.direct_ancestor_ids()
+        if not new and "update_fields" not in kwargs:
+            kwargs["update_fields"] = self.saved_fields()
 
         super().save(*args, **kwargs)
         self.__original_population = self.population
+        self.__original_parent_id = self.parent_id
+        self.__original_structure_id = self.structure_id
+
+        if new or moved:
+            AreaClosure.refresh([self.id])
+            self.update_depth()
+        if new or moved or changed_level:
+            heights = Area.update_heights(old_ancestors + self.direct_ancestor_ids())
+            self.subtree_height = heights.get(self.id, self.subtree_height)
 
         if changed_pop:
-            self.country.popcount_update_needed()
+            # this also discards any saved popcount checkpoints
+            IdentityMap.related(self, "country").popcount_update_needed()
+
+    def tree_queryset(self):
+        return (
+            Area.objects.filter(country=self.country_id)
+            .select_related("structure")
+            .order_by("structure", "sort_name")
+        )
+
+    def direct_ancestor_ids(self):
+        """Return a list of the ids of this area and its ancestors through
+        parent links."""
+        return list(
+            AreaClosure.objects.filter(descendant=self.id, direct=True).values_list(
+                "ancestor_id", flat=True
+            )
+        )
+
+    def update_depth(self):
+        """Set the depth of this area from its parent's, and move all of its
+        descendants by the same number of levels."""
+        depth = 0
+        if self.parent_id != self.id:
+            depth = Area.objects.values_list("depth", flat=True).get(pk=self.parent_id)
+            depth += 1
+        old_depth = Area.objects.values_list("depth", flat=True).get(pk=self.id)
+        if depth != old_depth:
+            Area.objects.filter(
+                ancestor_links__ancestor=self.id, ancestor_links__direct=True
+            ).update(depth=F("depth") + (depth - old_depth))
+            IdentityMap.forget_model(Area)
+        self.depth = depth
+
+    @classmethod
+    def with_child_counts(cls, queryset, supplementary=False):
+        """Add the number of children of each area to a queryset, as
+        num_children, in the same query. With supplementary, add the number
+        of supplementary children too, as num_supplementary_children."""
+
+        def count(children, key):
+            children = children.exclude(pk=OuterRef("pk")).order_by()
+            counts = children.values(key).annotate(n=Count("pk")).values("n")
+            return Coalesce(Subquery(counts), 0)
+
+        counts = {
+            "num_children": count(cls.objects.filter(parent=OuterRef("pk")), "parent")
+        }
+        if supplementary:
+            counts["num_supplementary_children"] = count(
+                cls.objects.filter(supplements=OuterRef("pk")), "supplements"
+            )
+        return queryset.annotate(**counts)
+
+    @classmethod
+    def update_heights(cls, area_ids):
+        """Recompute the subtree height of the given areas from the levels of
+        their descendants, and return a dict of {id: height} for the areas
+        which changed."""
+        if not area_ids:
+            return {}
+        rows = (
+            AreaClosure.objects.filter(ancestor__in=area_ids, direct=True)
+            .values(
+                "ancestor_id", "ancestor__structure__level", "ancestor__subtree_height"
+            )
+            .annotate(deepest=Max("descendant__structure__level"))
+        )
+        changed = {}
+        for row in rows:
+            height = max(0, row["deepest"] - row["ancestor__structure__level"])
+            if height != row["ancestor__subtree_height"]:
+                changed[row["ancestor_id"]] = height
+        cls.objects.bulk_update(
+            [cls(id=area_id, subtree_height=h) for area_id, h in changed.items()],
+            ["subtree_height"],
+        )
+        if changed:
+            IdentityMap.forget_model(cls)
+        return changed
+
+    @classmethod
+    def edit_supplements(cls, area_ids, add_ids=(), remove_ids=()):
+        """Add and remove supplementary parents for many areas at once, with
+        one insert and one delete, and return the numbers of links added and
+        removed. Unlike supplements.add and remove, this rebuilds the closure
+        links and marks each country as needing a recount just once."""
+        through = cls.supplements.through
+        area_ids = set(area_ids)
+        remove_ids = set(remove_ids)
+        add_ids = set(
+            cls.objects.filter(id__in=set(add_ids) - remove_ids).values_list(
+                "id", flat=True
+            )
+        )
+        current = set(
+            through.objects.filter(from_area__in=area_ids).values_list(
+                "from_area_id", "to_area_id"
+            )
+        )
+        added = [
+            through(from_area_id=area_id, to_area_id=supplement_id)
+            for area_id in area_ids
+            for supplement_id in add_ids
+            if area_id != supplement_id and (area_id, supplement_id) not in current
+        ]
+        removing = {pair for pair in current if pair[1] in remove_ids}
+        if not (added or removing):
+            return 0, 0
+
+        with transaction.atomic():
+            through.objects.bulk_create(added)
+            removed = 0
+            if removing:
+                removed, _ = through.objects.filter(
+                    from_area__in={area_id for area_id, _ in removing},
+                    to_area__in=remove_ids,
+                ).delete()
+            changed = {link.from_area_id for link in added}
+            changed.update(area_id for area_id, _ in removing)
+            AreaClosure.refresh(changed)
+            for country_id in set(
+                cls.objects.filter(id__in=changed).values_list("country", flat=True)
+            ):
+                PendingRecounts.mark(country_id)
+        return len(added), removed
 
     @property
     def declarations(self):
@@ -580,7 +882,7 @@ class Area(Hierarchy, models.Model):
     def regen_from_oldest_dec(self):
         decs = self.declarations
         if decs:
-            self.country.generate_population_count(
+            IdentityMap.related(self, "country").generate_population_count(
                 fromdate=decs.latest("-event_date").event_date
             )
 
@@ -593,7 +895,7 @@ class Area(Hierarchy, models.Model):
         )
         return children
 
-    @property
+    @functools.cached_property
     def num_indirect_children(self):
         return Area.objects.filter(supplements=self.id).exclude(pk=self.id).count()
 
@@ -609,7 +911,7 @@ class Area(Hierarchy, models.Model):
         )
         return combined
 
-    @property
+    @functools.cached_property
     def num_all_children(self):
         return (
             Area.objects.filter(Q(parent=self.id) | Q(supplements=self.id))
@@ -618,61 +920,65 @@ class Area(Hierarchy, models.Model):
             .count()
         )
 
-    @property
+    @functools.cached_property
     def num_supplementary_children(self):
         return Area.objects.filter(supplements=self.id).exclude(pk=self.id).count()
 
     @property
     def ancestors(self):
-        self.parentlist = set([self])
-        if self.id != self.parent_id:
-            self.parentlist.add(self.parent)
-        self.get_parent(self.parent.id)
-        for s in self.supplements.all():
-            if s not in self.parentlist:
-                self.parentlist.add(s)
-                self.get_parent(s.id)
+        """Return a set of this area and all its ancestors, through both
+        parent and supplementary parent links."""
+        self.parentlist = set(Area.objects.filter(descendant_links__descendant=self))
         return self.parentlist
 
     def get_parent(self, parent_id):
-        parent = Area.objects.get(id=parent_id)
-        if parent.parent_id != parent_id:
-            self.parentlist.add(parent.parent)
-            self.get_parent(parent.parent_id)
-        for s in parent.supplements.all():
-            if s not in self.parentlist:
-                self.parentlist.add(s)
-                self.get_parent(s.id)
+        self.parentlist.update(
+            Area.objects.filter(descendant_links__descendant=parent_id)
+        )
         return self.parentlist
 
     @property
     def direct_ancestors(self):
+        """Return a list of this area, its parent, and so on up to the root area."""
         self.direct_parentlist = [self]
-        if self.id != self.parent_id:
-            self.direct_parentlist.append(self.parent)
-        self.get_direct_parent(self.parent.id)
+        self.get_direct_parent(self.id)
         return self.direct_parentlist
 
     def get_direct_parent(self, parent_id):
-        parent = Area.objects.get(id=parent_id)
-        if parent.parent_id != parent_id:
-            self.direct_parentlist.append(parent.parent)
-            self.get_direct_parent(parent.parent_id)
+        parents = Area.objects.filter(
+            descendant_links__descendant=parent_id,
+            descendant_links__direct=True,
+            descendant_links__depth__gt=0,
+        ).order_by("descendant_links__depth")
+        self.direct_parentlist.extend(parents)
         return self.direct_parentlist
 
     def declared_population(self):
-        popcounter = PopulationCounter()
+        country = IdentityMap.related(self, "country")
+        popcounter = PopulationCounter(CountrySnapshot.load(country))
         return popcounter.declared_population(self)
 
+    @property
+    def descendants(self):
+        """Return a set of all areas below this one through parent links."""
+        self.descendant_list = set(
+            Area.objects.filter(
+                ancestor_links__ancestor=self, ancestor_links__direct=True
+            ).exclude(pk=self.id)
+        )
+        return self.descendant_list
+
     @property
     def all_descendants(self):
+        """Return a set of all areas below this one, through both parent and
+        supplementary parent links."""
         self.descendant_list = set()
-        return self.get_all_descendants(set())
+        return self.get_all_descendants(self.descendant_list)
 
     def get_all_descendants(self, desclist):
-        for child in self.all_children:
-            desclist.add(child)
-            desclist.update(child.get_all_descendants(desclist))
+        desclist.update(
+            Area.objects.filter(ancestor_links__ancestor=self).exclude(pk=self.id)
+        )
         return desclist
 
     @property
@@ -685,55 +991,50 @@ class Area(Hierarchy, models.Model):
             if parent == self:
                 continue
             if parent.is_declared_at(dec_date):
-                logger.debug("parent %s is declared at %s" % (parent.name, dec_date))
+                logger.debug("parent %s is declared at %s", parent.name, dec_date)
                 num_declared += 1
         return num_declared
 
     def contribution(self):
-        area_total = 0
         num_dec_anc = self.num_declared_ancestors()
-        poplog.info("num declared ancestors for %s is %s" % (self.name, num_dec_anc))
-        # This area is declared and nothing above it has declared
-        if self.is_declared and num_dec_anc == 0:
-            poplog.info("%s is declared and has no declared ancestors" % self.name)
-            area_total = self.population
-        # Multiple areas above this one have declared
-        elif num_dec_anc > 1:
-            poplog.info("%s has %s declared ancestors" % (self.name, num_dec_anc))
-            area_total = -1 * (num_dec_anc - 1) * self.population
-        else:
-            poplog.info("%s has exactly 1 declared ancestor" % self.name)
-        poplog.info("so %s contribution is %s" % (self.name, area_total))
+        area_total = contribution(self.population, self.is_declared, num_dec_anc)
+        poplog.debug(
+            "%s has %s declared ancestors, so contributes %s",
+            self.name,
+            num_dec_anc,
+            area_total,
+        )
         return area_total
 
     @property
     def count_population(self):
-        return self.structure.count_population
+        return IdentityMap.related(self, "structure").count_population
 
     @property
     def is_governing(self):
-        return self.structure.is_governing
+        return IdentityMap.related(self, "structure").is_governing
 
     @property
     def level(self):
-        return self.structure.level
+        return IdentityMap.related(self, "structure").level
 
     @property
     def indent_level(self):
         if self.override_indent_level:
             return self.override_indent_level
-        return self.structure.indent_level
+        return IdentityMap.related(self, "structure").indent_level
 
     @property
     def api_link(self):
         return django.urls.reverse("api_area_data", args=[self.id])
 
+    @property
+    def declaration_index(self):
+        return DeclarationIndex.for_country(self.country_id)
+
     @property
     def latest_declaration(self):
-        try:
-            return self.declarations.latest("event_date")
-        except Declaration.DoesNotExist as ex:
-            pass
+        return self.declaration_index.latest(self.id)
 
     @property
     def latest_declaration_date(self):
@@ -749,10 +1050,10 @@ class Area(Hierarchy, models.Model):
         is DECLARED."""
         # Consider an area to be declared based on the status of its most
         # recent declaration
-        latest = self.latest_declaration
-        if latest:
-            return self.latest_declaration.status == "D"
-        return False
+        if "latest_status" in self.__dict__:
+            # annotated by AreaBranch, so no need to load the index
+            return self.latest_status == Declaration.DECLARED
+        return self.declaration_index.is_declared_at(self.id)
 
     def is_declared_at(self, dec_date):
         """Return true if the Area's most recent declaration, at the given date,
@@ -760,23 +1061,19 @@ class Area(Hierarchy, models.Model):
         if not dec_date:
             return self.is_declared
 
-        latest_dec = None
         try:
-            latest_dec = self.declarations.filter(event_date__lte=dec_date).latest(
-                "event_date"
-            )
-        except ValidationError as ex:
+            return self.declaration_index.is_declared_at(self.id, dec_date)
+        except ValueError as ex:
             logger.error("invalid date: %s" % dec_date)
-        except Declaration.DoesNotExist as ex:
-            pass
-        if latest_dec:
-            return latest_dec.status == "D"
         return False
 
     @property
     def sub_types(self):
-        thistype = self.structure
-        typekids = thistype.children
+        thistype = IdentityMap.related(self, "structure")
+        # structures loaded by a StructureTree already know their children
+        typekids = getattr(thistype, "loaded_children", None)
+        if typekids is None:
+            typekids = thistype.children
         return typekids
 
     @property
@@ -835,7 +1132,7 @@ class Area(Hierarchy, models.Model):
             exclude_list.append(kwargs.get("exclude"))
         arealist = (
             Area.objects.filter(
-                country_id=self.country.id,
+                country_id=self.country_id,
                 # structure__level__lte=(self.structure.level+1)
                 agglomeration=True,
             )
@@ -850,53 +1147,91 @@ class Area(Hierarchy, models.Model):
             self.links.create(url=url)
 
     def check_tree_integrity(self):
-        graph = self.build_adjacency_list()
-        by_level = self.get_children_by_level()
-        print(f"all y level {by_level}")
-        levels = sorted(by_level.keys())
-        print(f"by level keys {levels}")
-        this_level = self.structure.level
-        all_ok = True
-        num_nodes = sum(len(v) for v in by_level.values())
-        nodes_by_id = {}
-
-        # check nodes by_level
-        l_counter = 0
-        while True:
-            kids = by_level.get(str(this_level), [])
-            print(f"level {this_level} has kids {kids}")
-            if kids:
-                for kid in kids:
-                    nodes_by_id[kid.id] = kid
-                    l_counter += 1
-                    if kid.structure.level != this_level:
-                        all_ok = False
-            else:
-                break
-            this_level += 1
-        if num_nodes != l_counter:
-            all_ok = False
-        print(f"nodes by id {nodes_by_id}")
-
-        # check by adjacency list
-        for node_id in graph.keys():
-            node = nodes_by_id[node_id]
-            print(f"nodeid {node_id} node {node}")
-            nodelist = graph[node_id]
-            print(f"list {nodelist}")
-            for kid_id in nodelist:
-                kid = nodes_by_id[kid_id]
-                if kid.level != (node.level + 1):
-                    all_ok = False
-                # also check that kid structure is a child of parent structure
-                if kid.structure.parent != node.structure:
-                    all_ok = False
-        return all_ok
+        """Return true if no problems are found with this area or any of the
+        areas under it."""
+        check = TreeCheck.load(IdentityMap.related(self, "country"))
+        check.run()
+        children = traversal.children_map(check.parents("area").items())
+        subtree = set(traversal.bfs(children, self.id))
+        return not any(
+            p["model"] == "area" and p["id"] in subtree for p in check.problems
+        )
 
     def __str__(self):
         return self.fullname
 
 
+class AreaClosure(models.Model):
+    """Links every area to each of its ancestors, through both parent and
+    supplementary parent links, so that all the ancestors or descendants of
+    an area can be found in one query. Every area is also linked to itself.
+
+    For ancestors which can be reached through parent links alone, direct is
+    set and depth is the number of levels between the two areas. Otherwise
+    depth is the length of the shortest route between them."""
+
+    ancestor = models.ForeignKey(
+        Area, on_delete=models.CASCADE, related_name="descendant_links"
+    )
+    descendant = models.ForeignKey(
+        Area, on_delete=models.CASCADE, related_name="ancestor_links"
+    )
+    depth = models.PositiveSmallIntegerField()
+    direct = models.BooleanField()
+
+    class Meta:
+        unique_together = [["ancestor", "descendant"]]
+
+    def __str__(self):
+        return "%s > %s" % (self.ancestor_id, self.descendant_id)
+
+    @classmethod
+    def refresh(cls, area_ids):
+        """Rebuild the links for the given areas and all their descendants,
+        after their parents or supplementary parents have changed."""
+        area_ids = set(area_ids)
+        area_ids.update(
+            cls.objects.filter(ancestor__in=area_ids).values_list(
+                "descendant_id", flat=True
+            )
+        )
+        parents = dict(
+            Area.objects.filter(id__in=area_ids).values_list("id", "parent_id")
+        )
+        supplements = {}
+        for area_id, supplement_id in Area.supplements.through.objects.filter(
+            from_area__in=area_ids
+        ).values_list("from_area_id", "to_area_id"):
+            supplements.setdefault(area_id, []).append(supplement_id)
+
+        # ancestors of anything outside the areas being rebuilt are unchanged
+        outside = set(parents.values()) - area_ids
+        for supplement_ids in supplements.values():
+            outside.update(set(supplement_ids) - area_ids)
+        known = {}
+        for link in cls.objects.filter(descendant__in=outside):
+            known.setdefault(link.descendant_id, {})[link.ancestor_id] = (
+                link.depth,
+                link.direct,
+            )
+
+        closure = build_closure(parents.keys(), parents, supplements, known)
+        links = [
+            cls(ancestor_id=ancestor_id, descendant_id=area_id, depth=d, direct=direct)
+            for area_id, ancestors in closure.items()
+            for ancestor_id, (d, direct) in ancestors.items()
+        ]
+        with transaction.atomic():
+            cls.objects.filter(descendant__in=parents).delete()
+            cls.objects.bulk_create(links)
+
+    @classmethod
+    def rebuild(cls, country):
+        """Rebuild all the links for a country."""
+        area_ids = Area.objects.filter(country=country).values_list("id", flat=True)
+        cls.refresh(area_ids)
+
+
 class Declaration(models.Model):
     area = models.ForeignKey(Area, on_delete=models.CASCADE)
     # status types
@@ -950,18 +1285,23 @@ class Declaration(models.Model):
         if not self.pk:
             new = True
 
+        loaded = {} if new else self._loaded_values
+        old_date = loaded.get("event_date", "")
         changed = False
-        if self.event_date != self._loaded_values.get(
-            "event_date", ""
-        ) or self.status != self._loaded_values.get("status", ""):
+        if self.event_date != old_date or self.status != loaded.get("status", ""):
             changed = True
 
         super().save(*args, **kwargs)
-        self._loaded_values["event_date"] = self.event_date
-        self._loaded_values["status"] = self.status
+        self._loaded_values = {"event_date": self.event_date, "status": self.status}
 
         if changed:
-            self.area.country.popcount_update_needed(self.event_date)
+            # If the date has moved, counts from the earlier of the old
+            # and new dates are affected
+            since = as_date(self.event_date)
+            if old_date and as_date(old_date) < since:
+                since = as_date(old_date)
+            area = IdentityMap.related(self, "area")
+            IdentityMap.related(area, "country").popcount_update_needed(since)
 
     @property
     def status_name(self):
@@ -990,18 +1330,35 @@ class Declaration(models.Model):
         population counts (only Declared or Revoked)"""
         return self.POPULATION_STATUS.get(self.status)
 
+    @classmethod
+    def active_at(cls, date=None, **filters):
+        """Return a queryset of the declarations active at the given (or current)
+        date: the latest declared status for each area, as long as no other
+        status has been declared for that area since."""
+        if date is None:
+            date = datetime.date.today()
+        since = cls.objects.filter(area=OuterRef("area"), event_date__lt=date)
+        # any other status after this declaration makes it inactive
+        revoked = since.filter(event_date__gt=OuterRef("event_date")).exclude(
+            status="D"
+        )
+        # only the latest declaration for each area is wanted
+        redeclared = since.filter(status="D").filter(
+            Q(event_date__gt=OuterRef("event_date"))
+            | Q(event_date=OuterRef("event_date"), id__gt=OuterRef("id"))
+        )
+        return cls.objects.filter(
+            ~Exists(revoked),
+            ~Exists(redeclared),
+            status="D",
+            event_date__lt=date,
+            **filters,
+        )
+
     def is_active_at_date(self, date):
-        siblings = Declaration.objects.filter(
-            area=self.area.id, event_date__lt=date, event_date__gt=self.event_date,
-        ).exclude(pk=self.id)
-        for sib in siblings:
-            if sib.status != "D":
-                logger.info(
-                    "excluding area %s due to declaration with non-D status %s at date %s"
-                    % (sib.area, sib.status, sib.event_date)
-                )
-                return False
-        return True
+        area = IdentityMap.related(self, "area")
+        index = DeclarationIndex.for_country(area.country_id)
+        return index.is_active_at(self, date)
 
 
 class PopCount(models.Model):
@@ -1019,14 +1376,131 @@ class PopCount(models.Model):
         return self.population
 
     @classmethod
-    def create(cls, country, declaration, population):
+    def build(cls, country, declaration, population):
+        """Return a new, unsaved popcount for a declaration."""
         pop = cls(country=country, declaration=declaration, population=population)
         pop.status = declaration.status
         pop.date = declaration.event_date
+        return pop
+
+    @classmethod
+    def create(cls, country, declaration, population):
+        pop = cls.build(country, declaration, population)
         pop.save()
         return pop
 
 
+class PopCountCheckpoint(models.Model):
+    """Saved state of the population counter for a country as at a date,
+    so that a recount from a later date doesn't have to start from scratch."""
+
+    # save a checkpoint after this many change dates
+    INTERVAL = 25
+
+    country = models.ForeignKey(Country, on_delete=models.CASCADE)
+    date = models.DateField()
+    population = models.PositiveIntegerField()
+    # counter state, as compact JSON
+    state = models.TextField()
+
+    def __str__(self):
+        return "%s: %s" % (self.country, self.date)
+
+    @classmethod
+    def build(cls, country, counter):
+        """Return a new, unsaved checkpoint of the counter's current state."""
+        state = counter.get_state()
+        checkpoint = cls(country=country, date=counter.date, population=state["total"])
+        checkpoint.state = json.dumps(state, separators=(",", ":"))
+        return checkpoint
+
+    @classmethod
+    def create(cls, country, counter):
+        checkpoint = cls.build(country, counter)
+        checkpoint.save()
+        return checkpoint
+
+    def restore(self, snapshot, root_id=None):
+        """Return a SweepCounter carrying on from this checkpoint, or None if
+        the checkpoint no longer matches the country."""
+        counter = SweepCounter.restore(snapshot, json.loads(self.state), root_id)
+        if not counter:
+            logger.warning(f"checkpoint {self.id} does not match, ignoring it")
+        return counter
+
+
+class CountrySummary(models.Model):
+    """Counters for a country, kept up to date as its contents change,
+    so that pages listing countries don't have to count anything."""
+
+    country = models.OneToOneField(
+        Country, on_delete=models.CASCADE, primary_key=True, related_name="summary"
+    )
+    num_structures = models.PositiveIntegerField(default=0)
+    num_areas = models.PositiveIntegerField(default=0)
+    # active declarations, as at the last time they were counted: whenever
+    # a declaration changes, and at each recount. One dated in the future
+    # only becomes active on that date, so refresh_country_summaries should
+    # be run daily to keep this current for countries which aren't recounted
+    num_declarations = models.PositiveIntegerField(default=0)
+    inbox_count = models.PositiveIntegerField(default=0)
+    current_popcount = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return "%s summary" % self.country
+
+    @classmethod
+    def adjust(cls, country_id, field, change):
+        """Add change to one of the counters for a country."""
+        cls.objects.filter(country_id=country_id).update(
+            **{field: models.F(field) + change}
+        )
+
+    @classmethod
+    def count_declarations(cls, country_id):
+        cls.objects.filter(country_id=country_id).update(
+            num_declarations=Declaration.active_at(area__country=country_id).count()
+        )
+
+    @classmethod
+    def refresh(cls, countries=None):
+        """Recount everything for the given countries (or all countries),
+        with one query per counter."""
+        if countries is None:
+            countries = Country.objects.all()
+        countries = list(countries)
+        ids = [c.id for c in countries]
+
+        def count_by_country(model, field="country"):
+            rows = (
+                model.objects.filter(**{f"{field}__in": ids})
+                .values(field)
+                .annotate(num=models.Count("id"))
+                .order_by()
+            )
+            return {row[field]: row["num"] for row in rows}
+
+        structures = count_by_country(Structure)
+        areas = count_by_country(Area)
+        inbox = count_by_country(ImportDeclaration)
+        declarations = Country.active_declaration_counts(ids=ids)
+        summaries = [
+            cls(
+                country=c,
+                num_structures=structures.get(c.id, 0),
+                num_areas=areas.get(c.id, 0),
+                num_declarations=declarations.get(c.id, 0),
+                inbox_count=inbox.get(c.id, 0),
+                current_popcount=c.current_popcount,
+            )
+            for c in countries
+        ]
+        with transaction.atomic():
+            cls.objects.filter(country__in=ids).delete()
+            cls.objects.bulk_create(summaries)
+        return summaries
+
+
 class ImportDeclaration(models.Model):
     name = models.TextField(null=True, blank=True)
     num_govs = models.PositiveSmallIntegerField(null=True, blank=True)
@@ -1039,7 +1513,8 @@ class ImportDeclaration(models.Model):
     country = models.ForeignKey(Country, on_delete=models.CASCADE)
 
 
-from django.db.models.signals import m2m_changed
+from django.core.signals import request_finished, request_started
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 
 
 def supplements_changed(sender, **kwargs):
@@ -1051,7 +1526,119 @@ def supplements_changed(sender, **kwargs):
     if kwargs["action"] == "post_clear":
         update = True
     if update:
-        kwargs["instance"].country.popcount_update_needed()
+        instance = kwargs["instance"]
+        if not kwargs["reverse"]:
+            changed = [instance.id]
+        elif kwargs["pk_set"]:
+            changed = kwargs["pk_set"]
+        else:
+            # cleared from the supplementary parent's side,
+            # so any of its descendants may have been affected
+            changed = [area.id for area in instance.all_descendants]
+        AreaClosure.refresh(changed)
+        # this also discards any saved popcount checkpoints
+        instance.country.popcount_update_needed()
 
 
 m2m_changed.connect(supplements_changed, sender=Area.supplements.through)
+
+
+def area_deleting(sender, instance, **kwargs):
+    # the area's closure links are deleted with it,
+    # so find its ancestors while they are still there
+    instance.deleted_from = instance.direct_ancestor_ids()
+    # links to it as a supplementary parent are deleted without m2m_changed,
+    # so the areas it supplemented need their links rebuilt afterwards
+    instance.supplemented = list(instance.supplement.values_list("id", flat=True))
+
+
+def area_deleted(sender, instance, **kwargs):
+    Area.update_heights(getattr(instance, "deleted_from", []))
+    supplemented = getattr(instance, "supplemented", [])
+    if supplemented:
+        AreaClosure.refresh(supplemented)
+
+
+def structure_deleted(sender, instance, **kwargs):
+    Structure.refresh_tree_fields(instance.country_id)
+
+
+pre_delete.connect(area_deleting, sender=Area)
+post_delete.connect(area_deleted, sender=Area)
+post_delete.connect(structure_deleted, sender=Structure)
+
+
+def request_starting(**kwargs):
+    clear_request_caches()
+    # recount marks left over from a rolled back transaction are dropped
+    PendingRecounts.clear()
+
+
+def request_ending(**kwargs):
+    clear_request_caches()
+
+
+def declaration_written(**kwargs):
+    DeclarationIndex.clear()
+
+
+def mapped_instance_written(sender, instance, **kwargs):
+    IdentityMap.forget(instance)
+
+
+# Declaration indexes and the identity map only last as long as a request.
+# Indexes are discarded as soon as any declaration changes, and the
+# identity map forgets anything saved or deleted
+request_started.connect(request_starting)
+request_finished.connect(request_ending)
+post_save.connect(declaration_written, sender=Declaration)
+post_delete.connect(declaration_written, sender=Declaration)
+for mapped_model in [Country, Structure, Area, Declaration]:
+    post_save.connect(mapped_instance_written, sender=mapped_model)
+    post_delete.connect(mapped_instance_written, sender=mapped_model)
+
+
+def country_saved(sender, instance, created, **kwargs):
+    if created:
+        CountrySummary.objects.get_or_create(country=instance)
+    CountrySummary.objects.filter(country=instance).update(
+        current_popcount=instance.current_popcount
+    )
+
+
+# the summary counter kept for each kind of object in a country
+SUMMARY_COUNTERS = {
+    Structure: "num_structures",
+    Area: "num_areas",
+    ImportDeclaration: "inbox_count",
+}
+
+
+def counted_item_saved(sender, instance, created, **kwargs):
+    if created:
+        CountrySummary.adjust(instance.country_id, SUMMARY_COUNTERS[sender], 1)
+
+
+def counted_item_deleted(sender, instance, **kwargs):
+    CountrySummary.adjust(instance.country_id, SUMMARY_COUNTERS[sender], -1)
+    if sender is Area:
+        # the area's declarations may have gone before it, too late
+        # to find out which country they belonged to
+        CountrySummary.count_declarations(instance.country_id)
+
+
+def declaration_changed(sender, instance, **kwargs):
+    try:
+        country_id = instance.area.country_id
+    except Area.DoesNotExist:
+        # counted when the area's deletion is
+        return
+    CountrySummary.count_declarations(country_id)
+
+
+post_save.connect(country_saved, sender=Country)
+for counted_model in SUMMARY_COUNTERS:
+    post_save.connect(counted_item_saved, sender=counted_model)
+    post_delete.connect(counted_item_deleted, sender=counted_model)
+post_save.connect(declaration_changed, sender=Declaration)
+post_delete.connect(declaration_changed, sender=Declaration)
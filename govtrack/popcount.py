@@ -0,0 +1,437 @@
+"""Population counting against an in-memory snapshot of a country.
+
+Counting directly against the models runs several queries for every area
+visited, for every date counted. A CountrySnapshot loads everything the
+counter needs for one country up front, so a full recount only costs a
+fixed number of queries regardless of the size of the country.
+"""
+
+from collections import deque
+import bisect
+import datetime
+import heapq
+import logging
+
+logger = logging.getLogger("cegov")
+
+DATE_FORMAT = "%Y-%m-%d"
+
+
+def as_date(value):
+    """Convert a date, datetime or YYYY-MM-DD string to a date.
+    Empty values are returned as None."""
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(value, DATE_FORMAT).date()
+
+
+def contribution(population, is_declared, num_declared_ancestors):
+    """Return how much an area adds to the declared population counted by
+    summing declared areas: all of its population if it is declared and
+    nothing above it is, or minus its population for every declared
+    ancestor after the first, since each of those counts it again."""
+    if is_declared and num_declared_ancestors == 0:
+        return population
+    if num_declared_ancestors > 1:
+        return -1 * (num_declared_ancestors - 1) * population
+    return 0
+
+
+class CountrySnapshot:
+    """Read-only copy of the area tree and declaration history for a country.
+
+    Areas are referred to by id throughout. Children are held in the same
+    order as Area.children, so that traversals visit areas in the same
+    order as they would when walking the models."""
+
+    def __init__(self, country_id):
+        self.country_id = country_id
+        self.root_id = None
+        self.population = {}
+        self.parent = {}
+        # direct children of each area
+        self.children = {}
+        # supplementary parents of each area, and the reverse
+        self.supplements = {}
+        self.supplementary_children = {}
+        # declaration (event_date, status) pairs for each area, oldest first
+        self.events = {}
+        self._event_dates = {}
+
+    @classmethod
+    def load(cls, country):
+        """Load a snapshot for a country in a constant number of queries."""
+        from .models import Area, Declaration
+
+        snapshot = cls(country.id)
+        areas = (
+            Area.objects.filter(country=country.id)
+            .order_by("structure", "sort_name", "id")
+            .values_list("id", "parent_id", "population", "structure__level")
+        )
+        for area_id, parent_id, population, level in areas:
+            snapshot.add_area(area_id, parent_id, population)
+            if level == 1:
+                snapshot.root_id = area_id
+
+        supplements = Area.supplements.through.objects.filter(
+            from_area__country=country.id
+        ).values_list("from_area_id", "to_area_id")
+        for area_id, supplement_id in supplements:
+            snapshot.add_supplement(area_id, supplement_id)
+
+        declarations = (
+            Declaration.objects.filter(area__country=country.id)
+            .order_by("event_date", "id")
+            .values_list("area_id", "event_date", "status")
+        )
+        for area_id, event_date, status in declarations:
+            snapshot.add_event(area_id, event_date, status)
+
+        logger.info(
+            "loaded snapshot of %s areas for country %s"
+            % (len(snapshot.parent), country.id)
+        )
+        return snapshot
+
+    def add_area(self, area_id, parent_id, population):
+        """Add an area. Areas must be added in sibling order."""
+        self.population[area_id] = population
+        self.parent[area_id] = parent_id
+        self.children.setdefault(area_id, [])
+        if area_id != parent_id:
+            self.children.setdefault(parent_id, []).append(area_id)
+
+    def add_supplement(self, area_id, supplement_id):
+        self.supplements.setdefault(area_id, []).append(supplement_id)
+        self.supplementary_children.setdefault(supplement_id, []).append(area_id)
+
+    def add_event(self, area_id, event_date, status):
+        """Add a declaration event. Events must be added oldest first."""
+        self.events.setdefault(area_id, []).append((event_date, status))
+        self._event_dates.setdefault(area_id, []).append(event_date)
+
+    def timeline(self):
+        """Return all declaration events as (event_date, area_id, status),
+        oldest first. Events for an area keep the order they were added in."""
+        events = [
+            (event_date, area_id, status)
+            for area_id, area_events in self.events.items()
+            for event_date, status in area_events
+        ]
+        events.sort(key=lambda e: e[0])
+        return events
+
+    def is_agglomeration(self, area_id):
+        """Return true if any other area has this one as a supplementary parent."""
+        return bool(self.supplementary_children.get(area_id))
+
+    def status_at(self, area_id, date=None):
+        """Return the status of the latest declaration for an area at the given
+        date, or of its most recent declaration if no date is given."""
+        events = self.events.get(area_id)
+        if not events:
+            return None
+        if date is None:
+            return events[-1][1]
+        idx = bisect.bisect_right(self._event_dates[area_id], as_date(date))
+        if idx == 0:
+            return None
+        return events[idx - 1][1]
+
+    def is_declared_at(self, area_id, date=None):
+        return self.status_at(area_id, date) == "D"
+
+    def declared_ancestors(self, date=None):
+        """Return a dict of the ids of the declared ancestors of each area,
+        through both parent and supplementary parent links, at the given
+        date. Every area is visited once, after all of its parents."""
+        date = as_date(date)
+        waiting = {}
+        for area_id in self.parent:
+            parents = self.parents_of(area_id)
+            waiting[area_id] = len(parents)
+        queue = deque(a for a, n in waiting.items() if not n)
+        declared = {}
+        while queue:
+            area_id = queue.popleft()
+            ancestors = set()
+            for parent in self.parents_of(area_id):
+                ancestors |= declared[parent]
+                if self.is_declared_at(parent, date):
+                    ancestors.add(parent)
+            declared[area_id] = ancestors
+            for child in self.children_of(area_id):
+                waiting[child] -= 1
+                if not waiting[child]:
+                    queue.append(child)
+        if len(declared) < len(self.parent):
+            looped = sorted(set(self.parent) - set(declared))
+            logger.warning("areas %s are in a loop of parent links" % looped)
+            for area_id in looped:
+                declared[area_id] = set()
+        return declared
+
+    def parents_of(self, area_id):
+        """The parent and supplementary parents of an area in this snapshot."""
+        parents = [self.parent[area_id], *self.supplements.get(area_id, [])]
+        return [p for p in dict.fromkeys(parents) if p != area_id and p in self.parent]
+
+    def children_of(self, area_id):
+        """The direct and supplementary children of an area, each listed once."""
+        children = [
+            *self.children.get(area_id, []),
+            *self.supplementary_children.get(area_id, []),
+        ]
+        return [c for c in dict.fromkeys(children) if c != area_id]
+
+    def contributions(self, date=None):
+        """Return a dict of (number of declared ancestors, contribution) for
+        every area, as Area.num_declared_ancestors and Area.contribution."""
+        return {
+            area_id: (
+                len(ancestors),
+                contribution(
+                    self.population[area_id],
+                    self.is_declared_at(area_id, date),
+                    len(ancestors),
+                ),
+            )
+            for area_id, ancestors in self.declared_ancestors(date).items()
+        }
+
+    def declared_population(self, area_id, date=None):
+        """Count the declared population under an area at the given date.
+        This follows exactly the same rules as PopulationCounter."""
+        date = as_date(date)
+        count = []
+        declared_aggloms = set()
+        proxy_declared = {area_id: False}
+        queue = deque([area_id])
+        while queue:
+            this = queue.popleft()
+            is_agglom = self.is_agglomeration(this)
+            if this not in proxy_declared:
+                proxy_declared[this] = False
+                for parent in [*self.supplements.get(this, []), self.parent[this]]:
+                    if parent in declared_aggloms or self.is_declared_at(parent, date):
+                        proxy_declared[this] = True
+            would_count = proxy_declared[this] or self.is_declared_at(this, date)
+            if would_count and not is_agglom:
+                count.append(this)
+            if would_count and is_agglom:
+                declared_aggloms.add(this)
+            if not would_count or would_count and is_agglom:
+                queue.extend(self.children.get(this, []))
+
+        total = 0
+        for counted in count:
+            total += self.population[counted]
+
+        return total
+
+
+class SweepCounter:
+    """Incremental population counter which sweeps forward through time.
+
+    Rather than recounting the whole tree at every date, the counter keeps
+    the result of the traversal done by CountrySnapshot.declared_population
+    (which areas are visited, which would count, which are declared
+    agglomerations, and which are counted) and updates it as declarations
+    take effect. Only areas whose inputs have changed are re-evaluated.
+
+    This relies on the traversal being breadth-first over direct children:
+    pruning subtrees doesn't change the relative order of the remaining
+    areas, so each area's position in a full breadth-first walk of the tree
+    (its rank) tells us which areas the traversal would have already
+    processed when it reached it. Every area's state depends only on the
+    declaration inputs and on the state of areas with a lower rank, so
+    re-evaluating changed areas in rank order gives the same result as a
+    full recount."""
+
+    def __init__(self, snapshot, root_id=None):
+        self.snapshot = snapshot
+        self.root_id = root_id if root_id is not None else snapshot.root_id
+        self.rank = {}
+        queue = deque([self.root_id])
+        while queue:
+            area_id = queue.popleft()
+            self.rank[area_id] = len(self.rank)
+            queue.extend(snapshot.children.get(area_id, []))
+
+        self.declared = set()
+        self.visited = set(self.rank)
+        self.would_count = set()
+        self.declared_aggloms = set()
+        self.counted = set()
+        self.total = 0
+
+        self._timeline = snapshot.timeline()
+        self._next_event = 0
+        self.date = None
+
+    def get_state(self):
+        """Return the state of the count as a dict of plain lists, suitable for
+        saving in a checkpoint."""
+        return {
+            "date": self.date.isoformat() if self.date else None,
+            "declared": sorted(self.declared),
+            "proxy": sorted(self.would_count - self.declared),
+            "aggloms": sorted(self.declared_aggloms),
+            "total": self.total,
+        }
+
+    @classmethod
+    def restore(cls, snapshot, state, root_id=None):
+        """Create a counter from a saved state, ready to carry on counting
+        from the date it was saved at. Return None if the state doesn't
+        match the snapshot, in which case counting has to start afresh."""
+        counter = cls(snapshot, root_id)
+        declared = set(state["declared"])
+        would_count = declared | set(state["proxy"])
+        if not would_count.issubset(snapshot.parent):
+            return None
+
+        # which areas are visited follows from which areas would count
+        counter.declared = declared
+        counter.visited = set()
+        for area_id in counter.rank:
+            parent_id = snapshot.parent[area_id]
+            if area_id == counter.root_id or (
+                parent_id in counter.visited
+                and (
+                    parent_id not in counter.would_count
+                    or snapshot.is_agglomeration(parent_id)
+                )
+            ):
+                counter.visited.add(area_id)
+                if area_id in would_count:
+                    counter.would_count.add(area_id)
+        counter.declared_aggloms = set(
+            a for a in counter.would_count if snapshot.is_agglomeration(a)
+        )
+        counter.counted = counter.would_count - counter.declared_aggloms
+        counter.total = sum(snapshot.population[a] for a in counter.counted)
+        aggloms = set(state["aggloms"])
+        if counter.total != state["total"] or counter.declared_aggloms != aggloms:
+            return None
+
+        counter.date = as_date(state["date"])
+        while counter._next_event < len(counter._timeline):
+            if counter._timeline[counter._next_event][0] > counter.date:
+                break
+            counter._next_event += 1
+        return counter
+
+    def count(self, dates):
+        """Yield (date, declared population) for each of the given dates,
+        which must be in ascending order."""
+        for date in dates:
+            self.advance(date)
+            yield (date, self.total)
+
+    def advance(self, date):
+        """Bring the count up to date with all declarations made on or before
+        the given date."""
+        date = as_date(date)
+        changes = {}
+        while self._next_event < len(self._timeline):
+            event_date, area_id, status = self._timeline[self._next_event]
+            if event_date > date:
+                break
+            changes[area_id] = status == "D"
+            self._next_event += 1
+        self.date = date
+        self.apply(changes)
+        return self.total
+
+    def apply(self, changes):
+        """Apply a dict of area id to declared status, re-evaluating every
+        area affected by the change."""
+        heap = []
+        queued = set()
+
+        def push(area_id):
+            if area_id in self.rank and area_id not in queued:
+                heapq.heappush(heap, (self.rank[area_id], area_id))
+                queued.add(area_id)
+
+        supp_kids = self.snapshot.supplementary_children
+        for area_id, is_declared in changes.items():
+            if is_declared == (area_id in self.declared):
+                continue
+            if is_declared:
+                self.declared.add(area_id)
+            else:
+                self.declared.discard(area_id)
+            # the declared status of an area is looked at directly when
+            # evaluating it, its direct children and its supplementary children
+            push(area_id)
+            for child in self.snapshot.children.get(area_id, []):
+                push(child)
+            for child in supp_kids.get(area_id, []):
+                push(child)
+
+        while heap:
+            rank, area_id = heapq.heappop(heap)
+            if not self._evaluate(area_id):
+                continue
+            for child in self.snapshot.children.get(area_id, []):
+                push(child)
+            # supplementary children processed earlier in the traversal
+            # can't have seen this area as a declared agglomeration
+            for child in supp_kids.get(area_id, []):
+                if self.rank.get(child, -1) > rank:
+                    push(child)
+
+    def _evaluate(self, area_id):
+        """Recalculate the state of a single area from its parents' state.
+        Return true if anything its dependants rely on has changed."""
+        snapshot = self.snapshot
+        parent_id = snapshot.parent[area_id]
+        is_agglom = snapshot.is_agglomeration(area_id)
+        if area_id == self.root_id:
+            visited = True
+        else:
+            visited = parent_id in self.visited and (
+                parent_id not in self.would_count
+                or snapshot.is_agglomeration(parent_id)
+            )
+
+        would_count = False
+        if visited:
+            would_count = area_id in self.declared
+            if area_id != self.root_id and not would_count:
+                rank = self.rank[area_id]
+                for parent in [*snapshot.supplements.get(area_id, []), parent_id]:
+                    if parent in self.declared or (
+                        parent in self.declared_aggloms and self.rank[parent] < rank
+                    ):
+                        would_count = True
+                        break
+
+        changed = False
+        for state, value in (
+            (self.visited, visited),
+            (self.would_count, would_count),
+            (self.declared_aggloms, would_count and is_agglom),
+        ):
+            if value != (area_id in state):
+                changed = True
+                if value:
+                    state.add(area_id)
+                else:
+                    state.discard(area_id)
+
+        counted = would_count and not is_agglom
+        if counted and area_id not in self.counted:
+            self.counted.add(area_id)
+            self.total += snapshot.population[area_id]
+        elif not counted and area_id in self.counted:
+            self.counted.discard(area_id)
+            self.total -= snapshot.population[area_id]
+        return changed
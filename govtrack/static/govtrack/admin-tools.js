@@ -3,15 +3,18 @@
 var showing = {};
 $(document).ready(() => {
     $('button.view-structure').click(toggleEditOptions);
-    $('button.view-area').click(toggleEditOptions);
+    // area rows are added as the tree is expanded,
+    // so their handlers are attached to the document
+    $(document).on('click', 'button.view-area', toggleEditOptions);
+    $(document).on('click', 'button.expand-area', toggleBranch);
     $('a#do_update_popcount').click(triggerRecount);
     $('a#update_all_popcounts').click(triggerAllRecounts);
 
-    $('div.delete-link').click(deleteThis);
+    $(document).on('click', 'div.delete-link', deleteThis);
     $('a#bulk-edit-show').click(showBulkEdit);
     $('a#bulk-edit-hide').click(hideBulkEdit);
-    $('.bulk-edit-item').hover(highlightRow);
-    $('.bulk-edit-item').click(selectRow);
+    $(document).on('mouseenter mouseleave', '.bulk-edit-item', highlightRow);
+    $(document).on('click', '.bulk-edit-item', selectRow);
     $('a#bulk-edit-select-all').click(selectAll);
     $('a#bulk-edit-select-none').click(selectNone);
     $('a.create-subtree').click(createSubtree);
@@ -59,6 +62,8 @@ $(document).ready(() => {
     
     $('.inbox-paste textarea').bind('paste', pasteInbox);
     //setupBulkMove()
+
+    $('tr.expand-on-load button.expand-area').click();
 });
 
 /* the following method from https://docs.djangoproject.com/en/3.0/ref/csrf/#setting-the-token-on-the-ajax-request */
@@ -448,6 +453,74 @@ function showMultiAddForm(target_id) {
     return false;
 }
 
+/* AREA TREE FUNCTIONS */
+
+// show or hide the areas under an area, loading them from the api
+function toggleBranch(ev) {
+    var button = ev.target;
+    var row = $(button).closest('tr');
+    if (button.dataset.expanded == 'true') {
+        collapseBranch(row.data('area-id'));
+        button.dataset.expanded = 'false';
+        button.innerHTML = '+';
+        return false;
+    }
+    var apiUrl = button.dataset.url;
+    apiUrl += (apiUrl.indexOf('?') < 0 ? '?' : '&') + 'html=1';
+    button.disabled = true;
+    fetch(apiUrl, {credentials: 'same-origin'})
+        .then((response) => {
+            if (!response.ok) {
+                throw new Error(response.status);
+            }
+            return response.json();
+        })
+        .then((data) => {
+            row.after(branchRows(data));
+            button.dataset.expanded = 'true';
+            button.innerHTML = '-';
+            if ($('#bulk-edit-hide').css('display') == 'inline') {
+                $('.bulk-edit-item').css('visibility', 'visible');
+            }
+        })
+        .catch((error) => {
+            console.log(error);
+            alert("operation failed");
+        })
+        .finally(() => {
+            button.disabled = false;
+        });
+    return false;
+}
+
+// make table rows for the areas loaded under an area,
+// each followed by the rows under it if those were loaded too
+function branchRows(area) {
+    var rows = [];
+    (area.children || []).forEach(function(child) {
+        var childRow = $(child.html.trim()).filter('tr');
+        childRow.attr('data-branch-of', area.id);
+        rows.push(childRow);
+        if (child.children) {
+            childRow.find('button.expand-area').attr('data-expanded', 'true').html('-');
+            rows = rows.concat(branchRows(child));
+        }
+    });
+    return rows;
+}
+
+// remove the rows under an area, and any rows under those
+function collapseBranch(areaId) {
+    $('tr[data-branch-of="' + areaId + '"]').each(function(count, row) {
+        if (!$(row).hasClass('supplementary')) {
+            collapseBranch(row.dataset.areaId);
+        }
+        $(row).remove();
+    });
+}
+
+/* END AREA TREE */
+
 /* BULK AREA EDIT FUNCTIONS */
 
 function selectAll(ev) {
@@ -1,7 +1,39 @@
 from django.test import TestCase
+from django.core.signals import request_started
+from django.contrib.auth.models import User
 from django.urls import reverse
+from django.db import connection, transaction
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from django.core.management.base import CommandError
 
-from govtrack.models import Country, Structure, Area, Declaration
+from govtrack.models import (
+    Country,
+    CountrySummary,
+    Structure,
+    Area,
+    AreaClosure,
+    Declaration,
+    PopulationCounter,
+    PopCountCheckpoint,
+    ImportDeclaration,
+)
+from govtrack.declindex import DeclarationIndex
+from govtrack.identitymap import IdentityMap, task_scope
+from govtrack.inboximport import DateDetector
+from govtrack.invalidation import PendingRecounts
+from govtrack.popcount import CountrySnapshot, SweepCounter
+from govtrack.treebuilder import AreaBranch
+from govtrack.arraycount import ArrayCounter
+from govtrack import traversal
+from govtrack.integrity import TreeCheck, check_countries
+
+from unittest import mock
+import io
+import json
+import datetime
+import random
 
 
 class StructureTests(TestCase):
@@ -50,6 +82,8 @@ class AreaTests(TestCase):
 
         # After adding a new child, the number of descendant levels
         # should have gone up by 1
+        for area in [self.area_national, self.area_north, self.area_northwest]:
+            area.refresh_from_db()
         self.assertEqual(self.area_national.height, 3)
         self.assertEqual(self.area_north.height, 2)
         self.assertEqual(self.area_northwest.height, 1)
@@ -91,19 +125,763 @@ class AreaTests(TestCase):
         self.assertIs(tree_ok, True)
 
 
+class AreaClosureTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def links(self):
+        return set(
+            AreaClosure.objects.values_list("ancestor", "descendant", "depth", "direct")
+        )
+
+    def assertClosureCorrect(self):
+        links = self.links()
+        AreaClosure.rebuild(Country.objects.get(pk=1))
+        self.assertEqual(links, self.links())
+
+    def names(self, areas):
+        return sorted(a.name for a in areas)
+
+    def test_lookups(self):
+        area = Area.objects.get(pk=4)
+        with self.assertNumQueries(1):
+            self.assertEqual([a.id for a in area.direct_ancestors[1:]], [3, 1])
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.names(area.ancestors),
+                ["Erewhon", "South Region", "South-East Locality"],
+            )
+        root = Area.objects.get(pk=1)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(root.all_descendants), 4)
+        self.assertEqual(len(root.descendants), 4)
+
+    def test_maintained_by_changes(self):
+        self.assertClosureCorrect()
+        country = Country.objects.get(pk=1)
+        area = Area.objects.create(
+            name="South-East Village",
+            country=country,
+            parent_id=4,
+            structure_id=4,
+            population=100,
+        )
+        self.assertEqual([a.id for a in area.direct_ancestors], [area.id, 4, 3, 1])
+        self.assertClosureCorrect()
+
+        # moving an area moves its descendants too
+        south_east = Area.objects.get(pk=4)
+        south_east.parent_id = 2
+        south_east.save()
+        self.assertEqual([a.id for a in area.direct_ancestors], [area.id, 4, 2, 1])
+        self.assertClosureCorrect()
+
+        # supplementary parents are ancestors, but not direct ones
+        south = Area.objects.get(pk=3)
+        south_east.supplements.add(south)
+        self.assertIn(south, area.ancestors)
+        self.assertNotIn(south, area.direct_ancestors)
+        self.assertIn(area, south.all_descendants)
+        self.assertNotIn(area, south.descendants)
+        self.assertClosureCorrect()
+
+        south.supplement.remove(south_east)
+        self.assertNotIn(south, area.ancestors)
+        self.assertClosureCorrect()
+        south.supplement.add(south_east)
+        south.supplement.clear()
+        self.assertNotIn(south, area.ancestors)
+        self.assertClosureCorrect()
+
+        south_east.delete()
+        self.assertFalse(AreaClosure.objects.filter(descendant=area.id).exists())
+
+    def test_delete_supplementary_parent(self):
+        agglomeration = Area.objects.create(
+            name="South Agglomeration",
+            country_id=1,
+            parent_id=3,
+            structure_id=3,
+            agglomeration=True,
+        )
+        north_west = Area.objects.get(pk=5)
+        north_west.supplements.add(agglomeration)
+        indirect = AreaClosure.objects.filter(ancestor=3, descendant=5, direct=False)
+        self.assertTrue(indirect.exists())
+
+        agglomeration.delete()
+        self.assertEqual(list(north_west.supplements.all()), [])
+        self.assertFalse(indirect.exists())
+        self.assertClosureCorrect()
+
+    def test_rebuild_command(self):
+        AreaClosure.objects.all().delete()
+        call_command("rebuild_area_closure", "ERW", stdout=io.StringIO())
+        self.assertEqual(AreaClosure.objects.count(), 11)
+        self.assertEqual(
+            [a.id for a in Area.objects.get(pk=5).direct_ancestors], [5, 2, 1]
+        )
+
+
+class TreeFieldsTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def setUp(self):
+        self.country = Country.objects.get(pk=1)
+
+    def tree_fields(self, model):
+        return dict(
+            (item_id, (depth, height))
+            for item_id, depth, height in model.objects.values_list(
+                "id", "depth", "subtree_height"
+            )
+        )
+
+    def assertRepaired(self):
+        """The incrementally updated fields should need no repair."""
+        self.assertEqual(Structure.refresh_tree_fields(self.country), {})
+        self.assertEqual(Area.refresh_tree_fields(self.country), {})
+
+    def test_fixture_fields(self):
+        self.assertRepaired()
+        self.assertEqual(
+            self.tree_fields(Structure),
+            {1: (0, 3), 2: (1, 2), 3: (2, 1), 4: (3, 0)},
+        )
+        self.assertEqual(
+            self.tree_fields(Area),
+            {1: (0, 2), 2: (1, 1), 3: (1, 1), 4: (2, 0), 5: (2, 0)},
+        )
+
+    def test_height_without_queries(self):
+        structure = Structure.objects.get(pk=2)
+        area = Area.objects.get(pk=1)
+        with self.assertNumQueries(0):
+            self.assertEqual(structure.height, 2)
+            self.assertEqual(area.height, 2)
+
+    def test_add_area(self):
+        area = Area.objects.create(
+            name="Parkside",
+            country=self.country,
+            structure=Structure.objects.get(pk=4),
+            parent=Area.objects.get(pk=4),
+        )
+        self.assertEqual((area.depth, area.subtree_height), (3, 0))
+        fields = self.tree_fields(Area)
+        self.assertEqual(fields[4], (2, 1))
+        self.assertEqual(fields[3], (1, 2))
+        self.assertEqual(fields[1], (0, 3))
+        self.assertEqual(fields[2], (1, 1))
+        self.assertRepaired()
+
+    def test_move_subtree(self):
+        south = Area.objects.get(pk=3)
+        south.parent = Area.objects.get(pk=2)
+        south.save()
+        fields = self.tree_fields(Area)
+        self.assertEqual(fields[3], (2, 1))
+        self.assertEqual(fields[4], (3, 0))
+        self.assertEqual(fields[2], (1, 1))
+        self.assertRepaired()
+
+    def test_move_lowers_height(self):
+        southeast = Area.objects.get(pk=4)
+        southeast.parent = Area.objects.get(pk=2)
+        southeast.save()
+        fields = self.tree_fields(Area)
+        self.assertEqual(fields[3], (1, 0))
+        self.assertEqual(fields[4], (2, 0))
+        self.assertRepaired()
+
+    def test_change_structure(self):
+        southeast = Area.objects.get(pk=4)
+        southeast.structure = Structure.objects.get(pk=4)
+        southeast.save()
+        fields = self.tree_fields(Area)
+        self.assertEqual(fields[3], (1, 2))
+        self.assertEqual(fields[1], (0, 3))
+        self.assertRepaired()
+
+    def test_delete_area(self):
+        Area.objects.filter(pk__in=[4, 5]).delete()
+        fields = self.tree_fields(Area)
+        self.assertEqual(fields, {1: (0, 1), 2: (1, 0), 3: (1, 0)})
+        self.assertRepaired()
+
+    def test_stale_save_keeps_fields(self):
+        north = Area.objects.get(pk=2)
+        Area.objects.get(pk=5).delete()
+        north.name = "Northern Region"
+        north.save()
+        self.assertEqual(self.tree_fields(Area)[2], (1, 0))
+
+    def test_structures(self):
+        neighbourhood = Structure.objects.get(pk=4)
+        street = Structure.objects.create(
+            name="Street Committee",
+            country=self.country,
+            level=5,
+            parent=neighbourhood,
+        )
+        self.assertEqual((street.depth, street.subtree_height), (4, 0))
+        self.assertEqual(self.tree_fields(Structure)[1], (0, 4))
+        self.assertRepaired()
+
+        Structure.objects.get(pk=3).delete()
+        self.assertEqual(self.tree_fields(Structure), {1: (0, 1), 2: (1, 0)})
+        self.assertRepaired()
+
+    def test_structure_level(self):
+        local = Structure.objects.get(pk=3)
+        local.level = 4
+        local.save()
+        fields = self.tree_fields(Area)
+        self.assertEqual(fields[2], (1, 2))
+        self.assertEqual(fields[1], (0, 3))
+        self.assertRepaired()
+
+    def test_repair_command(self):
+        Area.objects.update(depth=0, subtree_height=0)
+        out = io.StringIO()
+        call_command("repair_tree_fields", "ERW", stdout=out)
+        self.assertIn("ERW: repaired 0 structures and 5 areas", out.getvalue())
+        self.assertEqual(self.tree_fields(Area)[1], (0, 2))
+        with self.assertRaises(CommandError):
+            call_command("repair_tree_fields", "XXX", stdout=out)
+
+
+class TraversalTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def setUp(self):
+        # 1 has children 2 and 3, and 3 has children 4 and 5
+        self.parents = {1: 1, 2: 1, 3: 1, 4: 3, 5: 3}
+        self.children = traversal.children_map(self.parents.items())
+
+    def test_orders(self):
+        self.assertEqual(self.children, {1: [2, 3], 3: [4, 5]})
+        self.assertEqual(traversal.bfs(self.children, 1), [1, 2, 3, 4, 5])
+        self.assertEqual(traversal.dfs(self.children, 1), [1, 2, 3, 4, 5])
+        self.assertEqual(traversal.dfs(self.children, 3), [3, 4, 5])
+        self.assertEqual(traversal.levels(self.children, 1), [[1], [2, 3], [4, 5]])
+        self.assertEqual(
+            traversal.group_by_level([1, 2, 3, 4, 5], lambda n: n % 2),
+            {1: [1, 3, 5], 0: [2, 4]},
+        )
+
+    def test_ancestor_path(self):
+        self.assertEqual(traversal.ancestor_path(self.parents, 5), [1, 3, 5])
+        self.assertEqual(traversal.ancestor_path(self.parents, 1), [1])
+        with self.assertRaises(traversal.CycleError) as cm:
+            traversal.ancestor_path({1: 2, 2: 3, 3: 2}, 1)
+        self.assertEqual(cm.exception.cycle, [2, 3])
+
+    def test_find_cycles(self):
+        self.assertEqual(traversal.find_cycles(self.children), [])
+        graph = {1: [1, 2], 2: [3], 3: [2, 4], 4: [5], 5: [4, 6], 6: []}
+        self.assertEqual(sorted(traversal.find_cycles(graph)), [[2, 3], [4, 5]])
+
+    def test_deep_tree(self):
+        size = 20000
+        parents = {i: max(i - 1, 0) for i in range(size)}
+        children = traversal.children_map(parents.items())
+        self.assertEqual(len(traversal.dfs(children, 0)), size)
+        self.assertEqual(len(traversal.bfs(children, 0)), size)
+        self.assertEqual(len(traversal.ancestor_path(parents, size - 1)), size)
+        children[size - 1] = [0]
+        self.assertEqual(len(traversal.find_cycles(children)[0]), size)
+
+    def test_deep_structures(self):
+        # deeper than the recursion limit would allow
+        depth = 1500
+        Structure.objects.bulk_create(
+            Structure(
+                id=100 + i,
+                name="Level %s" % i,
+                country_id=1,
+                level=5 + i,
+                parent_id=(99 + i) if i else 4,
+            )
+            for i in range(depth)
+        )
+        deepest = Structure.objects.get(pk=99 + depth)
+        self.assertEqual([s.id for s in deepest.ancestors[:5]], [1, 2, 3, 4, 100])
+        self.assertEqual(len(deepest.ancestors), depth + 4)
+        national = Structure.objects.get(pk=1)
+        self.assertEqual(len(national.descendants), depth + 3)
+        self.assertEqual(len(national.bfs()), depth + 4)
+        self.assertEqual(len(national.build_hierarchy()), depth + 4)
+
+    def test_bulk_move_form(self):
+        response = self.client.post(
+            reverse("bulkarea_edit", args=[1]),
+            {"area_id_str": "2:3:4", "action": "move"},
+        )
+        self.assertEqual(
+            [
+                (a["id"], a["height"], [d.id for d in a["descendants"]])
+                for a in response.context["area_list"]
+            ],
+            [(2, 1, [5]), (3, 0, []), (4, 0, [])],
+        )
+        self.assertEqual(response.context["child_levels"], 1)
+
+
+class TreeIntegrityTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def setUp(self):
+        self.country = Country.objects.get(pk=1)
+
+    def problems(self):
+        report = TreeCheck.load(self.country).run()
+        return sorted((p["check"], p["model"], p["id"]) for p in report["problems"])
+
+    def test_fixture_ok(self):
+        report = TreeCheck.load(self.country).run()
+        self.assertEqual(report["ok"], True)
+        self.assertEqual(report["structures"], 4)
+        self.assertEqual(report["areas"], 5)
+        self.assertIs(Area.objects.get(pk=1).check_tree_integrity(), True)
+
+    def test_load_queries(self):
+        countries = list(Country.objects.all())
+        with self.assertNumQueries(3):
+            check_countries(countries)
+
+    def test_wrong_level(self):
+        Area.objects.filter(pk=5).update(parent_id=4)
+        self.assertEqual(
+            self.problems(),
+            [("level", "area", 5), ("structure_parent", "area", 5)],
+        )
+        self.assertIs(Area.objects.get(pk=3).check_tree_integrity(), False)
+        self.assertIs(Area.objects.get(pk=2).check_tree_integrity(), True)
+
+    def test_self_parent(self):
+        Area.objects.filter(pk=3).update(parent_id=3)
+        self.assertEqual(
+            self.problems(),
+            [("orphan", "area", 4), ("self_parent", "area", 3)],
+        )
+
+    def test_cycles(self):
+        Area.objects.filter(pk=2).update(parent_id=5)
+        Structure.objects.filter(pk=4).update(parent_id=4, level=1)
+        self.assertEqual(
+            self.problems(),
+            [
+                ("cycle", "area", 2),
+                ("level", "area", 2),
+                ("root", "structure", None),
+                ("structure_parent", "area", 2),
+            ],
+        )
+
+    def test_supplement_cycle(self):
+        Area.supplements.through.objects.bulk_create(
+            [Area.supplements.through(from_area_id=2, to_area_id=5)]
+        )
+        self.assertEqual(self.problems(), [("cycle", "area", 2)])
+
+    def test_orphan_structure(self):
+        other = Country.objects.create(country_code="OTH", name="Other")
+        Structure.objects.create(
+            id=50, name="Other National", country=other, level=1, parent_id=50
+        )
+        Area.objects.filter(pk=5).update(structure_id=50)
+        self.assertEqual(self.problems(), [("structure", "area", 5)])
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command("check_tree_integrity", "--workers", "1", stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report["ok"], True)
+        self.assertEqual([c["country"] for c in report["countries"]], ["ERW"])
+
+        Area.objects.filter(pk=3).update(parent_id=3)
+        out = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command("check_tree_integrity", "ERW", "--workers", "1", stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(len(report["countries"][0]["problems"]), 2)
+
+    def test_api(self):
+        url = reverse("api_country_tree_integrity", args=["ERW"])
+        self.assertEqual(self.client.get(url).status_code, 403)
+        user = User.objects.create_user("checker")
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(url).json()["ok"], True)
+        response = self.client.get(reverse("api_tree_integrity"))
+        self.assertEqual(response.json()["countries"][0]["areas"], 5)
+
+
+class AreaBranchTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def setUp(self):
+        IdentityMap.clear()
+        DeclarationIndex.clear()
+
+    def get_tree(self, area_id, **params):
+        response = self.client.get(reverse("api_area_tree", args=[area_id]), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def flatten(self, row):
+        rows = [(row["id"], row["is_supplementary"], row["indent_level"])]
+        for child in row.get("children", []):
+            rows.extend(self.flatten(child))
+        return rows
+
+    def add_areas(self, parent_id, num):
+        parent = Area.objects.get(pk=parent_id)
+        for i in range(num):
+            Area.objects.create(
+                name="%s %s" % (parent.name, i),
+                country=parent.country,
+                parent=parent,
+                structure_id=parent.structure_id + 1,
+                population=10,
+            )
+
+    def test_one_level(self):
+        tree = self.get_tree(1)
+        self.assertEqual(tree["id"], 1)
+        self.assertEqual(tree["num_children"], 2)
+        self.assertEqual([c["id"] for c in tree["children"]], [2, 3])
+        self.assertTrue(all("children" not in c for c in tree["children"]))
+        self.assertNotIn("html", tree)
+
+    def test_matches_build_hierarchy(self):
+        # the fixture areas have no sort names, so would be in no fixed order
+        Area.objects.update(sort_name=F("name"))
+        Area.objects.get(pk=5).supplements.add(Area.objects.get(pk=3))
+        Area.objects.get(pk=4).supplements.add(Area.objects.get(pk=2))
+        tree = self.get_tree(1, depth=3)
+        self.assertEqual(
+            self.flatten(tree),
+            [
+                (a.id, a.is_supplementary, a.indent_level)
+                for a in Area.objects.get(pk=1).build_hierarchy()
+            ],
+        )
+        self.assertEqual(self.get_tree(3)["num_supplementary_children"], 1)
+
+    def test_structure_hierarchy(self):
+        country = Country.objects.get(pk=1)
+        root = country.get_root_structure()
+        self.assertEqual(
+            [s.id for s in AreaBranch(country).tree.structure_hierarchy(root)],
+            [s.id for s in root.build_hierarchy()],
+        )
+
+    def test_country_page_queries(self):
+        url = reverse("country", args=[1])
+        # the first request also caches content types
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as before:
+            self.client.get(url)
+        self.add_areas(4, 10)
+        self.add_areas(5, 10)
+        with CaptureQueriesContext(connection) as after:
+            response = self.client.get(url)
+        self.assertEqual(len(after.captured_queries), len(before.captured_queries))
+        # rows under the root area are loaded as they are expanded
+        self.assertNotContains(response, "North-West Locality 9")
+        self.assertContains(response, reverse("api_area_tree", args=[1]))
+
+    def test_depth(self):
+        self.assertEqual(len(self.flatten(self.get_tree(1, depth=2))), 5)
+        self.assertEqual(self.get_tree(1, depth=99), self.get_tree(1, depth=3))
+        response = self.client.get(reverse("api_area_tree", args=[1]), {"depth": "x"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_declared(self):
+        declared = {a.id: a.is_declared for a in Area.objects.filter(country=1)}
+        tree = self.get_tree(1, depth=2)
+        rows = [tree, *tree["children"]]
+        rows.extend(g for c in tree["children"] for g in c["children"])
+        self.assertEqual({r["id"]: r["is_declared"] for r in rows}, declared)
+
+    def test_constant_queries(self):
+        url = reverse("api_area_tree", args=[2])
+        self.client.get(url, {"html": 1})
+        with CaptureQueriesContext(connection) as before:
+            self.client.get(url, {"html": 1})
+        parent = Area.objects.get(pk=2)
+        for i in range(10):
+            Area.objects.create(
+                name="Extra %s" % i,
+                country=parent.country,
+                parent=parent,
+                structure_id=parent.structure_id + 1,
+                population=10,
+            )
+        IdentityMap.clear()
+        with CaptureQueriesContext(connection) as after:
+            tree = self.get_tree(2, html=1)
+        self.assertEqual(len(after.captured_queries), len(before.captured_queries))
+        self.assertEqual(len(tree["children"]), parent.num_children)
+        self.assertIn("Extra 9", tree["children"][-1]["html"])
+
+
+class AreaApiTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def get_areas(self, path="/api/area/", **params):
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_list(self):
+        Area.objects.get(pk=5).supplements.add(Area.objects.get(pk=3))
+        page = self.get_areas()
+        self.assertIsNone(page["next"])
+        self.assertEqual([a["id"] for a in page["results"]], [1, 2, 3, 4, 5])
+        for row in page["results"]:
+            area = Area.objects.get(pk=row["id"])
+            self.assertEqual(row["num_children"], area.num_children)
+            self.assertEqual(row["supplements"], [s.id for s in area.supplements.all()])
+            self.assertEqual(row["parent"], area.parent_id)
+
+    def test_pages(self):
+        page = self.get_areas(page_size=2)
+        ids = [a["id"] for a in page["results"]]
+        while page["next"]:
+            page = self.get_areas(page["next"])
+            ids.extend(a["id"] for a in page["results"])
+        self.assertEqual(ids, [1, 2, 3, 4, 5])
+
+    def test_filters(self):
+        self.assertEqual(
+            [a["id"] for a in self.get_areas(structure=3)["results"]], [4, 5]
+        )
+        self.assertEqual([a["id"] for a in self.get_areas(parent=3)["results"]], [4])
+        self.assertEqual(len(self.get_areas(country=1)["results"]), 5)
+        self.assertEqual(self.get_areas(country=99)["results"], [])
+        response = self.client.get("/api/area/", {"country": "xx"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_children(self):
+        page = self.get_areas("/api/area/1/children/")
+        self.assertEqual([a["id"] for a in page["results"]], [2, 3])
+        self.assertEqual(self.client.get("/api/area/99/children/").status_code, 404)
+
+    def test_constant_queries(self):
+        with CaptureQueriesContext(connection) as before:
+            self.get_areas()
+        parent = Area.objects.get(pk=4)
+        for i in range(10):
+            area = Area.objects.create(
+                name="Extra %s" % i,
+                country=parent.country,
+                parent=parent,
+                structure_id=parent.structure_id + 1,
+                population=10,
+            )
+            area.supplements.add(parent)
+        with CaptureQueriesContext(connection) as after:
+            page = self.get_areas()
+        self.assertEqual(len(after.captured_queries), len(before.captured_queries))
+        self.assertEqual(page["results"][3]["num_children"], 10)
+
+
+class StructureApiTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def get_structures(self, path="/api/structures/", **params):
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_list(self):
+        page = self.get_structures()
+        self.assertEqual([s["id"] for s in page["results"]], [1, 2, 3, 4])
+        for row in page["results"]:
+            structure = Structure.objects.get(pk=row["id"])
+            self.assertEqual(row["height"], structure.height)
+            self.assertEqual(row["num_children"], structure.num_children)
+            self.assertEqual(
+                [c["id"] for c in row["children"]],
+                [c.id for c in structure.children],
+            )
+            for child in row["children"]:
+                self.assertEqual(
+                    child["num_children"],
+                    Structure.objects.get(pk=child["id"]).num_children,
+                )
+        detail = self.get_structures("/api/structures/2/")
+        self.assertEqual(detail, page["results"][1])
+
+    def test_filter(self):
+        self.assertEqual(len(self.get_structures(country=1)["results"]), 4)
+        self.assertEqual(self.get_structures(country=99)["results"], [])
+        response = self.client.get("/api/structures/", {"country": "xx"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_constant_queries(self):
+        with CaptureQueriesContext(connection) as before:
+            self.get_structures()
+        parent = Structure.objects.get(pk=2)
+        for i in range(5):
+            Structure.objects.create(
+                name="Extra %s" % i,
+                country=parent.country,
+                parent=parent,
+                level=parent.level + 1,
+            )
+        with CaptureQueriesContext(connection) as after:
+            page = self.get_structures()
+        self.assertEqual(len(after.captured_queries), len(before.captured_queries))
+        self.assertEqual(page["results"][1]["num_children"], 6)
+
+
+class ContributionTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def setUp(self):
+        IdentityMap.clear()
+        DeclarationIndex.clear()
+        for area_id in [1, 2, 3]:
+            Declaration.objects.create(
+                area_id=area_id, status="D", event_date="2020-3-%s" % area_id
+            )
+        Area.objects.get(pk=4).supplements.add(Area.objects.get(pk=2))
+        Declaration.objects.create(area_id=3, status="V", event_date="2020-4-1")
+
+    def test_matches_areas(self):
+        country = Country.objects.get(pk=1)
+        for date in [None, "2020-3-2", "2020-3-15"]:
+            contributions = CountrySnapshot.load(country).contributions(date)
+            for area in Area.objects.filter(country=country):
+                num_declared = area.num_declared_ancestors(date)
+                self.assertEqual(contributions[area.id][0], num_declared)
+            if date is None:
+                self.assertEqual(
+                    contributions,
+                    {
+                        a.id: (a.num_declared_ancestors(), a.contribution())
+                        for a in Area.objects.filter(country=country)
+                    },
+                )
+                # area 3 has revoked, but areas 1 and 2 are declared
+                self.assertEqual(contributions[4], (2, -100000))
+
+    def test_country_area_data(self):
+        url = reverse("api_country_area_data", args=["ERW"])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        rows = [
+            self.client.get(reverse("api_area_data", args=[a.id])).content.decode()
+            for a in Area.objects.filter(country=1).order_by("structure", "sort_name")
+        ]
+        self.assertEqual(response.content.decode(), "".join(rows))
+
+        with CaptureQueriesContext(connection) as before:
+            self.client.get(url)
+        parent = Area.objects.get(pk=3)
+        for i in range(5):
+            area = Area.objects.create(
+                name="Extra %s" % i,
+                country=parent.country,
+                parent=parent,
+                structure_id=parent.structure_id + 1,
+                population=10,
+            )
+            Declaration.objects.create(area=area, status="D", event_date="2020-5-1")
+        with CaptureQueriesContext(connection) as after:
+            self.client.get(url)
+        self.assertEqual(len(after.captured_queries), len(before.captured_queries))
+
+
+class IdentityMapTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def setUp(self):
+        # the map outlives the transaction each test runs in
+        IdentityMap.clear()
+
+    def test_shared_structures(self):
+        areas = list(Area.objects.filter(pk__in=[2, 3, 4, 5]))
+        with self.assertNumQueries(2):
+            levels = [area.level for area in areas]
+        self.assertEqual(levels, [2, 2, 3, 3])
+        with self.assertNumQueries(0):
+            [area.indent_level for area in areas]
+            [area.structure.name for area in areas]
+        self.assertIs(areas[0].structure, areas[1].structure)
+
+    def test_get_many(self):
+        IdentityMap.get(Area, 1)
+        with self.assertNumQueries(1):
+            found = IdentityMap.get_many(Area, [1, 2, 3, 99])
+        self.assertEqual(sorted(found), [1, 2, 3])
+        self.assertIs(found[1], IdentityMap.get(Area, 1))
+
+    def test_forget_on_save(self):
+        structure = IdentityMap.get(Structure, 3)
+        Structure.objects.get(pk=3).save()
+        self.assertIsNot(IdentityMap.get(Structure, 3), structure)
+
+    def test_forget_after_bulk_update(self):
+        area = IdentityMap.get(Area, 4)
+        moved = Area.objects.get(pk=3)
+        moved.parent = Area.objects.get(pk=2)
+        moved.save()
+        self.assertIsNot(IdentityMap.get(Area, 4), area)
+        self.assertEqual(IdentityMap.get(Area, 4).depth, 3)
+
+    def test_declarations_share_area(self):
+        Declaration.objects.create(area_id=4, status="V", event_date="2020-6-1")
+        decs = list(Declaration.objects.filter(area=4))
+        DeclarationIndex.for_country(1)
+        with self.assertNumQueries(1):
+            active = [dec.is_active_at_date("2020-3-1") for dec in decs]
+        self.assertEqual(active, [True, True])
+
+    def test_memoized_counts(self):
+        area = Area.objects.get(pk=1)
+        with self.assertNumQueries(2):
+            self.assertEqual(area.num_children, 2)
+            self.assertEqual(area.num_children, 2)
+            self.assertEqual(area.num_supplementary_children, 0)
+            self.assertEqual(area.num_supplementary_children, 0)
+
+    def test_cleared_by_request_and_task(self):
+        area = IdentityMap.get(Area, 1)
+        self.client.get(reverse("countries"))
+        self.assertIsNot(IdentityMap.get(Area, 1), area)
+        area = IdentityMap.get(Area, 1)
+        with task_scope():
+            self.assertIsNot(IdentityMap.get(Area, 1), area)
+
+
 class DeclarationTests(TestCase):
 
     fixtures = ["testdata"]
 
     def setUp(self):
-        pass
+        PendingRecounts.clear()
 
     def test_declaration_changed(self):
         dec = Declaration.objects.get(pk=1)
         self.assertIs(dec.area.country.is_popcount_needed, False)
-        dec.event_date = "2020-01-15"
-        dec.save()
-        self.assertIs(dec.area.country.is_popcount_needed, True)
+        with self.captureOnCommitCallbacks(execute=True):
+            dec.event_date = "2020-01-15"
+            dec.save()
+            # the country is only marked when the transaction commits
+            self.assertIs(Country.objects.get(pk=1).is_popcount_needed, False)
+        self.assertIs(Country.objects.get(pk=1).is_popcount_needed, True)
 
     def test_delete_declaration(self):
         dec = Declaration.objects.get(pk=1)
@@ -122,3 +900,980 @@ class DeclarationTests(TestCase):
         except:
             nw = None
         self.assertIs(nw, None)
+
+
+class DeclarationIndexTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def setUp(self):
+        # indexes outlive the rollback at the end of each test
+        DeclarationIndex.clear()
+        self.country = Country.objects.get(pk=1)
+
+    def test_status_lookups(self):
+        areas = list(Area.objects.filter(country=self.country).order_by("id"))
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                [a.is_declared_at("2020-01-15") for a in areas],
+                [False, False, False, True, False],
+            )
+            self.assertEqual(
+                [a.is_declared for a in areas], [False, False, False, True, True]
+            )
+            self.assertEqual(areas[4].latest_declaration.pk, 2)
+            self.assertIsNone(areas[0].latest_declaration)
+        self.assertIs(areas[3].is_declared_at("not a date"), False)
+
+    def test_invalidated_by_changes(self):
+        area = Area.objects.get(pk=4)
+        self.assertIs(area.is_declared, True)
+        revoked = Declaration.objects.create(
+            area=area, status="V", event_date=datetime.date(2020, 3, 1)
+        )
+        self.assertIs(area.is_declared, False)
+        self.assertIs(area.is_declared_at("2020-02-29"), True)
+        revoked.delete()
+        self.assertIs(area.is_declared, True)
+
+    def test_active_declarations(self):
+        area = Area.objects.get(pk=4)
+        Declaration.objects.create(
+            area=area, status="V", event_date=datetime.date(2020, 3, 1)
+        )
+        redeclared = Declaration.objects.create(
+            area=area, status="D", event_date=datetime.date(2020, 4, 1)
+        )
+
+        def active_at(date):
+            return [dec.pk for dec in self.country.active_declarations(date=date)]
+
+        self.assertEqual(active_at(datetime.date(2020, 1, 1)), [])
+        self.assertEqual(active_at(datetime.date(2020, 2, 15)), [1, 2])
+        self.assertEqual(active_at(datetime.date(2020, 3, 15)), [2])
+        self.assertEqual(active_at(datetime.date(2020, 5, 1)), [2, redeclared.pk])
+
+        dec = Declaration.objects.get(pk=1)
+        self.assertIs(dec.is_active_at_date(datetime.date(2020, 3, 1)), True)
+        self.assertIs(dec.is_active_at_date(datetime.date(2020, 3, 2)), False)
+
+
+class ActiveDeclarationTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def add_country(self, code, pk):
+        country = Country.objects.create(name=code, country_code=code)
+        structure = Structure.objects.create(
+            pk=pk, parent_id=pk, name=code, country=country, level=1
+        )
+        area = Area.objects.create(
+            pk=pk,
+            parent_id=pk,
+            name=code,
+            country=country,
+            structure=structure,
+            population=10,
+        )
+        Declaration.objects.create(
+            area=area, status="D", event_date=datetime.date(2020, 1, 1)
+        )
+        return country
+
+    def test_matches_per_declaration_check(self):
+        area = Area.objects.get(pk=4)
+        for status, day in [("V", 3), ("D", 5), ("D", 5), ("N", 9)]:
+            Declaration.objects.create(
+                area=area, status=status, event_date=datetime.date(2020, 2, day)
+            )
+        for day in range(1, 12):
+            date = datetime.date(2020, 2, day)
+            expected = {}
+            for dec in Declaration.objects.filter(
+                status="D", event_date__lt=date
+            ).order_by("event_date", "id"):
+                if dec.is_active_at_date(date):
+                    expected[dec.area_id] = dec.pk
+            active = Declaration.active_at(date)
+            self.assertEqual(sorted(d.pk for d in active), sorted(expected.values()))
+
+    def test_index_queries(self):
+        url = reverse("index")
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertContains(response, "South-East Locality")
+
+        for pk, code in enumerate(["AAA", "BBB", "CCC"], 100):
+            self.add_country(code, pk)
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(
+            [c["name"] for c, dlist in response.context["countries"]],
+            ["AAA", "BBB", "CCC", "Erewhon"],
+        )
+        self.assertEqual(response.context["countries"][3][0]["num_areas"], 2)
+
+        self.assertEqual(Country.active_declaration_counts()[1], 2)
+
+
+class AreaImportTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def setUp(self):
+        PendingRecounts.clear()
+        IdentityMap.clear()
+        self.client.force_login(User.objects.create_user("importer"))
+        self.url = reverse("api_area_multi_add", args=[3, 3])
+
+    def post(self, data, **kwargs):
+        return self.client.post(
+            self.url, data, HTTP_ACCEPT="application/json", **kwargs
+        ).json()
+
+    def test_paste(self):
+        paste = "\n".join(
+            [
+                "Southport|12,000|http://southport.example|http://sp.example",
+                "",
+                "Eastbury|abc",
+                "x" * 65 + "|100",
+                "Westbury|300|" + "u" * 1100,
+            ]
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            report = self.post({"area_csv_data": paste})
+        self.assertEqual((report["created"], report["links"]), (3, 2))
+        self.assertEqual([e["line"] for e in report["errors"]], [4, 5])
+        self.assertIn("name", report["errors"][0]["errors"])
+        self.assertEqual(list(report["errors"][1]["errors"]), ["links"])
+
+        southport = Area.objects.get(name="Southport")
+        self.assertEqual(southport.population, 12000)
+        self.assertEqual(Area.objects.get(name="Eastbury").population, 0)
+        self.assertEqual(southport.sort_name, "Southport")
+        self.assertEqual(
+            sorted(link.url for link in southport.links.all()),
+            ["http://southport.example", "http://sp.example"],
+        )
+        self.assertEqual(sorted(southport.direct_ancestor_ids()), [1, 3, southport.id])
+        self.assertEqual(
+            {a.id for a in Area.objects.get(pk=3).descendants},
+            {
+                4,
+                *Area.objects.filter(name__endswith="bury").values_list(
+                    "id", flat=True
+                ),
+            }
+            | {southport.id},
+        )
+        self.assertEqual(CountrySummary.objects.get(country=1).num_areas, 8)
+        self.assertTrue(Country.objects.get(pk=1).is_popcount_needed)
+        self.assertEqual(TreeCheck.load(Country.objects.get(pk=1)).run()["ok"], True)
+        repair = io.StringIO()
+        call_command("repair_tree_fields", stdout=repair)
+        self.assertIn("repaired 0 structures and 0 areas", repair.getvalue())
+
+    def test_csv_upload(self):
+        upload = io.BytesIO(
+            b'"Northgate","1,500",http://northgate.example\r\n"Multi\nLine",7\r\n'
+        )
+        upload.name = "areas.csv"
+        report = self.post({"area_csv_file": upload})
+        self.assertEqual((report["created"], report["links"]), (2, 1))
+        self.assertEqual(Area.objects.get(name="Northgate").population, 1500)
+        self.assertEqual(Area.objects.get(name="Multi\nLine").population, 7)
+
+    def test_wrong_structure(self):
+        url = reverse("api_area_multi_add", args=[3, 4])
+        report = self.client.post(
+            url, {"area_csv_data": "Nowhere|1"}, HTTP_ACCEPT="application/json"
+        ).json()
+        self.assertEqual(report["created"], 0)
+        self.assertIn("__all__", report["errors"][0]["errors"])
+        self.assertFalse(Area.objects.filter(name="Nowhere").exists())
+
+    def test_messages(self):
+        response = self.client.post(
+            self.url, {"area_csv_data": "Southport|1\n%s|1" % ("x" * 65)}, follow=True
+        )
+        self.assertContains(response, "Created 1 areas with 0 links")
+        self.assertContains(response, "line 2")
+
+    def test_constant_queries(self):
+        def paste(num):
+            return "\n".join(
+                "Area %s|%s|http://%s.example" % (i, i, i) for i in range(num)
+            )
+
+        with CaptureQueriesContext(connection) as queries:
+            self.post({"area_csv_data": paste(300)})
+        # sqlite splits inserts into more batches than it needs to elsewhere,
+        # but nothing is done a row at a time
+        self.assertLess(len(queries.captured_queries), 30)
+        self.assertEqual(Area.objects.filter(name__startswith="Area ").count(), 300)
+
+
+class InboxImportTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def setUp(self):
+        IdentityMap.clear()
+        self.client.force_login(User.objects.create_user("importer"))
+        self.url = reverse("api_import_declaration_multi_add", args=[1])
+
+    def post(self, data, **kwargs):
+        return self.client.post(
+            self.url, data, HTTP_ACCEPT="application/json", **kwargs
+        ).json()
+
+    def test_date_detector(self):
+        dates = DateDetector()
+        self.assertEqual(dates.parse("3 Mar, 2020"), datetime.date(2020, 3, 3))
+        self.assertEqual(dates.last[0], "%d %b, %Y")
+        self.assertEqual(dates.parse("4 March 2020"), datetime.date(2020, 3, 4))
+        self.assertEqual(dates.parse("2020-03-05"), datetime.date(2020, 3, 5))
+        self.assertEqual(dates.parse("06-03-2020"), datetime.date(2020, 3, 6))
+        self.assertEqual(dates.last[0], "%d-%m-%Y")
+        with self.assertRaises(ValueError):
+            dates.parse("31-02-2020")
+        with self.assertRaises(ValueError):
+            dates.parse("soon")
+
+    def test_paste(self):
+        before = ImportDeclaration.objects.count()
+        inbox_count = CountrySummary.objects.get(country=1).inbox_count
+        paste = "\n".join(
+            [
+                "Southport|1|Southport|12,000|1 Mar 2020|2030|mayor|http://s.example",
+                "",
+                "Eastbury|1|Eastbury|500|sometime|2030||",
+                "Westbury|1|Westbury",
+                "Northgate|-5|Northgate|7|2020-03-02|||",
+                "Upton|2|Upton|1,500|2 March 2020|||http://u.example",
+            ]
+        )
+        report = self.post({"paste_data": paste})
+        self.assertEqual(report["created"], 2)
+        self.assertEqual([e["line"] for e in report["errors"]], [3, 4, 5])
+        self.assertEqual(list(report["errors"][0]["errors"]), ["date"])
+        self.assertEqual(list(report["errors"][1]["errors"]), ["__all__"])
+        self.assertEqual(list(report["errors"][2]["errors"]), ["num_govs"])
+
+        self.assertEqual(ImportDeclaration.objects.count(), before + 2)
+        southport = ImportDeclaration.objects.get(name="Southport")
+        self.assertEqual(southport.population, 12000)
+        self.assertEqual(southport.date, datetime.date(2020, 3, 1))
+        self.assertEqual(southport.link, "http://s.example")
+        self.assertEqual(
+            ImportDeclaration.objects.get(name="Upton").date,
+            datetime.date(2020, 3, 2),
+        )
+        self.assertEqual(
+            CountrySummary.objects.get(country=1).inbox_count, inbox_count + 2
+        )
+
+    def test_file_upload(self):
+        upload = io.BytesIO(b"Southport|1|Southport|100|2020-03-01|||\r\n")
+        upload.name = "inbox.txt"
+        report = self.post({"paste_file": upload})
+        self.assertEqual(report, {"created": 1, "errors": []})
+
+    def test_messages(self):
+        response = self.client.post(
+            self.url, {"paste_data": "Southport|1|Southport|100|soon|||"}, follow=True
+        )
+        self.assertRedirects(response, reverse("inbox", args=[1]))
+        self.assertContains(response, "Added 0 declarations to the inbox")
+        self.assertContains(response, "no valid date format found")
+
+    def test_not_logged_in(self):
+        self.client.logout()
+        response = self.client.post(self.url, {"paste_data": ""})
+        self.assertEqual(response.status_code, 403)
+
+    def test_constant_queries(self):
+        line = "Area %s|1|Area|100|1 Mar 2020|||"
+        with CaptureQueriesContext(connection) as small:
+            self.post({"paste_data": "\n".join(line % i for i in range(2))})
+        with CaptureQueriesContext(connection) as large:
+            self.post({"paste_data": "\n".join(line % i for i in range(40))})
+        self.assertEqual(len(small), len(large))
+
+    def test_command(self):
+        out = io.StringIO()
+        with mock.patch(
+            "sys.stdin",
+            mock.Mock(buffer=io.BytesIO(b"A|1|A|1|1 Mar 2020|||\nB|x|B|1|||||\n")),
+        ):
+            call_command("import_inbox", "ERW", "-", stdout=out)
+        self.assertIn(
+            "Added 1 declarations to the inbox for ERW, rejected 1", out.getvalue()
+        )
+        self.assertTrue(ImportDeclaration.objects.filter(name="A").exists())
+        with self.assertRaises(CommandError):
+            call_command("import_inbox", "XXX", "-")
+
+
+class AreaMoveTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def setUp(self):
+        PendingRecounts.clear()
+        IdentityMap.clear()
+        self.url = reverse("bulkarea_move", args=[3])
+
+    def post(self, area_ids, parent_id, structures=None, follow=False):
+        data = {"move": "move", "area_id_str": ":".join(str(i) for i in area_ids)}
+        if structures is None:
+            data.update(movetype="area", area_new_parent_id=parent_id)
+        else:
+            data.update(movetype="structure", struct_new_parent_id=parent_id)
+            for area_id, structure_id in structures.items():
+                data["area-target-struct-%s" % area_id] = structure_id
+        # following the redirect starts a new request, which would drop
+        # recount marks not yet written at the end of the test transaction
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(self.url, data, follow=follow)
+
+    def test_move_area(self):
+        response = self.post([4], 2)
+        self.assertRedirects(response, reverse("area", args=[3]))
+        self.assertEqual(Area.objects.get(pk=4).parent_id, 2)
+        self.assertEqual(
+            sorted(Area.objects.get(pk=4).direct_ancestor_ids()), [1, 2, 4]
+        )
+        self.assertEqual(Area.objects.get(pk=3).subtree_height, 0)
+        self.assertEqual(Area.objects.get(pk=4).depth, 2)
+        self.assertTrue(Country.objects.get(pk=1).is_popcount_needed)
+        self.assertEqual(TreeCheck.load(Country.objects.get(pk=1)).run()["ok"], True)
+
+    def test_move_structure(self):
+        Area.objects.create(
+            name="Village", country_id=1, parent_id=5, structure_id=4, population=5
+        )
+        self.post([5], 1, {5: 2, Area.objects.get(name="Village").id: 3})
+        area = Area.objects.get(pk=5)
+        self.assertEqual((area.parent_id, area.structure_id, area.depth), (1, 2, 1))
+        village = Area.objects.get(name="Village")
+        self.assertEqual((village.structure_id, village.depth), (3, 2))
+        self.assertEqual(area.subtree_height, 1)
+        self.assertEqual(Area.objects.get(pk=2).subtree_height, 0)
+        self.assertEqual(TreeCheck.load(Country.objects.get(pk=1)).run()["ok"], True)
+        repair = io.StringIO()
+        call_command("repair_tree_fields", stdout=repair)
+        self.assertIn("repaired 0 structures and 0 areas", repair.getvalue())
+
+    def test_under_own_descendant(self):
+        response = self.post([2], 5, {2: 3}, follow=True)
+        self.assertContains(response, "would be under its own descendant")
+        self.assertEqual(Area.objects.get(pk=2).parent_id, 1)
+        self.assertEqual(Area.objects.get(pk=2).structure_id, 2)
+
+    def test_wrong_structure(self):
+        response = self.post([4, 5], 1, follow=True)
+        self.assertContains(response, "would not be below structure")
+        self.assertEqual(
+            list(Area.objects.filter(pk__in=[4, 5]).values_list("parent", flat=True)),
+            [3, 2],
+        )
+
+    def test_root(self):
+        response = self.post([1], 2, follow=True)
+        self.assertContains(response, "is the root")
+        self.assertEqual(Area.objects.get(pk=1).parent_id, 1)
+
+    def test_constant_queries(self):
+        Area.objects.create(
+            name="West Locality", country_id=1, parent_id=2, structure_id=3
+        )
+        west = Area.objects.get(name="West Locality")
+        # load anything cached for the whole process
+        self.post([1], 2)
+        # each move changes the height of one area
+        with CaptureQueriesContext(connection) as one:
+            self.post([4], 2)
+        with CaptureQueriesContext(connection) as two:
+            self.post([5, west.id], 3)
+        self.assertEqual(len(one), len(two))
+
+
+class BulkSupplementTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def setUp(self):
+        PendingRecounts.clear()
+        IdentityMap.clear()
+        Area.objects.create(
+            name="West Locality", country_id=1, parent_id=2, structure_id=3
+        )
+        self.west = Area.objects.get(name="West Locality")
+        self.url = reverse("bulkarea_save", args=[2])
+
+    def post(self, area_ids, add=(), remove=()):
+        data = {
+            "save": "save",
+            "area_id_str": ":".join(str(i) for i in area_ids),
+            "supp_list_add": ":".join(str(i) for i in add),
+            "supp_list_rm": ":".join(str(i) for i in remove),
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(self.url, data)
+
+    def supplements(self, area_id):
+        return sorted(
+            Area.objects.get(pk=area_id).supplements.values_list("id", flat=True)
+        )
+
+    def test_add_and_remove(self):
+        Country.objects.filter(pk=1).update(popcount_ready=1)
+        response = self.post([5, self.west.id], add=[3, 4, 5])
+        self.assertRedirects(
+            response, reverse("area", args=[2]), target_status_code=200
+        )
+        self.assertEqual(self.supplements(5), [3, 4])
+        self.assertEqual(self.supplements(self.west.id), [3, 4, 5])
+        self.assertTrue(
+            AreaClosure.objects.filter(
+                ancestor=5, descendant=self.west.id, direct=False
+            ).exists()
+        )
+        self.assertTrue(Country.objects.get(pk=1).is_popcount_needed)
+
+        self.post([5, self.west.id], add=[3], remove=[4, 5])
+        self.assertEqual(self.supplements(5), [3])
+        self.assertEqual(self.supplements(self.west.id), [3])
+        self.assertFalse(
+            AreaClosure.objects.filter(ancestor=5, descendant=self.west.id).exists()
+        )
+        self.assertEqual(TreeCheck.load(Country.objects.get(pk=1)).run()["ok"], True)
+
+    def test_no_change(self):
+        self.post([5], add=[3])
+        Country.objects.filter(pk=1).update(popcount_ready=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(Area.edit_supplements([5], [3], [4]), (0, 0))
+        self.assertFalse(Country.objects.get(pk=1).is_popcount_needed)
+
+    def test_constant_queries(self):
+        self.post([5], add=[3])
+        with CaptureQueriesContext(connection) as one:
+            self.post([5], add=[4], remove=[3])
+        with CaptureQueriesContext(connection) as two:
+            self.post([5, self.west.id], add=[3, 1], remove=[4])
+        self.assertEqual(len(one), len(two))
+
+
+class CountrySummaryTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def summary(self):
+        return CountrySummary.objects.get(country=1)
+
+    def counts(self):
+        summary = self.summary()
+        return (
+            summary.num_structures,
+            summary.num_areas,
+            summary.num_declarations,
+            summary.inbox_count,
+        )
+
+    def test_maintained_by_changes(self):
+        self.assertEqual(self.counts(), (4, 5, 2, 0))
+        country = Country.objects.get(pk=1)
+        area = Area.objects.create(
+            name="East Region",
+            country=country,
+            parent_id=1,
+            structure_id=2,
+            population=1000,
+        )
+        Declaration.objects.create(
+            area=area, status="D", event_date=datetime.date(2020, 3, 1)
+        )
+        ImportDeclaration.objects.create(name="East", country=country)
+        self.assertEqual(self.counts(), (4, 6, 3, 1))
+
+        # deleting an area also deletes its children and their declarations
+        Area.objects.get(pk=3).delete()
+        self.assertEqual(self.counts(), (4, 4, 2, 1))
+
+        country.generate_population_count()
+        self.assertEqual(self.summary().current_popcount, 201000)
+
+    def test_refresh(self):
+        CountrySummary.objects.filter(country=1).update(num_areas=0, inbox_count=9)
+        out = io.StringIO()
+        call_command("refresh_country_summaries", "ERW", stdout=out)
+        self.assertEqual(self.counts(), (4, 5, 2, 0))
+        with self.assertRaises(CommandError):
+            call_command("refresh_country_summaries", "XXX", stdout=out)
+
+    def test_declarations_counted_for_given_countries(self):
+        self.assertEqual(Country.active_declaration_counts(ids=[1]), {1: 2})
+        self.assertEqual(Country.active_declaration_counts(ids=[]), {})
+
+    def test_declarations_recounted_with_population(self):
+        # as if a declaration dated in the future had since become active
+        CountrySummary.objects.filter(country=1).update(num_declarations=0)
+        Country.objects.get(pk=1).generate_population_count()
+        self.assertEqual(self.summary().num_declarations, 2)
+
+    def test_countries_page_queries(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("countries"))
+        self.assertContains(response, "Erewhon")
+
+
+class PopulationCounterTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def setUp(self):
+        self.country = Country.objects.get(pk=1)
+        self.root = Area.objects.get(pk=1)
+        # South Region is a supplementary parent of North-West Locality,
+        # and declares after both localities
+        self.area_south = Area.objects.get(pk=3)
+        Area.objects.get(pk=5).supplements.add(self.area_south)
+        Declaration.objects.create(
+            area=self.area_south, status="D", event_date=datetime.date(2020, 3, 1)
+        )
+        Declaration.objects.create(
+            area=Area.objects.get(pk=4),
+            status="V",
+            event_date=datetime.date(2020, 4, 1),
+        )
+        self.dates = [None, "2019-12-31", "2020-01-01", "2020-02-15", "2020-03-01"]
+        self.dates.append("2020-04-01")
+
+    def test_snapshot_matches_model_count(self):
+        snapshot = CountrySnapshot.load(self.country)
+        for date in self.dates:
+            expected = PopulationCounter().declared_population(self.root, date=date)
+            counted = PopulationCounter(snapshot).declared_population(
+                self.root, date=date
+            )
+            self.assertEqual(counted, expected, "count differs at %s" % date)
+
+    def test_snapshot_load_queries(self):
+        with self.assertNumQueries(3):
+            snapshot = CountrySnapshot.load(self.country)
+        with self.assertNumQueries(0):
+            for date in self.dates:
+                PopulationCounter(snapshot).declared_population(self.root, date=date)
+
+
+def random_snapshot(rng, num_areas=40, num_events=60):
+    snapshot = CountrySnapshot(1)
+    snapshot.add_area(1, 1, rng.randint(0, 100))
+    snapshot.root_id = 1
+    for area_id in range(2, num_areas + 1):
+        snapshot.add_area(area_id, rng.randint(1, area_id - 1), rng.randint(0, 100))
+    for area_id in range(2, num_areas + 1):
+        for supp in rng.sample(range(1, num_areas + 1), rng.randint(0, 2)):
+            if supp != area_id:
+                snapshot.add_supplement(area_id, supp)
+    start = datetime.date(2019, 1, 1)
+    events = sorted(
+        (
+            start + datetime.timedelta(days=rng.randint(0, 30)),
+            rng.randint(1, num_areas),
+        )
+        for _ in range(num_events)
+    )
+    for event_date, area_id in events:
+        snapshot.add_event(area_id, event_date, rng.choice("DDDVN"))
+    dates = sorted(set(e[0] for e in events))
+    return snapshot, dates
+
+
+class SweepCounterTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def test_sweep_matches_full_count(self):
+        rng = random.Random(1234)
+        for _ in range(25):
+            snapshot, dates = random_snapshot(rng)
+            counter = SweepCounter(snapshot)
+            for date, total in counter.count(dates):
+                self.assertEqual(total, snapshot.declared_population(1, date))
+
+    def test_restore_state(self):
+        rng = random.Random(4321)
+        for _ in range(25):
+            snapshot, dates = random_snapshot(rng)
+            counter = SweepCounter(snapshot)
+            half = len(dates) // 2
+            list(counter.count(dates[:half]))
+            restored = SweepCounter.restore(snapshot, counter.get_state())
+            self.assertEqual(
+                list(restored.count(dates[half:])), list(counter.count(dates[half:]))
+            )
+
+    def test_generate_population_count(self):
+        country = Country.objects.get(pk=1)
+        country.generate_population_count()
+        self.assertEqual(
+            [(str(pc.date), pc.population) for pc in country.popcounts],
+            [("2020-01-01", 100000), ("2020-02-01", 300000)],
+        )
+        self.assertEqual(country.current_popcount, 300000)
+
+
+class ArrayCounterTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def scenario(self, areas, supplements=(), declared=()):
+        """Build a snapshot from (name, parent name, population) tuples,
+        (name, supplementary parent name) pairs, and (name, date) declarations.
+        The first area is the root."""
+        snapshot = CountrySnapshot(1)
+        ids = {}
+        for name, parent, population in areas:
+            ids[name] = len(ids) + 1
+            snapshot.add_area(ids[name], ids.get(parent, ids[name]), population)
+        snapshot.root_id = 1
+        for name, supplement in supplements:
+            snapshot.add_supplement(ids[name], ids[supplement])
+        for name, event_date in sorted(declared, key=lambda d: d[1]):
+            snapshot.add_event(ids[name], event_date, "D")
+        return snapshot
+
+    def assertMatchesSnapshot(self, snapshot, dates):
+        totals = list(ArrayCounter(snapshot).count(dates))
+        expected = [(date, snapshot.declared_population(1, date)) for date in dates]
+        self.assertEqual(totals, expected)
+        return [total for date, total in totals]
+
+    def test_fixture_matches_population_counter(self):
+        country = Country.objects.get(pk=1)
+        counter = ArrayCounter(CountrySnapshot.load(country))
+        root = Area.objects.get(pk=1)
+        dates = ["2019-12-31", "2020-01-01", "2020-01-15", "2020-02-01"]
+        self.assertEqual(
+            [total for date, total in counter.count(dates)],
+            [PopulationCounter().declared_population(root, date) for date in dates],
+        )
+
+    def test_example_count_scenarios(self):
+        # the trees from govtrack/test/example_count.py, declaring one area
+        # per day in the order given there
+        day = [datetime.date(2020, 1, d) for d in range(1, 5)]
+        simple = self.scenario(
+            [
+                ("L1", None, 60),
+                ("L2A", "L1", 30),
+                ("L2B", "L1", 20),
+                ("L2C", "L1", 10),
+                ("L3A1", "L2A", 15),
+                ("L3A2", "L2A", 10),
+                ("L3A3", "L2A", 5),
+                ("L3B1", "L2B", 20),
+                ("L3B1A", "L3B1", 10),
+                ("L3B1B", "L3B1", 10),
+            ],
+            declared=[("L2A", day[0]), ("L3B1", day[1]), ("L3B1A", day[2])],
+        )
+        self.assertEqual(self.assertMatchesSnapshot(simple, day), [30, 50, 50, 50])
+
+        overlapping = [
+            ("L1", None, 40),
+            ("L2A", "L1", 40),
+            ("L2B", "L1", 20),
+            ("L3A1", "L2A", 10),
+            ("L3A2", "L2A", 10),
+            ("L3A3", "L2A", 10),
+            ("L3A4", "L2A", 10),
+        ]
+        supplements = [("L3A3", "L2B"), ("L3A4", "L2B")]
+        two = self.scenario(
+            overlapping, supplements, [("L2B", day[0]), ("L2A", day[1])]
+        )
+        self.assertEqual(self.assertMatchesSnapshot(two, day), [20, 40, 40, 40])
+        three = self.scenario(
+            overlapping + [("L3A41", "L3A4", 5), ("L3A42", "L3A4", 5)],
+            supplements,
+            [("L2A", day[0]), ("L2B", day[1]), ("L3A41", day[2])],
+        )
+        self.assertEqual(self.assertMatchesSnapshot(three, day), [40, 40, 40, 40])
+
+        uzbekistan = self.scenario(
+            [
+                ("UZB", None, 4),
+                ("1_T1A", "UZB", 2),
+                ("1_T1R", "UZB", 4),
+                ("1_T2R", "1_T1R", 1),
+                ("2_T2R", "1_T1R", 1),
+                ("3_T2R", "1_T1R", 1),
+                ("4_T2R", "1_T1R", 1),
+            ],
+            [("3_T2R", "1_T1A"), ("4_T2R", "1_T1A")],
+            [("1_T1A", day[0]), ("1_T1R", day[1])],
+        )
+        self.assertEqual(self.assertMatchesSnapshot(uzbekistan, day), [2, 4, 4, 4])
+
+    def test_random_trees(self):
+        rng = random.Random(2468)
+        for _ in range(50):
+            snapshot, dates = random_snapshot(rng)
+            counter = ArrayCounter(snapshot)
+            counter.CHUNK_SIZE = rng.randint(1, 8)
+            self.assertEqual(
+                list(counter.count(dates)), list(SweepCounter(snapshot).count(dates))
+            )
+
+    def test_generate_population_count(self):
+        country = Country.objects.get(pk=1)
+        country.generate_population_count(engine="array")
+        self.assertEqual(
+            [(str(pc.date), pc.population) for pc in country.popcounts],
+            [("2020-01-01", 100000), ("2020-02-01", 300000)],
+        )
+        self.assertFalse(PopCountCheckpoint.objects.filter(country=country).exists())
+        with self.assertRaises(ValueError):
+            country.generate_population_count(engine="abacus")
+
+
+class PopCountTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def setUp(self):
+        PendingRecounts.clear()
+        self.country = Country.objects.get(pk=1)
+        self.country.generate_population_count()
+
+    def test_partial_recount(self):
+        first = self.country.popcounts.first()
+        with self.captureOnCommitCallbacks(execute=True):
+            Declaration.objects.create(
+                area=Area.objects.get(pk=3),
+                status="D",
+                event_date=datetime.date(2020, 3, 1),
+            )
+        country = Country.objects.get(pk=1)
+        self.assertEqual(country.popcount_since, datetime.date(2020, 3, 1))
+
+        # running locally, so the recount happens straight away
+        country.trigger_population_recount()
+        country = Country.objects.get(pk=1)
+        popcounts = list(country.popcounts)
+        # counts before the new declaration are left alone
+        self.assertEqual(popcounts[0].id, first.id)
+        self.assertEqual(
+            [(str(pc.date), pc.population) for pc in popcounts],
+            [("2020-01-01", 100000), ("2020-02-01", 300000), ("2020-03-01", 400000)],
+        )
+        self.assertEqual(country.current_popcount, 400000)
+        self.assertIs(country.is_popcount_needed, False)
+        self.assertIsNone(country.popcount_since)
+
+    def test_failed_recount_keeps_series(self):
+        before = [(pc.id, pc.population) for pc in self.country.popcounts]
+        with self.captureOnCommitCallbacks(execute=True):
+            Declaration.objects.create(
+                area=Area.objects.get(pk=3),
+                status="D",
+                event_date=datetime.date(2020, 3, 1),
+            )
+        country = Country.objects.get(pk=1)
+        with mock.patch.object(
+            PopCountCheckpoint.objects, "bulk_create", side_effect=RuntimeError
+        ):
+            with self.assertRaises(RuntimeError):
+                country.generate_population_count()
+        # the old series is swapped out only once the new one is written
+        country = Country.objects.get(pk=1)
+        self.assertEqual([(pc.id, pc.population) for pc in country.popcounts], before)
+        self.assertIs(country.is_popcount_needed, True)
+
+    def test_checkpoints(self):
+        checkpoint = PopCountCheckpoint.objects.get(country=self.country)
+        self.assertEqual(str(checkpoint.date), "2020-02-01")
+        self.assertEqual(checkpoint.population, 300000)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Declaration.objects.create(
+                area=Area.objects.get(pk=3),
+                status="D",
+                event_date=datetime.date(2020, 3, 1),
+            )
+        country = Country.objects.get(pk=1)
+        with mock.patch.object(
+            PopCountCheckpoint, "restore", wraps=checkpoint.restore
+        ) as restore:
+            country.generate_population_count(country.popcount_since)
+            self.assertEqual(restore.call_count, 1)
+        self.assertEqual(country.current_popcount, 400000)
+
+        # changing a population invalidates all checkpoints
+        area = Area.objects.get(pk=4)
+        area.population = 50000
+        with self.captureOnCommitCallbacks(execute=True):
+            area.save()
+        self.assertFalse(PopCountCheckpoint.objects.filter(country=country).exists())
+
+    def test_moved_declaration(self):
+        dec = Declaration.objects.get(pk=2)
+        dec.event_date = datetime.date(2020, 5, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            dec.save()
+        # counts from the original date onwards are affected
+        country = Country.objects.get(pk=1)
+        self.assertEqual(country.popcount_since, datetime.date(2020, 2, 1))
+
+
+class PendingRecountsTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def setUp(self):
+        PendingRecounts.clear()
+        Country.objects.filter(pk=1).update(popcount_ready=1, popcount_since=None)
+
+    def test_coalesced(self):
+        country = Country.objects.get(pk=1)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertNumQueries(0):
+                for day in [20, 10, 15]:
+                    country.popcount_update_needed(datetime.date(2020, 3, day))
+        # one callback wrote everything
+        self.assertEqual(len(callbacks), 1)
+        country = Country.objects.get(pk=1)
+        self.assertIs(country.is_popcount_needed, True)
+        self.assertEqual(country.popcount_since, datetime.date(2020, 3, 10))
+
+    def test_one_update_per_country(self):
+        areas = list(Area.objects.filter(country=1))
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                for area in areas:
+                    area.population += 1
+                    area.save()
+        updates = [
+            q["sql"]
+            for q in queries.captured_queries
+            if q["sql"].startswith('UPDATE "govtrack_country"')
+        ]
+        self.assertEqual(len(updates), 1)
+
+    def test_since(self):
+        def mark(since):
+            with self.captureOnCommitCallbacks(execute=True):
+                Country.objects.get(pk=1).popcount_update_needed(since)
+            return Country.objects.get(pk=1).popcount_since
+
+        self.assertEqual(mark("2020-3-1"), datetime.date(2020, 3, 1))
+        # an earlier pending date is kept
+        self.assertEqual(mark("2020-4-1"), datetime.date(2020, 3, 1))
+        self.assertEqual(mark("2020-2-1"), datetime.date(2020, 2, 1))
+        # a full recount stays a full recount
+        self.assertIsNone(mark(None))
+        self.assertIsNone(mark("2020-5-1"))
+        self.assertIs(Country.objects.get(pk=1).is_popcount_needed, True)
+
+    def test_rolled_back(self):
+        country = Country.objects.get(pk=1)
+        try:
+            with transaction.atomic():
+                country.popcount_update_needed("2020-3-1")
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertIs(Country.objects.get(pk=1).is_popcount_needed, False)
+        # the mark is dropped, and isn't written at the next commit
+        with self.captureOnCommitCallbacks(execute=True):
+            country.popcount_update_needed("2020-6-1")
+        country = Country.objects.get(pk=1)
+        self.assertEqual(country.popcount_since, datetime.date(2020, 6, 1))
+
+    def test_rolled_back_savepoint(self):
+        country = Country.objects.get(pk=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            country.popcount_update_needed("2020-6-1")
+            try:
+                with transaction.atomic():
+                    country.popcount_update_needed("2020-3-1")
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        # only the mark made outside the savepoint is written
+        country = Country.objects.get(pk=1)
+        self.assertEqual(country.popcount_since, datetime.date(2020, 6, 1))
+
+    def test_rolled_back_in_earlier_request(self):
+        for new_scope in [
+            lambda: request_started.send(sender=self.__class__),
+            lambda: task_scope().__enter__(),
+        ]:
+            country = Country.objects.get(pk=1)
+            try:
+                with transaction.atomic():
+                    country.popcount_update_needed("2020-3-1")
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            # a later request or task doesn't write it
+            new_scope()
+            with self.captureOnCommitCallbacks(execute=True):
+                country.popcount_update_needed("2020-6-1")
+            country = Country.objects.get(pk=1)
+            self.assertEqual(country.popcount_since, datetime.date(2020, 6, 1))
+            Country.objects.filter(pk=1).update(popcount_ready=1, popcount_since=None)
+
+
+class GenerateTimelineCommandTests(TestCase):
+
+    fixtures = ["testdata"]
+
+    def run_command(self, *args, **kwargs):
+        out = io.StringIO()
+        call_command("generate_timeline", *args, workers=1, stdout=out, **kwargs)
+        return out.getvalue()
+
+    def test_recounts_given_countries(self):
+        output = self.run_command("ERW")
+        self.assertIn("ERW: done", output)
+        country = Country.objects.get(pk=1)
+        self.assertEqual(country.current_popcount, 300000)
+        self.assertEqual(country.popcounts.count(), 2)
+
+    def test_defaults_to_countries_needing_recount(self):
+        output = self.run_command()
+        self.assertIn("No countries need a population recount", output)
+
+        Country.objects.filter(pk=1).update(popcount_ready=0)
+        output = self.run_command()
+        self.assertIn("ERW: done", output)
+        self.assertIs(Country.objects.get(pk=1).is_popcount_needed, False)
+
+    def test_failed_recount_is_retried(self):
+        PendingRecounts.clear()
+        Country.objects.filter(pk=1).update(popcount_ready=0)
+        with mock.patch.object(
+            Country, "generate_population_count", side_effect=RuntimeError("boom")
+        ):
+            err = io.StringIO()
+            with self.captureOnCommitCallbacks(execute=True):
+                with self.assertRaises(CommandError):
+                    call_command("generate_timeline", workers=1, stderr=err)
+        self.assertIn("RuntimeError: boom", err.getvalue())
+        self.assertIs(Country.objects.get(pk=1).is_popcount_needed, True)
+
+        output = self.run_command()
+        self.assertIn("ERW: done", output)
+        self.assertIs(Country.objects.get(pk=1).is_popcount_needed, False)
+
+    def test_reports_failures(self):
+        err = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command("generate_timeline", "XXX", workers=1, stderr=err)
+        self.assertIn("XXX: failed", err.getvalue())
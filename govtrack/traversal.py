@@ -0,0 +1,149 @@
+"""Iterative traversal of trees held in adjacency maps.
+
+A tree is given as a dict mapping each node to a list of its children, in
+order, usually built in one query with children_map. Nothing here
+recurses, so trees of any depth can be traversed, and queues and visited
+sets take constant time per operation.
+"""
+
+from collections import deque
+
+
+class CycleError(ValueError):
+    """Raised when following parent links leads back to a node already seen."""
+
+    def __init__(self, cycle):
+        super().__init__("nodes %s are in a loop of parent links" % cycle)
+        self.cycle = cycle
+
+
+def children_map(pairs):
+    """Build a map of each node's children from (node, parent) pairs, with
+    children in the order the pairs are given. Root nodes, which are their
+    own parent, are not listed as children."""
+    children = {}
+    for node, parent in pairs:
+        if parent != node:
+            children.setdefault(parent, []).append(node)
+    return children
+
+
+def bfs(children, root):
+    """Return the nodes under root, including root itself, in breadth-first order."""
+    visited = {root}
+    queue = deque([root])
+    order = []
+    while queue:
+        node = queue.popleft()
+        order.append(node)
+        for child in children.get(node, ()):
+            if child not in visited:
+                visited.add(child)
+                queue.append(child)
+    return order
+
+
+def dfs(children, root):
+    """Return the nodes under root, including root itself, in depth-first
+    order, with each node before its children."""
+    visited = {root}
+    order = [root]
+    stack = [iter(children.get(root, ()))]
+    while stack:
+        for child in stack[-1]:
+            if child not in visited:
+                visited.add(child)
+                order.append(child)
+                stack.append(iter(children.get(child, ())))
+                break
+        else:
+            stack.pop()
+    return order
+
+
+def levels(children, root):
+    """Return a list of the nodes at each depth under root, starting with [root]."""
+    visited = {root}
+    layers = []
+    layer = [root]
+    while layer:
+        layers.append(layer)
+        next_layer = []
+        for node in layer:
+            for child in children.get(node, ()):
+                if child not in visited:
+                    visited.add(child)
+                    next_layer.append(child)
+        layer = next_layer
+    return layers
+
+
+def group_by_level(items, level):
+    """Group items by the result of level(item), keeping them in order."""
+    groups = {}
+    for item in items:
+        groups.setdefault(level(item), []).append(item)
+    return groups
+
+
+def ancestor_path(parents, node):
+    """Return the path from the root down to node, following the parent of
+    each node in parents. Raises CycleError if the path loops."""
+    path = [node]
+    seen = {node}
+    parent = parents.get(node, node)
+    while parent != node:
+        if parent in seen:
+            raise CycleError(path[path.index(parent) :])
+        path.append(parent)
+        seen.add(parent)
+        node, parent = parent, parents.get(parent, parent)
+    path.reverse()
+    return path
+
+
+def find_cycles(successors):
+    """Return the groups of nodes which are in loops in a directed graph,
+    given as a map of each node's successors. Each group is a list of
+    nodes which can all be reached from each other; nodes which are only
+    their own successor, as roots are their own parent, are ignored."""
+    # Tarjan's strongly connected components, with an explicit stack
+    index = {}
+    lowlink = {}
+    component = []
+    in_component = set()
+    cycles = []
+    for start in list(successors):
+        if start in index:
+            continue
+        index[start] = lowlink[start] = len(index)
+        component.append(start)
+        in_component.add(start)
+        stack = [(start, iter(successors.get(start, ())))]
+        while stack:
+            node, nodes_after = stack[-1]
+            for succ in nodes_after:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = len(index)
+                    component.append(succ)
+                    in_component.add(succ)
+                    stack.append((succ, iter(successors.get(succ, ()))))
+                    break
+                if succ in in_component:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            else:
+                stack.pop()
+                if stack:
+                    parent = stack[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    group = []
+                    while True:
+                        member = component.pop()
+                        in_component.discard(member)
+                        group.append(member)
+                        if member == node:
+                            break
+                    if len(group) > 1:
+                        cycles.append(sorted(group))
+    return cycles
@@ -0,0 +1,186 @@
+"""Building the ordered list of areas shown on country and area pages.
+
+Hierarchy.build_hierarchy runs a query for the children of every area in
+the tree, which is too slow for large countries. Pages start with a single
+row instead, and AreaBranch loads the rows under an area as they are
+expanded, a level at a time. StructureTree loads a country's structures,
+which are few, all at once.
+"""
+
+from django.db.models import F, OuterRef, Q, Subquery
+import django.urls
+
+import copy
+import logging
+
+logger = logging.getLogger("cegov")
+
+
+class StructureTree:
+    """All the structures of a country, with their children in name order."""
+
+    def __init__(self, country):
+        self.country = country
+        self.structures = {}
+
+    @classmethod
+    def load(cls, country):
+        """Load the structures for a country, in one query."""
+        from .models import Structure
+
+        tree = cls(country)
+        structures = Structure.objects.filter(country=country.id).order_by("name")
+        for structure in structures:
+            tree.structures[structure.id] = structure
+            structure.loaded_children = []
+        for structure in tree.structures.values():
+            parent = tree.structures.get(structure.parent_id)
+            if parent and parent is not structure:
+                parent.loaded_children.append(structure)
+        return tree
+
+    def structure_hierarchy(self, structure):
+        """Return the same list as Hierarchy.build_hierarchy for a structure."""
+        itemlist = [structure]
+        stack = [iter(self.structures[structure.id].loaded_children)]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+                continue
+            itemlist.append(child)
+            stack.append(iter(child.loaded_children))
+        return itemlist
+
+
+def load_structure_children(structures):
+    """Load the children of each of the given structures, in name order, as
+    loaded_children, along with the number of children of each, as
+    num_children. The structures of all their countries are loaded in one
+    query, which is cheap as countries only have a handful each."""
+    from .models import Structure
+
+    structures = list(structures)
+    forest = {s.id: s for s in structures}
+    country_ids = {s.country_id for s in structures}
+    for structure in Structure.objects.filter(country__in=country_ids):
+        forest.setdefault(structure.id, structure)
+    for structure in forest.values():
+        structure.loaded_children = []
+    for structure in sorted(forest.values(), key=lambda s: s.name):
+        parent = forest.get(structure.parent_id)
+        if parent and parent is not structure:
+            parent.loaded_children.append(structure)
+    for structure in forest.values():
+        structure.num_children = len(structure.loaded_children)
+    return structures
+
+
+class AreaBranch:
+    """Loads the areas under an area a level at a time, with the counts and
+    declared status needed to show each row worked out by the database."""
+
+    # the most levels which can be loaded at once
+    MAX_DEPTH = 3
+
+    def __init__(self, country):
+        self.country = country
+        self.tree = StructureTree.load(country)
+
+    @staticmethod
+    def annotate(queryset):
+        """Add the number of children, the number of supplementary children,
+        and the status of the latest declaration, to each area."""
+        from .models import Area, Declaration
+
+        latest = Declaration.objects.filter(area=OuterRef("pk")).order_by(
+            "-event_date", "-id"
+        )
+        return Area.with_child_counts(queryset, supplementary=True).annotate(
+            latest_status=Subquery(latest.values("status")[:1])
+        )
+
+    def prepare(self, area):
+        """Share the country and structures between rows, so that showing
+        them takes no more queries."""
+        area.country = self.country
+        if area.structure_id in self.tree.structures:
+            area.structure = self.tree.structures[area.structure_id]
+        return area
+
+    def children(self, parents):
+        """Return a dict of the direct and supplementary children of each of
+        the given areas, in display order, loaded in two queries."""
+        from .models import Area
+
+        by_id = {parent.id: parent for parent in parents}
+        supplements = {}
+        for area_id, parent_id in (
+            Area.supplements.through.objects.filter(to_area__in=by_id)
+            .exclude(from_area=F("to_area"))
+            .values_list("from_area_id", "to_area_id")
+        ):
+            supplements.setdefault(area_id, []).append(parent_id)
+
+        areas = self.annotate(
+            Area.objects.filter(Q(parent__in=by_id) | Q(id__in=supplements))
+        ).order_by("structure", "sort_name")
+        children = {}
+        for area in areas:
+            self.prepare(area)
+            listed_under = supplements.get(area.id, [])
+            if area.parent_id in by_id:
+                listed_under = [area.parent_id, *listed_under]
+            for parent_id in dict.fromkeys(listed_under):
+                if parent_id == area.id:
+                    continue
+                child = area
+                if parent_id != area.parent_id:
+                    # the same area may also be listed under its own parent
+                    child = copy.copy(area)
+                    child.is_supplementary = True
+                    child.override_indent_level = by_id[parent_id].indent_level + 1
+                children.setdefault(parent_id, []).append(child)
+        return children
+
+    def expand(self, area, depth=1):
+        """Load the areas under area, down to the given number of levels, into
+        the branch attribute of each area. Areas listed under supplementary
+        parents are not expanded."""
+        self.prepare(area)
+        depth = max(1, min(depth, self.MAX_DEPTH))
+        frontier = [area]
+        for _ in range(depth):
+            children = self.children(frontier)
+            next_frontier = []
+            for parent in frontier:
+                parent.branch = children.get(parent.id, [])
+                next_frontier.extend(c for c in parent.branch if not c.is_supplementary)
+            frontier = next_frontier
+            if not frontier:
+                break
+        return area.branch
+
+    def as_json(self, area, render_row=None):
+        """Return a dict describing an area and any of the areas loaded under
+        it, including each row's HTML if a function to render it is given."""
+        row = {
+            "id": area.id,
+            "name": area.name,
+            "structure": area.structure.name,
+            "structure_id": area.structure_id,
+            "level": area.level,
+            "indent_level": area.indent_level,
+            "population": area.population,
+            "is_declared": area.is_declared,
+            "is_supplementary": area.is_supplementary,
+            "num_children": area.num_children,
+            "num_supplementary_children": area.num_supplementary_children,
+            "url": django.urls.reverse("area", args=[area.id]),
+            "expand_url": django.urls.reverse("api_area_tree", args=[area.id]),
+        }
+        if render_row:
+            row["html"] = render_row(area)
+        if hasattr(area, "branch"):
+            row["children"] = [self.as_json(c, render_row) for c in area.branch]
+        return row
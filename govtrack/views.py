@@ -5,11 +5,20 @@ from django.forms.models import (
     modelformset_factory,
     inlineformset_factory,
 )
+from django.contrib import messages
 from django.forms import HiddenInput
 from django.http import JsonResponse, HttpResponseBadRequest
 import django.urls
 
-from .models import Declaration, Country, Area, Structure, Link, ImportDeclaration
+from .models import (
+    Declaration,
+    Country,
+    CountrySummary,
+    Area,
+    Structure,
+    Link,
+    ImportDeclaration,
+)
 from .forms import (
     StructureForm,
     AreaForm,
@@ -18,6 +27,9 @@ from .forms import (
     CountryForm,
     BulkAreaForm,
 )
+from .areamove import AreaMove
+from .treebuilder import AreaBranch
+from . import traversal
 
 import csv
 import datetime
@@ -31,34 +43,39 @@ logger = logging.getLogger("cegov")
 
 
 def index(request):
-    # first get all countries with active declarations
-    dlist = Declaration.objects.filter(status="D").order_by(
-        "area__country__name", "area__sort_name"
+    # get the active declarations for all countries at once
+    dlist = (
+        Declaration.active_at()
+        .select_related("area__country")
+        .order_by("area__country__name", "area__country_id", "event_date", "id")
     )
-    declared_countries = set([d.area.country for d in dlist])
-    country_list = sorted(list(declared_countries), key=lambda c: c.name)
     countries = []
-    # now get the actual declarations for each country
-    for c in country_list:
-        dlist = c.active_declarations()
-        if dlist:
+    for dec in dlist:
+        c = dec.area.country
+        if not countries or countries[-1][0]["id"] != c.id:
             countries.append(
                 (
                     {
                         "name": c.name,
                         "id": c.id,
-                        "num_areas": len(dlist),
+                        "num_areas": 0,
                         "declared_population": c.current_popcount,
                     },
-                    dlist,
+                    [],
                 )
             )
+        countries[-1][0]["num_areas"] += 1
+        countries[-1][1].append(dec)
     return render(request, "govtrack/index.html", {"countries": countries})
 
 
 def area(request, area_id):
     area = get_object_or_404(Area, pk=area_id)
-    records = area.build_hierarchy()
+    # only this area's row is shown at first; the rows under it are
+    # loaded from the api as they are expanded
+    branch = AreaBranch(area.country)
+    (row,) = branch.annotate(Area.objects.filter(pk=area.id))
+    records = [branch.prepare(row)]
 
     import_declarations = ImportDeclaration.objects.filter(
         country=area.country
@@ -81,18 +98,14 @@ def area(request, area_id):
 
 
 def countries(request):
-    clist = Country.objects.order_by("name")
-    update_needed = False
-    for c in clist:
-        c.inbox_count = ImportDeclaration.objects.filter(country=c).count()
-        c.area_population = c.current_popcount
-        if c.is_popcount_needed:
-            update_needed = True
+    # all the figures shown come from the summaries, so this is one query
+    slist = CountrySummary.objects.select_related("country").order_by("country__name")
+    update_needed = any(s.country.is_popcount_needed for s in slist)
     return render(
         request,
         "govtrack/countries.html",
         {
-            "country_list": clist,
+            "summary_list": slist,
             "update_needed": update_needed,
             "update_url": django.urls.reverse("api_trigger_all_recounts"),
         },
@@ -143,8 +156,10 @@ def country(request, country_id, action="view"):
                         logger.warn("did not save url because %s " % linkform.errors)
                         action = "edit"
 
-    structure = country.get_root_structure().build_hierarchy()
-    records = country.get_root_area().build_hierarchy()
+    branch = AreaBranch(country)
+    structure = branch.tree.structure_hierarchy(country.get_root_structure())
+    root_areas = Area.objects.filter(country=country.id, structure__level=1)
+    records = [branch.prepare(row) for row in branch.annotate(root_areas)]
 
     import_declarations = ImportDeclaration.objects.filter(country=country).order_by(
         "date"
@@ -268,47 +283,21 @@ def bulkarea_move(request, area_id):
     area = get_object_or_404(Area, pk=area_id)
     logger.info(f"moving bulk area data for {area}")
     if request.method == "POST" and request.POST.get("move"):
-        logger.info(request.POST)
         # get area ids to be moved
-        idlist = request.POST.get("area_id_str").split(":")
-        for aid in idlist:
-            logger.info(f"moving area {aid}")
-
+        idlist = request.POST.get("area_id_str", "").split(":")
+        move = AreaMove(area.country)
+        # sometimes we get a list of two elements
+        # where the second is unset and the first is the value we want
         if request.POST.get("movetype") == "area":
-            # get parent to move them to
-            new_parent_vals = request.POST.getlist("area_new_parent_id")
-            # for some reason we get a list of two elements
-            # where the second is unset and the first is the value we want
-            new_parent = new_parent_vals[0]
-            logger.info(f"moving to parent {new_parent} from {new_parent_vals}")
-            for aid in idlist:
-                area = Area.objects.get(pk=aid)
-                area.parent = Area.objects.get(pk=new_parent)
-                area.save()
+            move.move(idlist, request.POST.getlist("area_new_parent_id")[0])
         elif request.POST.get("movetype") == "structure":
-            logger.info("doing a complex move")
-            # get parent to move them to
-            new_parent_vals = request.POST.getlist("struct_new_parent_id")
-            logger.info(f"new parent vals {new_parent_vals}")
-            # sometimes we get a list of two elements
-            # where the second is unset and the first is the value we want
-            new_parent_id = new_parent_vals[0]
-            new_parent = Area.objects.get(pk=new_parent_id)
-            logger.info(f"moving to parent {new_parent.id} from {new_parent_vals}")
-            for aid in idlist:
-                area = Area.objects.get(pk=aid)
-                area.parent = new_parent
-                area.save()
-            target_structure_keys = [
-                s for s in request.POST.keys() if s[0:19] == "area-target-struct-"
-            ]
-            for key in target_structure_keys:
-                area_id = key[19:]
-                structure_id = request.POST.get(key)
-                logger.info(f"moving area {area_id} to structure {structure_id}")
-                area = Area.objects.get(pk=area_id)
-                area.structure = Structure.objects.get(pk=structure_id)
-                area.save()
+            move.move(idlist, request.POST.getlist("struct_new_parent_id")[0])
+            for key, structure_id in request.POST.items():
+                if key.startswith("area-target-struct-"):
+                    move.restructure(key[19:], structure_id)
+        report = move.run()
+        for error in report["errors"]:
+            messages.error(request, error["detail"])
 
     return redirect("area", area_id=area_id)
 
@@ -334,49 +323,19 @@ def bulkarea_save(request, area_id):
             add_link = cdata["link"]
             if request.POST.get("do_set_link", "") != "true":
                 add_link = ""
-            supps_to_add_str = request.POST.get("supp_list_add")
-            supps_to_rm_str = request.POST.get("supp_list_rm")
-            supps_to_add = set(supps_to_add_str.split(":"))
-            supps_to_rm = set(supps_to_rm_str.split(":"))
-            logger.info(f"adding supps {supps_to_add_str} {supps_to_add}")
-            logger.info(f"rming supps {supps_to_rm_str} {supps_to_rm}")
-
-            for area in areas:
-                if add_link:
+            supps_to_add = request.POST.get("supp_list_add", "").split(":")
+            supps_to_rm = request.POST.get("supp_list_rm", "").split(":")
+            logger.info(f"adding supps {supps_to_add}, rming supps {supps_to_rm}")
+
+            if add_link:
+                for area in areas:
                     area.add_link(add_link)
-                all_current_supps = list(
-                    area.supplements.all().values_list("id", flat=True)
-                )
-                logger.info(f"current supps: { all_current_supps }")
-                a_changed = False
-                for add_area in supps_to_add:
-                    if add_area and int(add_area) not in all_current_supps:
-                        if int(add_area) == int(area.id):
-                            logger.info(
-                                f"Can't add area {add_area} to {area.id} are you crazy?"
-                            )
-                        else:
-                            logger.info(
-                                f"adding area {add_area} to supps {all_current_supps} for {area.id}: {add_area == area.id}"
-                            )
-                            area.supplements.add(add_area)
-                            a_changed = True
-                for rm_area in supps_to_rm:
-                    if rm_area and int(rm_area) in all_current_supps:
-                        logger.info(
-                            f"rming area {rm_area} from supps {all_current_supps}"
-                        )
-                        area.supplements.remove(rm_area)
-                        a_changed = True
-                if a_changed:
-                    logger.info(f"about to save area {area.id}")
-                    area.save()
-                    logger.info(f"done saving area {area.id}")
-                all_latest_supps = list(
-                    area.supplements.all().values_list("id", flat=True)
-                )
-                logger.info(f"updated supps: { all_latest_supps }")
-            logger.info(f"Completed updating supps for { area }")
+            added, removed = Area.edit_supplements(
+                [area.id for area in areas],
+                [int(a) for a in supps_to_add if a.isdigit()],
+                [int(a) for a in supps_to_rm if a.isdigit()],
+            )
+            logger.info(f"added {added} and removed {removed} supplementary links")
         else:
             # TODO: ideally would return an error here and preserve other settings
             logger.info(f"Problem with form: {masterform.errors}")
@@ -414,7 +373,11 @@ def bulkarea_edit(request, area_id):
     action = request.POST.get("action")
     structure = None
 
-    area_obj = Area.objects.filter(id__in=edit_areas).order_by("sort_name")
+    area_obj = (
+        Area.objects.filter(id__in=edit_areas)
+        .select_related("structure", "parent__structure")
+        .order_by("sort_name")
+    )
     tmpl_data = {
         "action": action,
         "area": area,
@@ -436,39 +399,45 @@ def bulkarea_edit(request, area_id):
         # find the max number of descendants for all areas
         max_level = 0
         uniq_structures = set()
+        # load the whole country once, so that descendants are found in memory
+        areas, children = area.load_tree()
         for a in area_obj:
             uniq_structures.add(a.structure)
             desc_list = []
             print(f"{a.id} min level {max_level} a.level {a.level}")
             area_height = 0
             skip_descendants = set()
-            kids_by_level = a.get_children_by_level()
+            subtree = traversal.dfs(children, a.id)
+            kids_by_level = traversal.group_by_level(
+                (areas[i] for i in subtree), lambda d: d.level
+            )
             logger.info(kids_by_level)
             current_level = a.level + 1
             end_level = a.level + a.height
             logger.info(
                 f"{a.id} will start at level {current_level} end at {end_level} ({a.level} + {a.height})"
             )
-            logger.info(f"{a.id} all descendants: {a.descendants}")
+            logger.info(f"{a.id} all descendants: {subtree[1:]}")
             # Look at all descendants by level
             # For each level, identify any descendants who are being directly selected to move
             # (in a nested move, when an area and >1 of its descendants are specifically selected)
             # Remove any selected descendants *and their descendants* from the descendants list
             while current_level <= end_level:
                 logger.info(f"LEVEL {current_level}")
-                if len(kids_by_level[str(current_level)]):
+                level_kids = kids_by_level.get(current_level, [])
+                if len(level_kids):
                     area_height += 1
                     logger.info(
                         f"at level {current_level} area height is {area_height}"
                     )
                 num_kids_this_level = 0
-                for d in kids_by_level[str(current_level)]:
+                for d in level_kids:
                     logger.info(
                         f"a {a.id} has desc {d.id}, is in edit_areas? {edit_areas} or desc {skip_descendants}"
                     )
                     if str(d.id) in edit_areas:
                         logger.info(f"{a.id} yep {d.id} is in {edit_areas}")
-                        kid_ids = [k.id for k in d.descendants]
+                        kid_ids = traversal.bfs(children, d.id)[1:]
                         skip_descendants.update(kid_ids)
                         logger.info(
                             f"{a.id} adding kids {kid_ids} to skip_desc {skip_descendants}"
@@ -482,7 +451,7 @@ def bulkarea_edit(request, area_id):
                     logger.info(
                         f"{a.id} kids at level {current_level}: {num_kids_this_level}"
                     )
-                if num_kids_this_level == 0:
+                if level_kids and num_kids_this_level == 0:
                     logger.info(f"{a.id} no kids at level {current_level}")
                     area_height -= 1
                 current_level += 1
@@ -509,7 +478,7 @@ def bulkarea_edit(request, area_id):
         enable_multi_move = True  # may be limited by user in future
         tmpl_data["enable_multi_move"] = enable_multi_move
 
-        all_areas = Area.objects.filter(country=area.country)
+        all_areas = list(areas.values())
         print(f"have {len(all_areas)} areas in country")
         # Potential parents must have a structure with at least [max_level] descendants
         if same_structure:
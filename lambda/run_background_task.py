@@ -16,6 +16,7 @@ import django
 
 django.setup()
 
+from govtrack.identitymap import task_scope
 from govtrack.models import Country
 
 
@@ -29,18 +30,25 @@ def handler(event, context):
 
 def generate_timeline(event, context):
     print("Called with event data " + str(event))
-    try:
-        print(
-            f"Finding country {event['country_code']} from class {Country}={Country.content_type_id()}"
-        )
-        country = Country.find_by_code(event["country_code"])
-        print(f"got country {country}")
-        country.generate_population_count()
-        print(f"Finished generating population count for {event['country_code']}")
-    except KeyError as ex:
-        print(f"No country code specified: {ex}")
-    except Country.DoesNotExist as ex:
-        print(f"No country found with code {event['country_code']} {ex}")
+    # warm containers keep module state between invocations, so start and
+    # finish each task with empty request caches
+    with task_scope():
+        try:
+            print(
+                f"Finding country {event['country_code']} from class {Country}={Country.content_type_id()}"
+            )
+            country = Country.find_by_code(event["country_code"])
+            print(f"got country {country}")
+            # only counts from the since date onwards need to be regenerated;
+            # an empty since date means regenerate the whole series
+            since_date = event.get("since_date") or None
+            print(f"regenerating counts from {since_date}")
+            country.generate_population_count(since_date)
+            print(f"Finished generating population count for {event['country_code']}")
+        except KeyError as ex:
+            print(f"No country code specified: {ex}")
+        except Country.DoesNotExist as ex:
+            print(f"No country found with code {event['country_code']} {ex}")
     print("All done")
 
 
@@ -48,7 +56,8 @@ if __name__ == "__main__":
     try:
         country_code = sys.argv[1]
         print(country_code)
-        generate_timeline({"country_code": country_code}, {})
+        since_date = sys.argv[2] if len(sys.argv) > 2 else ""
+        generate_timeline({"country_code": country_code, "since_date": since_date}, {})
         print("DOne generating timeline")
     except:
         pass